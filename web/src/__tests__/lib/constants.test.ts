@@ -1,5 +1,5 @@
 import { describe, it, expect } from 'vitest'
-import { MEDIA_TYPES, isMediaType, POSTS_PER_PAGE, DEFAULT_SITE_URL } from '@/lib/constants'
+import { MEDIA_TYPES, isMediaType, POSTS_PER_PAGE, DEFAULT_SITE_URL, telegramChannelId } from '@/lib/constants'
 
 describe('constants', () => {
   it('should have correct media types', () => {
@@ -26,3 +26,12 @@ describe('isMediaType', () => {
   })
 })
 
+
+describe('telegramChannelId', () => {
+  it('should parse numeric chat ids', () => {
+    expect(telegramChannelId('-1001234567890')).toBe(-1001234567890)
+    expect(telegramChannelId('')).toBe(null)
+    expect(telegramChannelId(undefined)).toBe(null)
+    expect(telegramChannelId('batarikh')).toBe(null)
+  })
+})
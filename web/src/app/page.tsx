@@ -14,6 +14,7 @@ import {
   MEDIA_TYPE_LABELS,
   PAGINATION_RANGE,
   isMediaType,
+  telegramChannelId,
 } from "@/lib/constants";
 
 export const dynamic = "force-dynamic";
@@ -59,9 +60,15 @@ export default async function Home({ searchParams }: { searchParams?: Promise<{
     try {
       let query = client
         .from("posts")
-        .select("id,created_at,content,media_type,media_url,width,height", { count: "exact" })
+        .select("channel_id,id,created_at,content,media_type,media_url,width,height,media", { count: "exact" })
+        .is("deleted_at", null)
         .order("created_at", { ascending: false })
         .range(from, to);
+      // Post ids are only unique per channel; t.me links below assume NEXT_PUBLIC_TELEGRAM_CHANNEL
+      const channelId = telegramChannelId();
+      if (channelId !== null) {
+        query = query.eq("channel_id", channelId);
+      }
       if (type && isMediaType(type)) {
         query = query.eq("media_type", type);
       }
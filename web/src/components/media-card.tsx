@@ -4,7 +4,7 @@ import Image from 'next/image'
 import { Card, CardHeader, CardTitle, CardDescription, CardContent } from '@/components/ui/card'
 import { Button } from '@/components/ui/button'
 import { Badge } from '@/components/ui/badge'
-import type { Post, MediaType } from '@/types/post'
+import type { Post, PostMedia, MediaType } from '@/types/post'
 import dynamic from 'next/dynamic'
 import { useEffect, useRef, useState, type ComponentType } from 'react'
 import { FileDown, Video, AudioLines, FileText, Image as ImageIcon, AlignRight, ArrowUpRight } from 'lucide-react'
@@ -45,6 +45,57 @@ function labelForType(t: MediaType) {
   }
 }
 
+/** Albums list every part in order; single posts carry their media on the row itself */
+function mediaItems(post: Post): PostMedia[] {
+  if (post.media && post.media.length > 0) return post.media
+  return [{ id: post.id, type: post.media_type, url: post.media_url, width: post.width, height: post.height }]
+}
+
+function MediaItem({ item, post, inView }: { item: PostMedia; post: Post; inView: boolean }) {
+  if (!item.url) return null
+  const isPdf = item.url.toLowerCase().endsWith('.pdf')
+  if (item.type === 'document' || isPdf) {
+    const href = `/download?${new URLSearchParams({ url: item.url, name: `post-${item.id}.pdf` }).toString()}`
+    return (
+      <div className="w-fit pr-4 pt-4">
+        <Button asChild variant="pdf" size="lg" className="w-full justify-start py-6 px-2">
+          <a href={href} target="_blank" rel="noreferrer">
+            <FileDown className="ml-2" />
+            دانلود PDF
+          </a>
+        </Button>
+      </div>
+    )
+  }
+  if (item.type === 'image') {
+    return (
+      <div style={{ aspectRatio: (item.width && item.height) ? `${item.width}/${item.height}` : DEFAULT_IMAGE_ASPECT_RATIO }} className="w-full">
+        <Image
+          src={item.url}
+          alt={(sanitizeContent(post.content) || `تصویر - ${formatDate(post.created_at)}`) as string}
+          width={item.width ?? 800}
+          height={item.height ?? 600}
+          sizes="(min-width:1024px) 33vw, (min-width:640px) 50vw, 100vw"
+          className="w-full h-full object-cover"
+        />
+      </div>
+    )
+  }
+  if (item.type === 'video') {
+    return (
+      <div style={{ aspectRatio: (item.width && item.height) ? `${item.width}/${item.height}` : DEFAULT_VIDEO_ASPECT_RATIO }} className="w-full">
+        {inView && (
+          <VideoPlayer src={item.url} title="Video" className="w-full h-full" />
+        )}
+      </div>
+    )
+  }
+  if (item.type === 'audio' && inView) {
+    return <AudioPlayer src={item.url} title="Audio" className="w-full" />
+  }
+  return null
+}
+
 export function MediaCard({ post }: { post: Post }) {
   const ref = useRef<HTMLDivElement | null>(null)
   const [inView, setInView] = useState(false)
@@ -70,46 +121,9 @@ export function MediaCard({ post }: { post: Post }) {
 
   return (
     <Card ref={ref}>
-      {(() => {
-        const isPdf = !!post.media_url && post.media_url.toLowerCase().endsWith('.pdf')
-        const isDocument = post.media_type === 'document' || isPdf
-        if (isDocument && post.media_url) {
-          const href = `/download?${new URLSearchParams({ url: post.media_url, name: `post-${post.id}.pdf` }).toString()}`
-          return (
-            <div className="w-fit pr-4 pt-4">
-              <Button asChild variant="pdf" size="lg" className="w-full justify-start py-6 px-2">
-                <a href={href} target="_blank" rel="noreferrer">
-                  <FileDown className="ml-2" />
-                  دانلود PDF
-                </a>
-              </Button>
-            </div>
-          )
-        }
-        return null
-      })()}
-      {post.media_type === 'image' && post.media_url && (
-        <div style={{ aspectRatio: (post.width && post.height) ? `${post.width}/${post.height}` : DEFAULT_IMAGE_ASPECT_RATIO }} className="w-full">
-          <Image
-            src={post.media_url}
-            alt={(sanitizeContent(post.content) || `تصویر - ${formatDate(post.created_at)}`) as string}
-            width={post.width ?? 800}
-            height={post.height ?? 600}
-            sizes="(min-width:1024px) 33vw, (min-width:640px) 50vw, 100vw"
-            className="w-full h-full object-cover"
-          />
-        </div>
-      )}
-      {post.media_type === 'video' && post.media_url && (
-        <div style={{ aspectRatio: (post.width && post.height) ? `${post.width}/${post.height}` : DEFAULT_VIDEO_ASPECT_RATIO }} className="w-full">
-          {inView && (
-            <VideoPlayer src={post.media_url} title="Video" className="w-full h-full" />
-          )}
-        </div>
-      )}
-      {post.media_type === 'audio' && post.media_url && inView && (
-        <AudioPlayer src={post.media_url} title="Audio" className="w-full" />
-      )}
+      {mediaItems(post).map((item) => (
+        <MediaItem key={item.id} item={item} post={post} inView={inView} />
+      ))}
       <CardContent>
         {post.content && (
           <p className="text-md whitespace-pre-wrap leading-6">{sanitizeContent(post.content)}</p>
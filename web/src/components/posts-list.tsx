@@ -9,7 +9,7 @@ export function PostsList({ posts }: { posts: Post[] }) {
     <ErrorBoundary>
       <div className="columns-1 sm:columns-2 lg:columns-2 gap-4">
         {posts.map((p) => (
-          <ErrorBoundary key={p.id}>
+          <ErrorBoundary key={`${p.channel_id}:${p.id}`}>
             <MediaCard post={p} />
           </ErrorBoundary>
         ))}
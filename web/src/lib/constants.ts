@@ -11,6 +11,16 @@ export const DEFAULT_SITE_URL = 'https://batarikh.xyz'
 export const DEFAULT_TELEGRAM_CHANNEL = 'batarikh'
 export const DEFAULT_MEDIA_HOST = 'batarikhmedia.stream'
 
+/**
+ * Numeric Telegram chat id of the channel this site shows, or null to show
+ * every channel in the posts table (single-channel deployments)
+ */
+export function telegramChannelId(value: string | undefined = process.env.NEXT_PUBLIC_TELEGRAM_CHANNEL_ID): number | null {
+  if (!value) return null
+  const id = Number(value)
+  return Number.isInteger(id) ? id : null
+}
+
 // Media types
 export const MEDIA_TYPES = ['image', 'video', 'audio', 'document', 'none'] as const
 
@@ -2,7 +2,17 @@ import type { MediaType } from '@/lib/constants'
 
 export type { MediaType }
 
+/** One part of an album, in message order */
+export interface PostMedia {
+  id: number
+  type: MediaType
+  url: string | null
+  width: number | null
+  height: number | null
+}
+
 export interface Post {
+  channel_id: number
   id: number
   created_at: string
   content: string | null
@@ -10,4 +20,5 @@ export interface Post {
   media_url: string | null
   width: number | null
   height: number | null
+  media: PostMedia[] | null
 }
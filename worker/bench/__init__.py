@@ -0,0 +1 @@
+"""Benchmarks for the worker; run them from worker/ as python3 -m bench.<name>."""
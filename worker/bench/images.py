@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Image derivative micro-benchmark: what each image setting costs and buys.
+
+Runs imaging.render_derivatives, the code the worker's transform stage
+runs, over a directory of sample images once per configuration in a
+sweep over variant sizes (IMAGE_SIZES), format (webp / avif / original,
+i.e. ENABLE_RESIZED_ORIGINALS), quality (WEBP_QUALITY / AVIF_QUALITY),
+resampling filter (IMAGE_RESAMPLE), decode strategy and
+MAX_IMAGE_DIMENSION. Per configuration it reports render and encode
+time, peak memory, output bytes and SSIM against a Lanczos-scaled
+reference, as a table and as JSON.
+
+Decode strategies: "full" decodes every image at full size, "draft" always
+takes the low-memory path (JPEG DCT scaling down to the largest variant),
+"auto" is the worker's default (draft only above LOW_MEMORY_PIXELS). With
+full-size variants enabled (webp/avif) draft only scales down images
+larger than MAX_IMAGE_DIMENSION.
+
+Each configuration renders in a fresh process, so its peak RSS is its own.
+SSIM is computed on luma afterwards and needs numpy (optional: without it
+the SSIM columns are left empty).
+
+Usage (from worker/):
+    python3 -m bench.images [DIR] [--sizes 1024 --sizes 640,1280] [--formats webp,avif]
+                            [--qualities 60,75,85] [--filters bicubic,lanczos]
+                            [--decode auto,draft] [--max-dimensions 8192]
+                            [--repeat N] [--out FILE]
+
+Without DIR a few synthetic photos are generated (640x480 to 4032x3024).
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import imaging
+from imaging import HAS_PIL
+
+if HAS_PIL:
+    from PIL import Image, features
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FILTERS = ("nearest", "box", "bilinear", "hamming", "bicubic", "lanczos")
+DECODES = ("full", "draft", "auto")
+_MB = 1024 * 1024
+
+def _csv(value: str) -> List[str]:
+    return [v.strip().lower() for v in value.split(",") if v.strip()]
+
+def _sizes(value: str) -> List[int]:
+    try:
+        return [int(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"sizes must be comma-separated integers: {value!r}")
+
+def _configs(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    configs = []
+    for sizes, fmt, quality, resample, decode, max_dim in itertools.product(
+            args.sizes or [imaging.IMAGE_SIZES], args.formats, args.qualities, args.filters, args.decode,
+            args.max_dimensions):
+        if fmt == "original" and quality != args.qualities[0]:
+            continue  # resized originals are saved at the encoder's default quality
+        configs.append({"sizes": sizes, "format": fmt, "quality": None if fmt == "original" else quality,
+                        "resample": resample, "decode": decode, "max_dimension": max_dim})
+    return configs
+
+def _current(config: Dict[str, Any]) -> bool:
+    """Whether `config` is what the worker runs with under the current environment."""
+    enabled = {"webp": imaging.ENABLE_WEBP, "avif": imaging.ENABLE_AVIF, "original": imaging.ENABLE_RESIZED_ORIGINALS}
+    quality = imaging.AVIF_QUALITY if config["format"] == "avif" else imaging.WEBP_QUALITY
+    return (enabled[config["format"]] and config["sizes"] == imaging.IMAGE_SIZES and config["resample"] == imaging.IMAGE_RESAMPLE
+            and config["decode"] == "auto" and config["quality"] in (quality, None)
+            and config["max_dimension"] == int(os.getenv("MAX_IMAGE_DIMENSION", "8192")))
+
+def render_config(config: Dict[str, Any], images: List[str], out_dir: str, repeat: int) -> Dict[str, Any]:
+    """Render every image under `config` (runs in a fresh process)."""
+    from memwatch import peak_rss_bytes, rss_bytes
+
+    imaging.IMAGE_SIZES = config["sizes"]
+    imaging.ENABLE_WEBP = config["format"] == "webp"
+    imaging.ENABLE_AVIF = config["format"] == "avif"
+    imaging.ENABLE_RESIZED_ORIGINALS = config["format"] == "original"
+    if config["quality"] is not None:
+        imaging.WEBP_QUALITY = imaging.AVIF_QUALITY = config["quality"]
+    imaging.IMAGE_RESAMPLE = config["resample"]
+    if config["decode"] == "full":
+        imaging.LOW_MEMORY_PIXELS = 1 << 62
+    os.environ["MAX_IMAGE_DIMENSION"] = str(config["max_dimension"])
+
+    encodes: List[Tuple[str, float]] = []
+    save = imaging._save
+
+    def timed_save(im, path, fmt, size, **params):
+        started = time.perf_counter()
+        save(im, path, fmt, size, **params)
+        encodes.append((path, (time.perf_counter() - started) * 1000))
+
+    imaging._save = timed_save
+    baseline = rss_bytes()
+    results = []
+    for index, fp in enumerate(images):
+        ext = os.path.splitext(fp)[1]
+        best: Optional[Dict[str, Any]] = None
+        for run in range(repeat):
+            target = os.path.join(out_dir, f"{index}-{run}")
+            os.makedirs(target)
+            encodes.clear()
+            started, cpu = time.perf_counter(), time.process_time()
+            out = imaging.render_derivatives(fp, 0, index, ext, out_dir=target, low_memory=config["decode"] == "draft")
+            took = {"render_ms": (time.perf_counter() - started) * 1000, "cpu_ms": (time.process_time() - cpu) * 1000,
+                    "encode_ms": sum(ms for _, ms in encodes)}
+            # Keep the fastest run; its files are the ones scored
+            if best is None or took["render_ms"] < best["render_ms"]:
+                if best is not None:
+                    shutil.rmtree(best["dir"], ignore_errors=True)
+                encode_ms = dict(encodes)
+                best = dict(took, dir=target, variants=[
+                    {"key": key, "path": path, "bytes": os.path.getsize(path), "encode_ms": round(encode_ms.get(path, 0), 1)}
+                    for path, key in out])
+            else:
+                shutil.rmtree(target, ignore_errors=True)
+        results.append(dict(best, image=fp))
+    return {"images": results, "baseline_rss": baseline, "peak_rss": peak_rss_bytes()}
+
+def _dimensions(fp: str) -> Tuple[int, int]:
+    with Image.open(fp) as im:
+        return im.size
+
+def _luma(im) -> "np.ndarray":
+    return np.asarray(im.convert("L"), dtype=np.float64)
+
+def _box(x: "np.ndarray", w: int) -> "np.ndarray":
+    """Mean over every w x w window (valid region only), via a summed-area table."""
+    c = np.pad(x, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    return (c[w:, w:] - c[:-w, w:] - c[w:, :-w] + c[:-w, :-w]) / (w * w)
+
+def ssim(a: "np.ndarray", b: "np.ndarray", window: int = 7) -> float:
+    """Mean SSIM of two same-size luma arrays (uniform window, as skimage's default)."""
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    n = window * window
+    cov = n / (n - 1)  # sample covariance
+    mu_a, mu_b = _box(a, window), _box(b, window)
+    var_a = cov * (_box(a * a, window) - mu_a * mu_a)
+    var_b = cov * (_box(b * b, window) - mu_b * mu_b)
+    var_ab = cov * (_box(a * b, window) - mu_a * mu_b)
+    s = ((2 * mu_a * mu_b + c1) * (2 * var_ab + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(s.mean())
+
+def score(runs: List[Dict[str, Any]]) -> None:
+    """Add an SSIM to every variant: against the full decode, Lanczos-scaled to the variant's size."""
+    by_image: Dict[str, List[Dict[str, Any]]] = {}
+    for run in runs:
+        for image in run["images"]:
+            by_image.setdefault(image["image"], []).extend(image["variants"])
+    for fp, variants in by_image.items():
+        with Image.open(fp) as im:
+            source = im.convert("RGB")
+        references: Dict[Tuple[int, int], "np.ndarray"] = {}
+        for variant in variants:
+            with Image.open(variant["path"]) as im:
+                im.load()
+                size = im.size
+                if size not in references:
+                    references[size] = _luma(source if source.size == size else source.resize(size, Image.Resampling.LANCZOS))
+                variant["ssim"] = round(ssim(references[size], _luma(im)), 4) if min(size) >= 7 else None
+
+def summarize(config: Dict[str, Any], run: Dict[str, Any]) -> Dict[str, Any]:
+    images = run["images"]
+    variants = [v for i in images for v in i["variants"]]
+    scores = [v["ssim"] for v in variants if v.get("ssim") is not None]
+    n = max(len(images), 1)
+    by_variant: Dict[str, Dict[str, Any]] = {}
+    for v in variants:
+        # "-w1024.webp" / ".webp": the variant name without the per-image prefix
+        name = v["key"].split("/", 1)[1].lstrip("0123456789")
+        entry = by_variant.setdefault(name, {"count": 0, "bytes": 0, "encode_ms": 0.0, "ssim": []})
+        entry["count"] += 1
+        entry["bytes"] += v["bytes"]
+        entry["encode_ms"] += v["encode_ms"]
+        if v.get("ssim") is not None:
+            entry["ssim"].append(v["ssim"])
+    return {
+        "config": config,
+        "current": _current(config),
+        "render_ms_per_image": round(sum(i["render_ms"] for i in images) / n, 1),
+        "cpu_ms_per_image": round(sum(i["cpu_ms"] for i in images) / n, 1),
+        "encode_ms_per_image": round(sum(i["encode_ms"] for i in images) / n, 1),
+        "bytes_per_image": round(sum(v["bytes"] for v in variants) / n),
+        "peak_rss_mb": round(run["peak_rss"] / _MB, 1),
+        "peak_added_mb": round(max(0, run["peak_rss"] - run["baseline_rss"]) / _MB, 1),
+        "ssim_mean": round(sum(scores) / len(scores), 4) if scores else None,
+        "ssim_min": min(scores) if scores else None,
+        "variants": {name: {"count": e["count"], "bytes_mean": round(e["bytes"] / e["count"]),
+                            "encode_ms_mean": round(e["encode_ms"] / e["count"], 1),
+                            "ssim_mean": round(sum(e["ssim"]) / len(e["ssim"]), 4) if e["ssim"] else None}
+                     for name, e in sorted(by_variant.items())},
+        "images": [{"image": os.path.basename(i["image"]), "render_ms": round(i["render_ms"], 1),
+                    "variants": [{k: v[k] for k in ("key", "bytes", "encode_ms", "ssim") if k in v} for v in i["variants"]]}
+                   for i in images],
+    }
+
+def _print_table(rows: List[Dict[str, Any]]) -> None:
+    header = (f"  {'format':<9}{'q':>4}  {'sizes':<12}{'filter':<10}{'decode':<7}{'max dim':>8}"
+              f"{'render ms':>11}{'encode ms':>11}{'peak MB':>9}{'KB/image':>10}{'SSIM':>8}{'min':>8}")
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        c = row["config"]
+        ssim_mean = f"{row['ssim_mean']:.4f}" if row["ssim_mean"] is not None else "-"
+        ssim_min = f"{row['ssim_min']:.4f}" if row["ssim_min"] is not None else "-"
+        sizes = ",".join(map(str, c["sizes"]))
+        print(f"{'*' if row['current'] else ' '} {c['format']:<9}{c['quality'] or '-':>4}  {sizes:<12}{c['resample']:<10}"
+              f"{c['decode']:<7}{c['max_dimension']:>8}{row['render_ms_per_image']:>11}{row['encode_ms_per_image']:>11}"
+              f"{row['peak_added_mb']:>9}{row['bytes_per_image'] / 1024:>10.1f}{ssim_mean:>8}{ssim_min:>8}")
+    print("\nPer image, averaged over the corpus. peak MB: peak RSS above the rendering process's baseline. "
+          "* = the current settings.")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("dir", nargs="?", help="directory of sample images (default: generate a few)")
+    parser.add_argument("--sizes", type=_sizes, action="append",
+                        help="an IMAGE_SIZES value to try; repeat for more (default: the current IMAGE_SIZES)")
+    parser.add_argument("--formats", type=_csv, default=None, help="webp, avif, original (default: webp, plus avif if supported)")
+    parser.add_argument("--qualities", type=lambda v: [int(q) for q in _csv(v)], default=[imaging.WEBP_QUALITY])
+    parser.add_argument("--filters", type=_csv, default=[imaging.IMAGE_RESAMPLE], help=", ".join(FILTERS))
+    parser.add_argument("--decode", type=_csv, default=["auto", "draft"], help=", ".join(DECODES))
+    parser.add_argument("--max-dimensions", type=lambda v: [int(d) for d in _csv(v)],
+                        default=[int(os.getenv("MAX_IMAGE_DIMENSION", "8192"))])
+    parser.add_argument("--repeat", type=int, default=1, help="render each image N times and keep the fastest")
+    parser.add_argument("--out", help="results file (default: bench/results/images-<time>.json)")
+    args = parser.parse_args()
+
+    if not HAS_PIL:
+        raise SystemExit("Pillow is not installed")
+    if args.formats is None:
+        args.formats = ["webp", "avif"] if features.check("avif") else ["webp"]
+    for name, values, allowed in (("format", args.formats, ("webp", "avif", "original")),
+                                  ("filter", args.filters, FILTERS), ("decode strategy", args.decode, DECODES)):
+        unknown = set(values) - set(allowed)
+        if unknown:
+            parser.error(f"unknown {name}: {', '.join(sorted(unknown))}")
+    if "avif" in args.formats and not features.check("avif"):
+        parser.error("this Pillow build has no AVIF support")
+
+    work_dir = tempfile.mkdtemp(prefix="image-bench-")
+    try:
+        if args.dir:
+            images = [os.path.join(args.dir, n) for n in sorted(os.listdir(args.dir))
+                      if n.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))]
+        else:
+            from bench.standins import make_corpus
+            images = [f.path for f in make_corpus(os.path.join(work_dir, "corpus")) if f.kind == "image"]
+        if not images:
+            raise SystemExit(f"No images found in {args.dir}")
+        configs = _configs(args)
+        print(f"{len(configs)} configuration(s) x {len(images)} image(s)")
+
+        runs = []
+        spawn = multiprocessing.get_context("spawn")
+        for n, config in enumerate(configs, 1):
+            out_dir = os.path.join(work_dir, f"config-{n}")
+            os.makedirs(out_dir)
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                runs.append(pool.submit(render_config, config, images, out_dir, args.repeat).result())
+            print(f"  [{n}/{len(configs)}] {config['format']} q={config['quality']} sizes={config['sizes']} "
+                  f"{config['resample']} {config['decode']}: {sum(i['render_ms'] for i in runs[-1]['images']):.0f} ms")
+        if np is not None:
+            score(runs)
+        else:
+            print("numpy is not installed: skipping SSIM (pip install -r bench/requirements.txt)")
+
+        rows = [summarize(config, run) for config, run in zip(configs, runs)]
+        print()
+        _print_table(rows)
+        result = {
+            "benchmark": "images",
+            "at": datetime.now().astimezone().isoformat(timespec="seconds"),
+            "images": [{"name": os.path.basename(fp), "bytes": os.path.getsize(fp), "size": list(_dimensions(fp))}
+                       for fp in images],
+            "environment": {"pillow": Image.__version__, "cpus": os.cpu_count(), "ssim": np is not None},
+            "configurations": rows,
+        }
+        out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                       f"images-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nResults saved to {out}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
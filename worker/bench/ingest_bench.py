@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+End-to-end ingest benchmark, with no Telegram, R2 or Supabase involved.
+
+Runs the worker's own code (process_message, or backfill_channel through
+IngestPipeline) on synthetic messages whose media comes from a local
+corpus. Uploads go to a moto S3 server started in a subprocess, rows go to
+SQLite behind a stand-in for the supabase client (see bench/standins.py).
+Reports messages/s, per-stage latency percentiles, CPU time and peak RSS,
+and saves the results as JSON so runs can be compared.
+
+Usage (from worker/):
+    pip install -r bench/requirements.txt
+    python3 -m bench.ingest_bench [--mode backfill|process] [--messages N] [--corpus DIR]
+                                  [--mix text=40,image=40,video=10,document=10]
+                                  [--download-latency-ms MS] [--download-mbps MBPS] [--db-latency-ms MS]
+                                  [--out FILE] [--compare FILE]
+
+Without --corpus a small corpus is generated (photos from 640x480 to
+4032x3024, a PDF, a 12 MB video). The worker's settings come from the
+environment as usual (IMAGE_SIZES, ENABLE_AVIF, PIPELINE_*_WORKERS, ...);
+the ones that matter are recorded with the results. Real credentials in
+.env are never used: every service setting is overridden before the
+worker is imported.
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+BENCH_CHAT_ID = -1000000000001
+SETTINGS_ENV = ("IMAGE_SIZES", "ENABLE_WEBP", "ENABLE_AVIF", "ENABLE_RESIZED_ORIGINALS", "PIPELINE_DOWNLOAD_WORKERS",
+                "PIPELINE_TRANSFORM_WORKERS", "PIPELINE_UPLOAD_WORKERS", "PIPELINE_PERSIST_WORKERS",
+                "PIPELINE_QUEUE_SIZE", "PERSIST_BATCH_SIZE", "RSS_BUDGET_MB")
+
+def _parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("text", "image", "video", "document", "audio"):
+            raise argparse.ArgumentTypeError(f"unknown message kind {kind!r}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def _isolate_env(endpoint: str, bucket: str, work_dir: str, messages: int) -> None:
+    """Point every service setting at the stand-ins (load_dotenv won't override these)."""
+    os.environ.update({
+        "API_ID": "0", "API_HASH": "", "SESSION_STRING": "",
+        "SUPABASE_URL": "", "SUPABASE_SERVICE_ROLE_KEY": "",
+        "R2_ENDPOINT": endpoint, "R2_BUCKET": bucket,
+        "R2_ACCESS_KEY_ID": "bench", "R2_SECRET_ACCESS_KEY": "bench",
+        "R2_PUBLIC_BASE_URL": "https://media.bench.invalid",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "TARGET_CHANNELS": str(BENCH_CHAT_ID),
+        "WORKER_STATE_PATH": os.path.join(work_dir, "worker_state.json"),
+        "TRACE_BUFFER_SIZE": str(max(2000, messages + 100)),
+        "BACKFILL_LIMIT": str(messages), "BACKFILL_RESET": "1", "BACKFILL_MEDIA": "",
+        "TELEGRAM_RPS": os.getenv("TELEGRAM_RPS", "1000"), "TELEGRAM_BURST": os.getenv("TELEGRAM_BURST", "1000"),
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+def _percentiles(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pct(p: float) -> float:
+        return round(values[min(len(values) - 1, int(p * len(values)))], 2)
+
+    return {"count": len(values), "mean": round(sum(values) / len(values), 2),
+            "p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99), "max": round(values[-1], 2)}
+
+class _RssSampler:
+    """Peak RSS over the measured run only (ru_maxrss covers the whole process lifetime)."""
+
+    def __init__(self, interval: float = 0.02) -> None:
+        from memwatch import rss_bytes
+        self._rss = rss_bytes
+        self.interval = interval
+        self.start_rss = self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+    def __enter__(self) -> "_RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+def _time_stages(ingest, timings: Dict[str, List[float]]) -> None:
+    """Wrap the stage functions so each call's duration is recorded, in milliseconds.
+
+    process_message runs every stage for every message; calls with nothing
+    to do (text posts, transform of a video) are left out.
+    """
+    def record(name: str, started: float, job) -> None:
+        media_type = getattr(job, "media_type", None)
+        if media_type == "none" or name == "transform" and media_type != "image":
+            return
+        timings.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+
+    def wrap_async(name: str, fn):
+        async def run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                record(name, started, args[0])
+        return run
+
+    def wrap(name: str, fn):
+        def run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, started, args[0])
+        return run
+
+    ingest._stage_download = wrap_async("download", ingest._stage_download)
+    ingest._stage_transform = wrap("transform", ingest._stage_transform)
+    ingest._stage_upload = wrap("upload", ingest._stage_upload)
+    ingest._persist_jobs = wrap_async("persist", ingest._persist_jobs)
+
+async def _run_process(ingest, telegram, concurrency: int, latencies: List[float]) -> None:
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(msg) -> None:
+        async with gate:
+            started = time.perf_counter()
+            await ingest.process_message(msg)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(one(m) for m in telegram.messages.values()))
+
+async def _run_backfill(ingest) -> None:
+    ingest._pipeline = ingest.IngestPipeline()
+    ingest._pipeline.start()
+    try:
+        await ingest.backfill_channel(BENCH_CHAT_ID)
+    finally:
+        await ingest._pipeline.stop()
+
+def _trace_latencies(ingest) -> Dict[str, Any]:
+    """End-to-end and queue-wait percentiles from the pipeline's message traces."""
+    totals, waits = [], {}
+    for trace in ingest.TRACES.slowest(ingest.TRACES.capacity):
+        totals.append(trace["total_ms"])
+        for span in trace["spans"]:
+            if span["name"].startswith("queue:") and "(" not in span["name"]:
+                waits.setdefault(span["name"][len("queue:"):], []).append(span["duration_ms"])
+    return {"end_to_end": _percentiles(totals), "queue_wait": {k: _percentiles(v) for k, v in sorted(waits.items())}}
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    from bench.standins import FakeTelegram, SqliteSupabase, load_corpus, make_corpus, start_s3_server
+
+    work_dir = tempfile.mkdtemp(prefix="ingest-bench-")
+    corpus = load_corpus(args.corpus) if args.corpus else make_corpus(os.path.join(work_dir, "corpus"))
+    if not corpus:
+        raise SystemExit(f"No usable media found in {args.corpus}")
+    server = None
+    endpoint = args.s3_endpoint
+    if not endpoint:
+        server, endpoint = start_s3_server()
+    bucket = f"bench-{int(time.time())}"
+    _isolate_env(endpoint, bucket, work_dir, args.messages)
+    try:
+        import ingest
+        ingest.r2.create_bucket(Bucket=bucket)
+        ingest.supabase = SqliteSupabase(os.path.join(work_dir, "posts.db"), args.db_latency_ms)
+        downloads = os.path.join(work_dir, "downloads")
+        os.makedirs(downloads)
+        telegram = FakeTelegram(BENCH_CHAT_ID, args.messages, corpus, args.mix, downloads,
+                                args.download_latency_ms, args.download_mbps, args.seed)
+        ingest.app = telegram
+        ingest._channels[BENCH_CHAT_ID] = "bench"
+
+        timings: Dict[str, List[float]] = {}
+        _time_stages(ingest, timings)
+        latencies: List[float] = []
+        kinds: Dict[str, int] = {}
+        for msg in telegram.messages.values():
+            kind = ingest._classify_message(msg)[0].replace("none", "text")
+            kinds[kind] = kinds.get(kind, 0) + 1
+
+        usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+        started = time.perf_counter()
+        with _RssSampler() as rss:
+            if args.mode == "process":
+                asyncio.run(_run_process(ingest, telegram, args.concurrency, latencies))
+            else:
+                asyncio.run(_run_backfill(ingest))
+        elapsed = time.perf_counter() - started
+        after = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+
+        cpu = None
+        if usage and after:
+            user, system = after.ru_utime - usage.ru_utime, after.ru_stime - usage.ru_stime
+            cpu = {"user_s": round(user, 2), "system_s": round(system, 2),
+                   "utilization": round((user + system) / elapsed, 2)}  # cores' worth of CPU
+        rows = ingest.supabase.rows("posts")
+        result = {
+            "benchmark": "ingest",
+            "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "mode": args.mode,
+            "messages": args.messages,
+            "kinds": kinds,
+            "elapsed_s": round(elapsed, 2),
+            "messages_per_sec": round(args.messages / elapsed, 2),
+            "rows": len(rows),
+            "media_ready": sum(1 for r in rows if r.get("media_status") == "ready"),
+            "failed": ingest.STATS["failed"],
+            "db_requests": ingest.supabase.requests,
+            "stages_ms": {k: _percentiles(v) for k, v in timings.items()},
+            "cpu": cpu,
+            "rss_mb": {"start": round(rss.start_rss / 2 ** 20, 1), "peak": round(rss.peak / 2 ** 20, 1),
+                       "stage_peaks": ingest._memory.summary()["stage_peak_rss_mb"]},
+            "settings": {k: os.environ[k] for k in SETTINGS_ENV if k in os.environ},
+            "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                            "cpus": os.cpu_count(), "corpus": args.corpus or "generated",
+                            "download_latency_ms": args.download_latency_ms, "download_mbps": args.download_mbps,
+                            "db_latency_ms": args.db_latency_ms},
+        }
+        if args.mode == "process":
+            result["end_to_end_ms"] = _percentiles(latencies)
+            result["settings"]["concurrency"] = args.concurrency
+        else:
+            traced = _trace_latencies(ingest)
+            result["end_to_end_ms"] = traced["end_to_end"]
+            result["queue_wait_ms"] = traced["queue_wait"]
+            result["settings"]["workers"] = ingest._pipeline.workers
+        return result
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if not args.keep:
+            import shutil
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            print(f"Work directory kept: {work_dir}")
+
+def _print_report(result: Dict[str, Any]) -> None:
+    print(f"\n{result['mode']}: {result['messages']} messages {result['kinds']} in {result['elapsed_s']}s "
+          f"= {result['messages_per_sec']} msg/s ({result['rows']} rows, {result['media_ready']} with media, "
+          f"{result['failed']} failed)")
+    print(f"{'stage':<22}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}  (ms)")
+    sections = [("", result["stages_ms"]), ("queue:", result.get("queue_wait_ms", {})),
+                ("", {"end to end": result["end_to_end_ms"]})]
+    for prefix, stats in sections:
+        for name, s in stats.items():
+            if s.get("count"):
+                print(f"{prefix + name:<22}{s['count']:>7}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}{s['mean']:>10}")
+    if result["cpu"]:
+        cpu = result["cpu"]
+        print(f"CPU: {cpu['user_s']}s user, {cpu['system_s']}s system ({cpu['utilization']} cores busy on average)")
+    print(f"RSS: {result['rss_mb']['start']} MB at start, {result['rss_mb']['peak']} MB peak")
+
+def _compare(result: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    def delta(new, old) -> str:
+        if not old or new is None:
+            return f"{new}"
+        return f"{new} ({(new - old) / old * 100:+.1f}%)"
+
+    print(f"\nAgainst {baseline.get('at')} ({baseline.get('mode')}, {baseline.get('messages')} messages):")
+    print(f"  msg/s      {delta(result['messages_per_sec'], baseline.get('messages_per_sec'))}")
+    for name, s in result["stages_ms"].items():
+        old = baseline.get("stages_ms", {}).get(name, {})
+        if s.get("count"):
+            print(f"  {name:<10} p50 {delta(s['p50'], old.get('p50'))}, p95 {delta(s['p95'], old.get('p95'))}")
+    old_cpu = baseline.get("cpu") or {}
+    if result["cpu"]:
+        cpu_s = round(result["cpu"]["user_s"] + result["cpu"]["system_s"], 2)
+        old_s = round(old_cpu.get("user_s", 0) + old_cpu.get("system_s", 0), 2)
+        print(f"  CPU s      {delta(cpu_s, old_s)}")
+    print(f"  peak RSS   {delta(result['rss_mb']['peak'], baseline.get('rss_mb', {}).get('peak'))}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--mode", choices=("backfill", "process"), default="backfill",
+                        help="backfill: backfill_channel through IngestPipeline; process: process_message per message")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4, help="process_message calls in flight (process mode)")
+    parser.add_argument("--corpus", help="directory of media files (.jpg/.png/.webp, .mp4/.mov, .pdf, .mp3)")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("text=40,image=40,video=10,document=10"),
+                        help="relative weights of message kinds")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the message mix")
+    parser.add_argument("--download-latency-ms", type=float, default=0, help="added to every Telegram download and get_messages call")
+    parser.add_argument("--download-mbps", type=float, default=0, help="simulated download bandwidth (0: disk speed)")
+    parser.add_argument("--db-latency-ms", type=float, default=0, help="added to every database request")
+    parser.add_argument("--s3-endpoint", help="use this S3-compatible endpoint instead of starting moto")
+    parser.add_argument("--out", help="results file (default: bench/results/ingest-<mode>-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to print deltas against")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory (corpus, downloads, SQLite db)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    result = run(args)
+    _print_report(result)
+    if baseline:
+        _compare(result, baseline)
+
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                   f"ingest-{args.mode}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nResults saved to {out}")
+
+if __name__ == "__main__":
+    main()
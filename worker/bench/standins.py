@@ -0,0 +1,334 @@
+"""
+Local stand-ins for the worker's external services, for benchmarks.
+
+- SqliteSupabase: the slice of the supabase-py query builder the worker
+  uses, on SQLite (PostgREST upsert semantics: supplied columns are merged
+  into an existing row).
+- FakeTelegram / FakeMessage: synthetic channel history whose media
+  downloads copy files from a local corpus, with optional latency and
+  bandwidth to look like Telegram.
+- start_s3_server: a moto S3 server in a subprocess, so its CPU and memory
+  don't count against the worker being measured.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import sqlite3
+import threading
+import subprocess
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+# ---- Supabase ----
+
+CONFLICT_KEYS = {"posts": ("channel_id", "id"), "worker_state": ("key",)}
+
+class SqliteSupabase:
+    def __init__(self, path: str = ":memory:", latency_ms: float = 0) -> None:
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows (tbl TEXT, pk TEXT, data TEXT, PRIMARY KEY (tbl, pk))")
+        self.latency = latency_ms / 1000
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def table(self, name: str) -> "_Query":
+        return _Query(self, name)
+
+    def rows(self, table: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [json.loads(d) for (d,) in self.db.execute("SELECT data FROM rows WHERE tbl = ?", (table,))]
+
+def _contains(stored: Any, wanted: Any) -> bool:
+    """Postgres jsonb @> for the shapes the worker asks about."""
+    if isinstance(wanted, dict):
+        return isinstance(stored, dict) and all(k in stored and _contains(stored[k], v) for k, v in wanted.items())
+    if isinstance(wanted, list):
+        return isinstance(stored, list) and all(any(_contains(s, w) for s in stored) for w in wanted)
+    return stored == wanted
+
+class _Query:
+    def __init__(self, sink: SqliteSupabase, table: str) -> None:
+        self.sink = sink
+        self.table = table
+        self.op = "select"
+        self.payload: Any = None
+        self.filters: List[Tuple[str, str, Any]] = []
+        self.order_by: Optional[Tuple[str, bool]] = None
+        self.limit_to: Optional[int] = None
+
+    # Builders
+    def select(self, columns: str = "*") -> "_Query":
+        self.op, self.payload = "select", columns
+        return self
+
+    def upsert(self, rows, on_conflict: Optional[str] = None) -> "_Query":
+        self.op, self.payload = "upsert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def update(self, values: Dict[str, Any]) -> "_Query":
+        self.op, self.payload = "update", values
+        return self
+
+    def delete(self) -> "_Query":
+        self.op = "delete"
+        return self
+
+    def eq(self, column: str, value: Any) -> "_Query":
+        self.filters.append(("eq", column, value))
+        return self
+
+    def in_(self, column: str, values) -> "_Query":
+        self.filters.append(("in", column, list(values)))
+        return self
+
+    def is_(self, column: str, value: Any) -> "_Query":
+        self.filters.append(("is", column, None if value in (None, "null") else value))
+        return self
+
+    def contains(self, column: str, value: Any) -> "_Query":
+        self.filters.append(("contains", column, value))
+        return self
+
+    def gt(self, column: str, value: Any) -> "_Query":
+        self.filters.append(("gt", column, value))
+        return self
+
+    def lt(self, column: str, value: Any) -> "_Query":
+        self.filters.append(("lt", column, value))
+        return self
+
+    def order(self, column: str, desc: bool = False) -> "_Query":
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, n: int) -> "_Query":
+        self.limit_to = n
+        return self
+
+    def __getattr__(self, name: str):
+        raise NotImplementedError(f"SqliteSupabase does not implement .{name}()")
+
+    def _match(self, row: Dict[str, Any]) -> bool:
+        for op, column, value in self.filters:
+            v = row.get(column)
+            if op == "eq" and v != value or op == "in" and v not in value or op == "is" and v is not value \
+                    or op == "gt" and not (v is not None and v > value) or op == "lt" and not (v is not None and v < value) \
+                    or op == "contains" and not _contains(v, value):
+                return False
+        return True
+
+    def _pk(self, row: Dict[str, Any]) -> str:
+        return json.dumps([row.get(k) for k in CONFLICT_KEYS.get(self.table, ("id",))])
+
+    def execute(self) -> SimpleNamespace:
+        if self.sink.latency:
+            time.sleep(self.sink.latency)
+        with self.sink.lock:
+            self.sink.requests += 1
+            db = self.sink.db
+            if self.op == "upsert":
+                for row in self.payload:
+                    pk = self._pk(row)
+                    found = db.execute("SELECT data FROM rows WHERE tbl = ? AND pk = ?", (self.table, pk)).fetchone()
+                    merged = dict(json.loads(found[0]) if found else {}, **row)
+                    db.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?)", (self.table, pk, json.dumps(merged)))
+                db.commit()
+                return SimpleNamespace(data=self.payload)
+            rows = [json.loads(d) for (d,) in db.execute("SELECT data FROM rows WHERE tbl = ?", (self.table,))]
+            rows = [r for r in rows if self._match(r)]
+            if self.op == "update":
+                for r in rows:
+                    r.update(self.payload)
+                    db.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?)", (self.table, self._pk(r), json.dumps(r)))
+                db.commit()
+                return SimpleNamespace(data=rows)
+            if self.op == "delete":
+                for r in rows:
+                    db.execute("DELETE FROM rows WHERE tbl = ? AND pk = ?", (self.table, self._pk(r)))
+                db.commit()
+                return SimpleNamespace(data=rows)
+        if self.order_by:
+            column, desc = self.order_by
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+        if self.limit_to is not None:
+            rows = rows[:self.limit_to]
+        if self.payload and self.payload != "*":
+            columns = [c.strip() for c in self.payload.split(",")]
+            rows = [{c: r.get(c) for c in columns} for r in rows]
+        return SimpleNamespace(data=rows)
+
+# ---- Telegram ----
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+VIDEO_EXTS = (".mp4", ".mov", ".mkv", ".webm")
+AUDIO_EXTS = (".mp3", ".ogg", ".m4a")
+
+@dataclass
+class CorpusFile:
+    path: str
+    kind: str  # image / video / document / audio
+    size: int
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+def load_corpus(directory: str) -> List[CorpusFile]:
+    """Media files in `directory` with the kind _classify_message would give them."""
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        ext = os.path.splitext(name)[1].lower()
+        kind = ("image" if ext in IMAGE_EXTS else "video" if ext in VIDEO_EXTS
+                else "audio" if ext in AUDIO_EXTS else "document" if ext == ".pdf" else None)
+        if kind is None or not os.path.isfile(path):
+            continue
+        width = height = None
+        if kind == "image" and Image is not None:
+            with Image.open(path) as im:
+                width, height = im.size
+        files.append(CorpusFile(path, kind, os.path.getsize(path), width, height))
+    return files
+
+def make_corpus(directory: str) -> List[CorpusFile]:
+    """Write a small synthetic corpus: photos from phone-camera size down, a PDF, a video-sized blob."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(7)
+    try:
+        from PIL import Image, ImageDraw, ImageFilter
+        for w, h in ((640, 480), (1280, 960), (2048, 1536), (4032, 3024)):
+            # Noise plus shapes compresses roughly like a photo, unlike a flat fill
+            im = Image.effect_noise((w, h), 40).convert("RGB")
+            draw = ImageDraw.Draw(im)
+            for _ in range(30):
+                x, y = rng.randrange(w), rng.randrange(h)
+                draw.ellipse((x, y, x + rng.randrange(w // 4 + 1), y + rng.randrange(h // 4 + 1)),
+                             fill=tuple(rng.randrange(256) for _ in range(3)))
+            im.filter(ImageFilter.GaussianBlur(1)).save(os.path.join(directory, f"photo-{w}x{h}.jpg"), quality=88)
+    except ImportError:
+        pass
+    with open(os.path.join(directory, "doc.pdf"), "wb") as f:
+        f.write(b"%PDF-1.4\n" + os.urandom(300 * 1024) + b"\n%%EOF\n")
+    with open(os.path.join(directory, "clip.mp4"), "wb") as f:
+        f.write(os.urandom(12 * 1024 * 1024))
+    return load_corpus(directory)
+
+class FakeMessage:
+    """Just the Message surface the worker reads."""
+
+    def __init__(self, telegram: "FakeTelegram", chat_id: int, message_id: int, date: datetime,
+                 text: Optional[str], media: Optional[CorpusFile]) -> None:
+        self._telegram = telegram
+        self._media = media
+        self.id = message_id
+        self.chat = SimpleNamespace(id=chat_id, title="Benchmark", username="bench")
+        self.date = date
+        self.edit_date = None
+        self.empty = False
+        self.media_group_id = None
+        self.entities = self.caption_entities = None
+        self.photo = self.video = self.audio = self.document = None
+        self.text = text if media is None else None
+        self.caption = text if media is not None else None
+        if media is None:
+            return
+        file = SimpleNamespace(file_id=f"bench-{message_id}", file_unique_id=f"u{message_id}",
+                               width=media.width, height=media.height, file_size=media.size)
+        if media.kind == "image":
+            self.photo = file
+        elif media.kind == "video":
+            self.video = file
+        elif media.kind == "audio":
+            self.audio = file
+        else:
+            file.mime_type, file.file_name = "application/pdf", os.path.basename(media.path)
+            self.document = file
+
+    async def download(self) -> Optional[str]:
+        return await self._telegram.download(self)
+
+class FakeTelegram:
+    """Stands in for the pyrogram Client: history, get_messages and downloads."""
+
+    def __init__(self, chat_id: int, count: int, corpus: List[CorpusFile], mix: Dict[str, float],
+                 download_dir: str, latency_ms: float = 0, mbps: float = 0, seed: int = 1) -> None:
+        self.is_connected = True
+        self.chat_id = chat_id
+        self.download_dir = download_dir
+        self.latency = latency_ms / 1000
+        self.bytes_per_s = mbps * 125000 if mbps else 0
+        rng = random.Random(seed)
+        by_kind: Dict[str, List[CorpusFile]] = {}
+        for f in corpus:
+            by_kind.setdefault(f.kind, []).append(f)
+        kinds = [k for k in mix if k == "text" or by_kind.get(k)]
+        weights = [mix[k] for k in kinds]
+        start = datetime.now(timezone.utc) - timedelta(minutes=count)
+        self.messages: Dict[int, FakeMessage] = {}
+        for i in range(1, count + 1):
+            kind = rng.choices(kinds, weights)[0]
+            media = rng.choice(by_kind[kind]) if kind != "text" else None
+            text = f"Benchmark post {i} " + " ".join(rng.choice(("alpha", "beta", "gamma", "delta")) for _ in range(rng.randrange(5, 60)))
+            self.messages[i] = FakeMessage(self, chat_id, i, start + timedelta(minutes=i), text, media)
+
+    async def download(self, msg: FakeMessage) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.bytes_per_s:
+            await asyncio.sleep(msg._media.size / self.bytes_per_s)
+        path = os.path.join(self.download_dir, f"{msg.id}{os.path.splitext(msg._media.path)[1]}")
+        await asyncio.to_thread(shutil.copyfile, msg._media.path, path)
+        return path
+
+    async def get_chat_history_count(self, chat_id: int) -> int:
+        return len(self.messages)
+
+    async def get_chat_history(self, chat_id: int, limit: int = 0, offset_id: int = 0):
+        top = (offset_id - 1) if offset_id else max(self.messages)
+        for message_id in range(top, max(0, top - (limit or top)), -1):
+            yield self.messages[message_id]
+
+    async def get_messages(self, chat_id: int, ids):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        ids = ids if isinstance(ids, list) else [ids]
+        return [self.messages.get(i) or SimpleNamespace(id=i, empty=True) for i in ids]
+
+# ---- S3 ----
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_s3_server() -> Tuple[subprocess.Popen, str]:
+    """A moto S3 server in a subprocess; returns (process, endpoint URL)."""
+    try:
+        import moto.server  # noqa: F401
+    except ImportError:
+        raise SystemExit("The S3 stand-in needs moto: pip install -r bench/requirements.txt "
+                         "(or pass --s3-endpoint for an S3-compatible server you run yourself)")
+    port = _free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("moto S3 server did not start")
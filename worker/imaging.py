@@ -0,0 +1,174 @@
+"""
+Image derivative rendering for the ingest worker and the offline tools.
+
+Kept free of Telegram/R2/Supabase setup so it can be imported in worker
+processes.
+"""
+
+import os
+import math
+import time
+import logging
+from typing import Collection, List, Optional, Tuple
+from dotenv import load_dotenv
+from metrics import Counter, Histogram
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+load_dotenv()
+
+# Image processing toggles (optimize egress by reducing derivatives)
+ENABLE_WEBP = os.getenv("ENABLE_WEBP", "1") == "1"
+ENABLE_AVIF = os.getenv("ENABLE_AVIF", "0") == "1"
+ENABLE_RESIZED_ORIGINALS = os.getenv("ENABLE_RESIZED_ORIGINALS", "0") == "1"
+try:
+    IMAGE_SIZES = [int(s.strip()) for s in os.getenv("IMAGE_SIZES", "1024").split(",") if s.strip().isdigit()]
+except (ValueError, AttributeError) as e:
+    logging.warning(f"Failed to parse IMAGE_SIZES, using default: {e}")
+    IMAGE_SIZES = [1024]
+# Encoder quality for the WebP/AVIF variants (AVIF 0: the encoder's default)
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "75"))
+AVIF_QUALITY = int(os.getenv("AVIF_QUALITY", "0"))
+# Filter used to scale the sized variants down: nearest, box, bilinear, hamming, bicubic or lanczos
+IMAGE_RESAMPLE = os.getenv("IMAGE_RESAMPLE", "bicubic").lower()
+# Images above this many pixels (or any image while the worker is over its
+# RSS budget) take the low-memory path in render_derivatives
+LOW_MEMORY_PIXELS = int(os.getenv("LOW_MEMORY_PIXELS", str(24_000_000)))
+
+DECODE_SECONDS = Histogram("batarikh_image_decode_seconds", "Time to decode a source image")
+RESIZE_SECONDS = Histogram("batarikh_image_resize_seconds", "Time to resize an image to a variant width", ["size"])
+ENCODE_SECONDS = Histogram("batarikh_image_encode_seconds", "Time to encode one image variant", ["format", "size"])
+ENCODE_BYTES = Counter("batarikh_image_encode_bytes_total", "Bytes of image variants written", ["format", "size"])
+
+def _save(im, path: str, fmt: str, size: str, **params) -> None:
+    """Save one variant, timing the encode and counting its bytes."""
+    started = time.perf_counter()
+    im.save(path, **params)
+    ENCODE_SECONDS.observe(time.perf_counter() - started, fmt, size)
+    ENCODE_BYTES.inc(os.path.getsize(path), fmt, size)
+
+def _avif_params() -> dict:
+    return {"quality": AVIF_QUALITY} if AVIF_QUALITY else {}
+
+def _fit(im, s: int):
+    """im.copy().thumbnail((s, s), IMAGE_RESAMPLE) without copying the full-size bitmap first."""
+    if im.width <= s and im.height <= s:
+        return im
+    # Same size arithmetic as Image.thumbnail
+    aspect = im.width / im.height
+    x = y = s
+    if x / y >= aspect:
+        x = max(min(math.floor(y * aspect), math.ceil(y * aspect), key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        y = max(min(math.floor(x / aspect), math.ceil(x / aspect), key=lambda n: 0 if n == 0 else abs(aspect - x / n)), 1)
+    return im.resize((x, y), getattr(Image.Resampling, IMAGE_RESAMPLE.upper(), Image.Resampling.BICUBIC), reducing_gap=2.0)
+
+def derivative_keys(chat_id: int, message_id: int, ext: str) -> List[str]:
+    """Object keys render_derivatives produces for an image under the current settings."""
+    keys = []
+    for s in IMAGE_SIZES:
+        if ENABLE_RESIZED_ORIGINALS:
+            keys.append(f"{chat_id}/{message_id}-w{s}{ext}")
+        if ENABLE_WEBP:
+            keys.append(f"{chat_id}/{message_id}-w{s}.webp")
+        if ENABLE_AVIF:
+            keys.append(f"{chat_id}/{message_id}-w{s}.avif")
+    if ENABLE_WEBP:
+        keys.append(f"{chat_id}/{message_id}.webp")
+    if ENABLE_AVIF:
+        keys.append(f"{chat_id}/{message_id}.avif")
+    return keys
+
+def render_derivatives(fp: str, chat_id: int, message_id: int, ext: str,
+                       out_dir: Optional[str] = None, only: Optional[Collection[str]] = None,
+                       low_memory: bool = False) -> List[Tuple[str, str]]:
+    """Write resized/WebP/AVIF variants of an image next to it (or into `out_dir`).
+
+    Returns (local path, object key) pairs for the upload stage. Failures of
+    individual variants are skipped so the original still gets published.
+    With `only`, variants whose object key is not listed are not encoded.
+
+    Images over LOW_MEMORY_PIXELS, or any image with `low_memory`, are
+    decoded at reduced scale where the format allows it (JPEG DCT scaling
+    via draft()): only as large as the biggest variant still to render.
+    """
+    def wanted(key: str) -> bool:
+        return only is None or key in only
+
+    out: List[Tuple[str, str]] = []
+    base = os.path.join(out_dir, os.path.basename(fp)) if out_dir else fp
+    try:
+        # Check file size before processing (limit to 50MB)
+        file_size = os.path.getsize(fp) if os.path.exists(fp) else 0
+        max_image_size = int(os.getenv("MAX_IMAGE_SIZE_BYTES", "52428800"))  # 50MB default
+        if file_size > max_image_size:
+            logging.warning(f"Image too large ({file_size} bytes), skipping processing")
+            return out
+        with Image.open(fp) as im:
+            # Limit image dimensions to prevent memory issues
+            max_dimension = int(os.getenv("MAX_IMAGE_DIMENSION", "8192"))  # 8K default
+            if low_memory or im.width * im.height > LOW_MEMORY_PIXELS:
+                full_size = any(wanted(f"{chat_id}/{message_id}.{f}") for f, on in (("webp", ENABLE_WEBP), ("avif", ENABLE_AVIF)) if on)
+                target = max_dimension if full_size else max(IMAGE_SIZES, default=max_dimension)
+                if im.width > target or im.height > target:
+                    im.draft(im.mode, (target, target))
+            with DECODE_SECONDS.time():
+                im.load()
+            if im.width > max_dimension or im.height > max_dimension:
+                logging.warning(f"Image dimensions too large ({im.width}x{im.height}), resizing...")
+                ratio = min(max_dimension / im.width, max_dimension / im.height)
+                new_size = (int(im.width * ratio), int(im.height * ratio))
+                im = im.resize(new_size, Image.Resampling.LANCZOS)
+            
+            for s in IMAGE_SIZES:
+                if not any(wanted(k) for k in (f"{chat_id}/{message_id}-w{s}{ext}", f"{chat_id}/{message_id}-w{s}.webp",
+                                                f"{chat_id}/{message_id}-w{s}.avif")):
+                    continue
+                try:
+                    with RESIZE_SECONDS.time(str(s)):
+                        im_copy = _fit(im, s)
+                    if ENABLE_RESIZED_ORIGINALS and wanted(f"{chat_id}/{message_id}-w{s}{ext}"):
+                        try:
+                            out_path = f"{base}.resized-{s}"
+                            # No usable extension on the path, so name the format
+                            _save(im_copy, out_path, ext.lstrip(".").lower() or "original", str(s),
+                                  format=Image.registered_extensions().get(ext.lower()))
+                            out.append((out_path, f"{chat_id}/{message_id}-w{s}{ext}"))
+                        except Exception:
+                            pass
+                    if ENABLE_WEBP and wanted(f"{chat_id}/{message_id}-w{s}.webp"):
+                        try:
+                            webp_path = f"{base}.resized-{s}.webp"
+                            _save(im_copy, webp_path, "webp", str(s), format="WEBP", quality=WEBP_QUALITY)
+                            out.append((webp_path, f"{chat_id}/{message_id}-w{s}.webp"))
+                        except Exception:
+                            pass
+                    if ENABLE_AVIF and wanted(f"{chat_id}/{message_id}-w{s}.avif"):
+                        try:
+                            avif_path = f"{base}.resized-{s}.avif"
+                            _save(im_copy, avif_path, "avif", str(s), format="AVIF", **_avif_params())
+                            out.append((avif_path, f"{chat_id}/{message_id}-w{s}.avif"))
+                        except Exception:
+                            pass
+                except Exception:
+                    pass
+            if ENABLE_WEBP and wanted(f"{chat_id}/{message_id}.webp"):
+                try:
+                    webp_path = f"{base}.webp"
+                    _save(im, webp_path, "webp", "full", format="WEBP", quality=WEBP_QUALITY)
+                    out.append((webp_path, f"{chat_id}/{message_id}.webp"))
+                except Exception:
+                    pass
+            if ENABLE_AVIF and wanted(f"{chat_id}/{message_id}.avif"):
+                try:
+                    avif_path = f"{base}.avif"
+                    _save(im, avif_path, "avif", "full", format="AVIF", **_avif_params())
+                    out.append((avif_path, f"{chat_id}/{message_id}.avif"))
+                except Exception:
+                    pass
+    except Exception:
+        pass
+    return out
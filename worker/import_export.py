@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Offline importer for Telegram Desktop channel exports.
+
+Rebuilds posts from an export directory instead of pulling media through
+MTProto: no Telegram session or rate limits, just disk, R2 and Supabase.
+Messages are mapped to the same post rows and image derivatives the live
+worker produces, with image encoding spread over a process pool.
+
+Usage:
+    python3 import_export.py EXPORT_DIR [--chat-id ID] [--processes N] [--dry-run]
+
+EXPORT_DIR is a "Export chat history" directory in JSON format
+(result.json plus photos/, files/, video_files/ ...) or HTML format
+(messages.html, messages2.html, ...). result.json is read as a stream, so
+exports larger than memory are fine. With --dry-run nothing is uploaded or
+written; rows are only mapped and counted, which needs no credentials.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from html.parser import HTMLParser
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import ingest
+from imaging import HAS_PIL, render_derivatives
+from logconfig import setup_process_logging
+
+if HAS_PIL:
+    from PIL import Image
+
+_MESSAGES_START = re.compile(r'"messages"\s*:\s*\[')
+_WHITESPACE = re.compile(r'[\s,]*')
+
+def iter_json_export(path: str, chunk_size: int = 1 << 20) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    """Stream a result.json: returns the chat header and an iterator over messages.
+
+    Only the current chunk and one message are held in memory at a time.
+    """
+    f = open(path, encoding="utf-8")
+    buf = ""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            f.close()
+            raise ValueError(f"No messages array found in {path}")
+        buf += chunk
+        m = _MESSAGES_START.search(buf)
+        if m:
+            break
+    head = buf[:m.start()]
+    header = {}
+    for field in ("name", "type"):
+        fm = re.search(rf'"{field}"\s*:\s*"([^"]*)"', head)
+        if fm:
+            header[field] = fm.group(1)
+    im = re.search(r'"id"\s*:\s*(-?\d+)', head)
+    if im:
+        header["id"] = int(im.group(1))
+
+    def messages() -> Iterator[Dict[str, Any]]:
+        decoder = json.JSONDecoder()
+        data, pos = buf[m.end():], 0
+        with f:
+            while True:
+                pos = _WHITESPACE.match(data, pos).end()
+                if data.startswith("]", pos):
+                    return
+                try:
+                    obj, pos = decoder.raw_decode(data, pos)
+                except json.JSONDecodeError:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        raise
+                    data, pos = data[pos:] + chunk, 0
+                    continue
+                yield obj
+
+    return header, messages()
+
+class _HtmlExportParser(HTMLParser):
+    """Turns the messages*.html pages of an export into result.json-shaped dicts."""
+
+    VOID = {"br", "img", "hr", "meta", "link", "input"}
+    MEDIA_LINKS = {
+        "photo_wrap": ("photo", None),
+        "video_file_wrap": ("file", "video_file"),
+        "media_video": ("file", "video_file"),
+        "media_audio_file": ("file", "audio_file"),
+        "media_file": ("file", None),
+    }
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.messages: List[Dict[str, Any]] = []
+        self._message: Optional[Dict[str, Any]] = None
+        self._depth = 0
+        self._text_depth = 0
+        self._text: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        if self._message is None:
+            if tag == "div" and "message" in classes and (attrs.get("id") or "").startswith("message"):
+                msg_id = attrs["id"][len("message"):]
+                if msg_id.lstrip("-").isdigit():
+                    self._message = {"id": int(msg_id), "type": "service" if "service" in classes else "message"}
+                    self._depth = 1
+            return
+        if tag not in self.VOID:
+            self._depth += 1
+            if self._text_depth:
+                self._text_depth += 1
+        if self._text_depth and tag == "br":
+            self._text.append("\n")
+        if tag == "div" and "date" in classes and attrs.get("title"):
+            self._message["date_title"] = attrs["title"]
+        elif tag == "div" and "text" in classes and not self._text_depth:
+            self._text_depth = 1
+        elif tag == "a" and attrs.get("href"):
+            for cls, (field, media_type) in self.MEDIA_LINKS.items():
+                if cls in classes:
+                    self._message[field] = attrs["href"]
+                    if media_type:
+                        self._message["media_type"] = media_type
+                    break
+
+    def handle_endtag(self, tag):
+        if self._message is None or tag in self.VOID:
+            return
+        if self._text_depth:
+            self._text_depth -= 1
+        self._depth -= 1
+        if self._depth == 0:
+            self._message["text"] = "".join(self._text).strip()
+            self.messages.append(self._message)
+            self._message, self._text = None, []
+
+    def handle_data(self, data):
+        if self._text_depth:
+            self._text.append(data)
+
+def iter_html_export(export_dir: str, chunk_size: int = 1 << 16) -> Iterator[Dict[str, Any]]:
+    """Stream messages from messages.html, messages2.html, ... one page at a time."""
+    def page_number(name: str) -> int:
+        m = re.match(r"messages(\d*)\.html$", name)
+        return int(m.group(1) or 1) if m else 0
+    pages = sorted((n for n in os.listdir(export_dir) if page_number(n)), key=page_number)
+    for name in pages:
+        parser = _HtmlExportParser()
+        with open(os.path.join(export_dir, name), encoding="utf-8") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                yield from parser.messages
+                parser.messages.clear()
+        parser.close()
+        yield from parser.messages
+
+def _message_date(em: Dict[str, Any]) -> Optional[datetime]:
+    if em.get("date_unixtime"):
+        return datetime.fromtimestamp(int(em["date_unixtime"]), tz=timezone.utc)
+    if em.get("date_title"):
+        # e.g. "01.01.2021 12:00:00 UTC+03:00"
+        m = re.match(r"(\d{2})\.(\d{2})\.(\d{4}) (\d{2}):(\d{2}):(\d{2})(?: UTC([+-]\d{2}):(\d{2}))?", em["date_title"])
+        if m:
+            d, mo, y, h, mi, sec, oh, om = m.groups()
+            dt = datetime(int(y), int(mo), int(d), int(h), int(mi), int(sec))
+            if oh:
+                sign = -1 if oh.startswith("-") else 1
+                offset = sign * (abs(int(oh)) * 60 + int(om))
+                return dt.replace(tzinfo=timezone.utc) - timedelta(minutes=offset)
+            return dt.replace(tzinfo=timezone.utc)
+    if em.get("date"):
+        return datetime.fromisoformat(em["date"]).replace(tzinfo=timezone.utc)
+    return None
+
+def _message_text(em: Dict[str, Any]) -> str:
+    text = em.get("text") or ""
+    if isinstance(text, list):
+        text = "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return text
+
+def _media_path(export_dir: str, rel: Optional[str]) -> Optional[str]:
+    # Exports without media keep a placeholder like "(File not included. ...)"
+    if not rel or rel.startswith("("):
+        return None
+    path = os.path.join(export_dir, rel)
+    return path if os.path.isfile(path) else None
+
+def map_message(em: Dict[str, Any], chat_id: int, export_dir: str) -> Optional[Tuple[ingest.IngestJob, Optional[str]]]:
+    """Map an export message to an IngestJob (as the live worker builds it) and
+    its media file path, classified the way _classify_message does."""
+    if em.get("type") != "message":
+        return None
+    date = _message_date(em)
+    if date is None:
+        return None
+    media_type, width, height, path = "none", None, None, None
+    if em.get("photo"):
+        media_type, width, height = "image", em.get("width"), em.get("height")
+        path = _media_path(export_dir, em["photo"])
+    elif em.get("file"):
+        mime = (em.get("mime_type") or "").lower()
+        rel = em["file"]
+        if em.get("media_type") == "video_file" or mime.startswith("video/"):
+            media_type, width, height = "video", em.get("width"), em.get("height")
+        elif em.get("media_type") == "audio_file" or mime.startswith("audio/"):
+            media_type = "audio"
+        elif mime == "application/pdf" or rel.lower().endswith(".pdf"):
+            media_type = "document"
+        if media_type != "none":
+            path = _media_path(export_dir, rel)
+    if media_type == "image" and path and (width is None or height is None) and HAS_PIL:
+        try:
+            with Image.open(path) as im:
+                width, height = im.size
+        except Exception:
+            pass
+    msg = SimpleNamespace(
+        id=em["id"], date=date, text=_message_text(em), caption=None,
+        photo=None, video=None, audio=None, document=None,
+        chat=SimpleNamespace(id=chat_id),
+    )
+    job = ingest.IngestJob(msg=msg, chat_id=chat_id, message_id=em["id"],
+                           media_type=media_type, width=width, height=height)
+    job.ext = os.path.splitext(path)[1] if path else ""
+    return job, path
+
+def _import_media(job: ingest.IngestJob, path: str, encoders: ProcessPoolExecutor, tmp_dir: str) -> None:
+    """Upload one message's media and derivatives (runs in an upload thread)."""
+    render = None
+    if job.media_type == "image" and HAS_PIL:
+        render = encoders.submit(render_derivatives, path, job.chat_id, job.message_id, job.ext, tmp_dir)
+    job.media_url = ingest._upload_object(job, path, f"{job.chat_id}/{job.message_id}{job.ext}")
+    if render is not None:
+        for vpath, vkey in render.result():
+            try:
+                ingest._upload_object(job, vpath, vkey)
+            except Exception:
+                pass
+            finally:
+                ingest._remove_file(vpath)
+
+def _process(item, encoders, tmp_dir: str, dry_run: bool) -> Dict[str, Any]:
+    job, path = item
+    if path and not dry_run:
+        try:
+            _import_media(job, path, encoders, tmp_dir)
+        except Exception as e:
+            logging.error(f"Media upload failed for message id={job.message_id}: {e}")
+    elif job.media_type != "none" and not path:
+        logging.warning(f"Media file for message id={job.message_id} is not in the export")
+    return ingest._build_post_row(job)
+
+def run_import(export_dir: str, chat_id: Optional[int], processes: int, upload_workers: int,
+               batch_size: int, dry_run: bool) -> Dict[str, int]:
+    result_json = os.path.join(export_dir, "result.json")
+    if os.path.exists(result_json):
+        header, messages = iter_json_export(result_json)
+        if chat_id is None and "id" in header:
+            # Exports store the bare channel id; Pyrogram (and our R2 keys) use -100<id>
+            is_channel = header.get("type", "").endswith("channel")
+            chat_id = int(f"-100{header['id']}") if is_channel else header["id"]
+    else:
+        messages = iter_html_export(export_dir)
+    if chat_id is None:
+        raise SystemExit("Could not determine the chat id from the export; pass --chat-id")
+
+    counts = {"messages": 0, "skipped": 0, "written": 0, "failed": 0}
+    started = time.monotonic()
+    tmp_dir = tempfile.mkdtemp(prefix="batarikh-import-")
+    rows: List[Dict[str, Any]] = []
+
+    def flush() -> None:
+        if not rows:
+            return
+        if not dry_run and ingest.supabase:
+            errors = ingest._write_rows(rows)
+            counts["failed"] += len(errors)
+            counts["written"] += len(rows) - len(errors)
+        else:
+            counts["written"] += len(rows)
+        rows.clear()
+        rate = counts["messages"] / max(time.monotonic() - started, 1e-6)
+        logging.info(f"Imported {counts['messages']} messages ({rate:.1f}/s), {counts['written']} rows written")
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=setup_process_logging) as encoders, ThreadPoolExecutor(max_workers=upload_workers) as uploaders:
+            # Bounded window of in-flight messages; drained oldest first to keep order
+            window = deque()
+            for em in messages:
+                item = map_message(em, chat_id, export_dir)
+                if item is None:
+                    counts["skipped"] += 1
+                    continue
+                counts["messages"] += 1
+                window.append(uploaders.submit(_process, item, encoders, tmp_dir, dry_run))
+                while len(window) > upload_workers * 4 or (window and window[0].done()):
+                    rows.append(window.popleft().result())
+                    if len(rows) >= batch_size:
+                        flush()
+            while window:
+                rows.append(window.popleft().result())
+                if len(rows) >= batch_size:
+                    flush()
+            flush()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return counts
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import a Telegram Desktop channel export into posts/R2.")
+    parser.add_argument("export_dir", help="Export directory (result.json or messages*.html)")
+    parser.add_argument("--chat-id", type=int, help="Chat id used for R2 keys (default: from result.json)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Image encoding processes")
+    parser.add_argument("--upload-workers", type=int, default=8, help="Concurrent R2 uploads")
+    parser.add_argument("--batch-size", type=int, default=200, help="Rows per Supabase upsert")
+    parser.add_argument("--dry-run", action="store_true", help="Map and count only; no uploads or DB writes")
+    args = parser.parse_args()
+
+    if not args.dry_run:
+        ingest.require_env(ingest.R2_ENV)
+        if not ingest.supabase:
+            logging.warning("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not set; rows will not be written")
+    counts = run_import(args.export_dir, args.chat_id, max(1, args.processes), max(1, args.upload_workers),
+                        max(1, args.batch_size), args.dry_run)
+    logging.info(f"Import finished: {counts}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.info("Import interrupted")
+        sys.exit(1)
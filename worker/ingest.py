@@ -58,20 +58,18 @@ import asyncio
 import json
 import signal
 import sys
-import gc
+import hashlib
+import hmac
+import cProfile
 from datetime import datetime, timezone
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
 import threading
-from typing import Optional, Tuple, Dict, Any, Deque
-from collections import deque
-from dataclasses import dataclass, asdict
+from typing import Optional, Tuple, Dict, Any, Deque, List
+from collections import deque, OrderedDict
+from dataclasses import dataclass, asdict, field
 from dotenv import load_dotenv
 import re
-try:
-    from PIL import Image
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
 from pyrogram import Client, filters, idle
 from pyrogram.errors import FloodWait, AuthKeyDuplicated
 from pyrogram.types import Message
@@ -81,12 +79,26 @@ from botocore.exceptions import ClientError
 from boto3.s3.transfer import S3Transfer, TransferConfig
 import mimetypes
 from supabase import create_client, Client as SupabaseClient
+from imaging import HAS_PIL, render_derivatives
+from metrics import Counter, Gauge, Histogram, render as render_metrics
+from tracing import TraceBuffer, chrome_trace
+from loopmon import LoopMonitor
+from logconfig import setup_logging
+from memwatch import MemoryWatch, rss_bytes, start_from_env as start_tracemalloc, trim as trim_heap
+from profiler import SORT_KEYS, collapse, profiled, pstats_text, sample as sample_stacks
 
 mimetypes.add_type('image/avif', '.avif')
 mimetypes.add_type('image/webp', '.webp')
 
 load_dotenv()
-logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s')
+setup_logging()
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except (ValueError, TypeError):
+        logging.warning(f"Invalid {name}, using default {default}")
+        return default
 
 API_ID = int(os.getenv("API_ID", "0"))
 API_HASH = os.getenv("API_HASH", "")
@@ -99,23 +111,18 @@ R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
 R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_PUBLIC_BASE_URL = os.getenv("R2_PUBLIC_BASE_URL")
 TARGET_CHANNEL = os.getenv("TARGET_CHANNEL", "batarikh")
+# Comma-separated list of channels to ingest from one process; falls back to TARGET_CHANNEL
+TARGET_CHANNELS = [c.strip() for c in os.getenv("TARGET_CHANNELS", TARGET_CHANNEL or "").split(",") if c.strip()]
 
-# Image processing toggles (optimize egress by reducing derivatives)
-ENABLE_WEBP = os.getenv("ENABLE_WEBP", "1") == "1"
-ENABLE_AVIF = os.getenv("ENABLE_AVIF", "0") == "1"
-ENABLE_RESIZED_ORIGINALS = os.getenv("ENABLE_RESIZED_ORIGINALS", "0") == "1"
-try:
-    IMAGE_SIZES = [int(s.strip()) for s in os.getenv("IMAGE_SIZES", "1024").split(",") if s.strip().isdigit()]
-except (ValueError, AttributeError) as e:
-    logging.warning(f"Failed to parse IMAGE_SIZES, using default: {e}")
-    IMAGE_SIZES = [1024]
-
-missing = []
-for k in ["API_ID", "API_HASH", "SESSION_STRING", "R2_ENDPOINT", "R2_BUCKET", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_PUBLIC_BASE_URL"]:
-    if not os.getenv(k):
-        missing.append(k)
-if missing:
-    raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+TELEGRAM_ENV = ["API_ID", "API_HASH", "SESSION_STRING"]
+R2_ENV = ["R2_ENDPOINT", "R2_BUCKET", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_PUBLIC_BASE_URL"]
+
+def require_env(keys: List[str]) -> None:
+    """Fail fast when required settings are missing (the worker needs all of them,
+    offline tools only the ones they use)."""
+    missing = [k for k in keys if not os.getenv(k)]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
 
 # Configure client with explicit update settings
 app = Client(
@@ -124,7 +131,8 @@ app = Client(
     api_hash=API_HASH,
     session_string=SESSION_STRING,
     no_updates=False,  # Explicitly enable updates
-    workers=1,  # Use single worker for Railway deployment
+    # Handlers only enqueue into IngestPipeline, so one update worker keeps arrival order
+    workers=_env_int("PYROGRAM_WORKERS", 1),
 )
 
 r2 = boto3.client(
@@ -160,8 +168,53 @@ STATS = {
     "connected": False,
     "reconnect_count": 0,
     "queue_size": 0,
+    "hydrated": 0,
+    "memory_paused": False,  # media admission held while RSS is over RSS_BUDGET_MB
+    "edits": {"seen": 0, "updated": 0, "reprocessed": 0, "unchanged": 0},
+    "deleted": {"posts": 0, "objects": 0},
+    "channels": {},  # per chat id: processed/failed/last_id, backfill and reconcile progress
 }
 
+# Prometheus metrics (served on /metrics)
+DOWNLOAD_SECONDS = Histogram("batarikh_download_seconds", "Time to download media from Telegram", ["media_type"])
+R2_UPLOAD_SECONDS = Histogram("batarikh_r2_upload_seconds", "Time to upload one object to R2")
+R2_HEAD_SECONDS = Histogram("batarikh_r2_head_seconds", "Time of the existence check before an R2 upload")
+SUPABASE_UPSERT_SECONDS = Histogram("batarikh_supabase_upsert_seconds", "Time of one posts upsert request")
+END_TO_END_SECONDS = Histogram(
+    "batarikh_end_to_end_seconds", "From the message date to its row being persisted", ["lane", "source"],
+    buckets=(1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400),
+)
+STAGE_BYTES = Counter("batarikh_stage_bytes_total", "Bytes moved by a pipeline stage", ["stage"])
+UPSERTED_ROWS = Counter("batarikh_supabase_rows_total", "Post rows sent in upserts")
+FLOODWAIT_SECONDS = Counter("batarikh_floodwait_seconds_total", "Seconds Telegram calls were paused for FloodWait")
+BREAKER_TRANSITIONS = Counter("batarikh_circuit_breaker_transitions_total", "Circuit breaker state changes", ["breaker", "state"])
+Gauge("batarikh_messages", "Worker message counters", ["result"],
+      callback=lambda: {(k,): STATS[k] for k in ("processed", "failed", "retried", "hydrated")})
+Gauge("batarikh_retry_queue_size", "Messages waiting in the retry queue", callback=lambda: {(): len(_message_queue)})
+Gauge("batarikh_queue_depth", "Jobs waiting per pipeline stage", ["stage"],
+      callback=lambda: {(k,): v for k, v in _pipeline.depths().items() if isinstance(v, int)} if _pipeline else {})
+Gauge("batarikh_lane_backlog", "Admitted jobs not yet handed to persist, per lane", ["lane"],
+      callback=lambda: {(k,): v for k, v in _pipeline.lane_backlog().items()} if _pipeline else {})
+Gauge("batarikh_circuit_breaker_open", "1 while a circuit breaker is open", ["breaker"],
+      callback=lambda: {(b.name,): int(b.state == "open") for b in (_r2_circuit_breaker, _supabase_circuit_breaker)})
+
+# Per-message stage timelines (served on /trace)
+TRACES = TraceBuffer(_env_int("TRACE_BUFFER_SIZE", 2000))
+
+# Event loop lag and blocking-call detection (reported on /status)
+_loop_monitor = LoopMonitor(
+    interval=_env_int("LOOP_LAG_INTERVAL_MS", 250) / 1000,
+    block_threshold=_env_int("LOOP_BLOCK_THRESHOLD_MS", 500) / 1000,
+)
+
+# RSS tracking and budget (reported on /status and /debug/memory)
+_memory = MemoryWatch(_env_int("RSS_BUDGET_MB", 0))
+Gauge("batarikh_rss_bytes", "Resident set size of the worker", callback=lambda: {(): rss_bytes()})
+Gauge("batarikh_stage_peak_rss_bytes", "Highest RSS seen at the end of a stage step", ["stage"],
+      callback=lambda: {(k,): v for k, v in _memory.stage_peaks.items()})
+Gauge("batarikh_memory_paused", "1 while media admission is held by the RSS budget",
+      callback=lambda: {(): int(STATS["memory_paused"])})
+
 # Message queue for retry mechanism
 @dataclass
 class QueuedMessage:
@@ -178,24 +231,107 @@ _shutdown_event = threading.Event()
 _max_retries = int(os.getenv("MAX_MESSAGE_RETRIES", "5"))
 _retry_delay_base = int(os.getenv("RETRY_DELAY_BASE_SECS", "60"))
 
+# Telegram's messages.getMessages accepts at most 200 ids per request
+TELEGRAM_BATCH_SIZE = 200
+
+class WorkerState:
+    """Checkpoint store: a local JSON file plus the `worker_state` table.
+
+    The local file survives process restarts, the table survives redeploys.
+    On load, whichever copy of a key was written last wins.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty: set = set()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+        except Exception as e:
+            logging.warning(f"Could not read worker state from {self.path}: {e}")
+            self._entries = {}
+        if not supabase:
+            return
+        try:
+            rows = supabase.table("worker_state").select("key,value,updated_at").execute().data or []
+        except Exception as e:
+            logging.warning(f"Could not read worker_state table: {e}")
+            return
+        for row in rows:
+            local = self._entries.get(row["key"])
+            if local is None or (row.get("updated_at") or "") > local.get("updated_at", ""):
+                self._entries[row["key"]] = {"value": row["value"], "updated_at": row.get("updated_at") or ""}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        return entry["value"] if entry else default
+
+    def set(self, key: str, value: Any) -> None:
+        self._entries[key] = {"value": value, "updated_at": datetime.now(timezone.utc).isoformat()}
+        self._dirty.add(key)
+
+    def _write(self, keys) -> None:
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.path)
+        if supabase and keys:
+            rows = [{"key": k, "value": self._entries[k]["value"], "updated_at": self._entries[k]["updated_at"]} for k in keys]
+            supabase.table("worker_state").upsert(rows).execute()
+
+    def save(self) -> None:
+        """Write dirty keys to disk and the database, for the command-line tools."""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        try:
+            self._write(keys)
+        except Exception as e:
+            self._dirty |= keys
+            logging.warning(f"Failed to save worker state: {e}")
+
+    async def flush(self) -> None:
+        """Write dirty keys to disk and the database (in a thread)."""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        try:
+            await asyncio.to_thread(self._write, keys)
+        except Exception as e:
+            self._dirty |= keys
+            logging.warning(f"Failed to save worker state: {e}")
+
+_state = WorkerState(os.getenv("WORKER_STATE_PATH", "worker_state.json"))
+
 # Circuit breaker state
 class CircuitBreaker:
-    def __init__(self, failure_threshold=5, timeout=60):
+    def __init__(self, failure_threshold=5, timeout=60, name="breaker"):
         self.failure_threshold = failure_threshold
         self.timeout = timeout
+        self.name = name
         self.failure_count = 0
         self.last_failure_time = None
         self.state = "closed"  # closed, open, half_open
     
+    def _set_state(self, state):
+        if state != self.state:
+            BREAKER_TRANSITIONS.inc(1, self.name, state)
+            self.state = state
+    
     def record_success(self):
         self.failure_count = 0
-        self.state = "closed"
+        self._set_state("closed")
     
     def record_failure(self):
         self.failure_count += 1
         self.last_failure_time = time.time()
         if self.failure_count >= self.failure_threshold:
-            self.state = "open"
+            self._set_state("open")
             logging.warning(f"Circuit breaker opened after {self.failure_count} failures")
     
     def can_proceed(self):
@@ -203,56 +339,258 @@ class CircuitBreaker:
             return True
         if self.state == "open":
             if time.time() - self.last_failure_time > self.timeout:
-                self.state = "half_open"
+                self._set_state("half_open")
                 logging.info("Circuit breaker entering half-open state")
                 return True
             return False
         return True  # half_open
 
-_r2_circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=60)
-_supabase_circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=60)
-
-class StatusHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path in ("/", "/health", "/status"):
-            stats_copy = STATS.copy()
-            stats_copy["queue_size"] = len(_message_queue)
-            stats_copy["r2_circuit_breaker"] = _r2_circuit_breaker.state
-            stats_copy["supabase_circuit_breaker"] = _supabase_circuit_breaker.state
-            body = json.dumps({
-                "ok": True,
-                "stats": stats_copy,
-                "channel": TARGET_CHANNEL,
-            }).encode()
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Content-Length", str(len(body)))
-            self.end_headers()
-            self.wfile.write(body)
-        elif self.path == "/favicon.ico":
-            self.send_response(204)
-            self.end_headers()
-        else:
-            self.send_response(404)
-            self.end_headers()
-    
-    def log_message(self, format, *args):
-        # Suppress default HTTP server logging
-        pass
+_r2_circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=60, name="r2")
+_supabase_circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=60, name="supabase")
 
-def start_status_server() -> None:
-    try:
-        port = int(os.getenv("PORT", "8000"))
-    except (ValueError, TypeError) as e:
-        logging.warning(f"Invalid PORT value, using default 8000: {e}")
-        port = 8000
-    try:
-        server = HTTPServer(("0.0.0.0", port), StatusHandler)
-        t = threading.Thread(target=server.serve_forever, daemon=True)
-        t.start()
+class StatusServer:
+    """The worker's HTTP endpoints, served on its own event loop.
+
+    /livez              the process and its event loop are responding
+    /readyz             200 only while the worker can ingest: Telegram connected,
+                        pipeline stages running, no circuit breaker open (503 with reasons)
+    /status             stats, pipeline and lane depths, throughput, event loop health
+    /metrics            Prometheus text format
+    /trace/<message_id> and /trace/slowest?n=20 (add format=chrome for trace-event JSON)
+    /debug/memory       RSS, peaks per stage and the RSS budget; /snapshot, /diff
+                        and /stop below it drive tracemalloc (?top=25&frames=1, diff ?rebase=1)
+    /debug/profile      ?seconds=30[&hz=100][&thread=loop]: sampled collapsed stacks for flame graphs;
+                        ?mode=cprofile&chat_id=..&message_id=..: cProfile of one process_message run
+
+    /debug/* is off unless DEBUG_TOKEN is set, and then needs an
+    "Authorization: Bearer <DEBUG_TOKEN>" header: profiling rewrites posts and
+    tracemalloc snapshots are expensive.
+
+    Responses are built in one synchronous step on the loop, so they see a
+    consistent STATS without any locking in the code that updates it. Each
+    connection is its own task with a read deadline: a slow client can't
+    hold up a health check.
+    """
+    READ_TIMEOUT = 10
+    RATE_SAMPLE_SECS = 5
+
+    def __init__(self) -> None:
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._sampler: Optional[asyncio.Task] = None
+        self._connections: set = set()
+        self._profiling = asyncio.Lock()
+        # (monotonic time, processed, failed) every RATE_SAMPLE_SECS over the last 5 minutes
+        self._rates: Deque[Tuple[float, int, int]] = deque(maxlen=300 // self.RATE_SAMPLE_SECS + 1)
+        self._started = time.monotonic()
+        self._debug_token = os.getenv("DEBUG_TOKEN", "")
+
+    def _debug_denied(self, head: bytes) -> Optional[Tuple[int, Any]]:
+        """(status, payload) refusing a /debug request, or None to serve it."""
+        if not self._debug_token:
+            return 404, {"error": "debug endpoints are disabled (set DEBUG_TOKEN)"}
+        for line in head.decode("latin-1").split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "authorization":
+                scheme, _, token = value.strip().partition(" ")
+                if scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self._debug_token.encode()):
+                    return None
+        return 401, {"error": "missing or wrong debug token"}
+
+    async def start(self) -> None:
+        try:
+            port = int(os.getenv("PORT", "8000"))
+        except (ValueError, TypeError) as e:
+            logging.warning(f"Invalid PORT value, using default 8000: {e}")
+            port = 8000
+        try:
+            self._server = await asyncio.start_server(self._handle, "0.0.0.0", port)
+        except OSError as e:
+            logging.error(f"Failed to start status server: {e}")
+            return
+        self._sampler = asyncio.create_task(self._sample_rates())
         logging.info(f"Status server listening on :{port}")
-    except OSError as e:
-        logging.error(f"Failed to start status server: {e}")
+
+    async def stop(self) -> None:
+        if self._sampler:
+            self._sampler.cancel()
+        if self._server:
+            self._server.close()
+            # Drop idle clients so their handlers end now instead of being cancelled with the loop
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.sleep(0)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _sample_rates(self) -> None:
+        while True:
+            self._rates.append((time.monotonic(), STATS["processed"], STATS["failed"]))
+            await asyncio.sleep(self.RATE_SAMPLE_SECS)
+
+    def _throughput(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        out = {}
+        for label, window in (("1m", 60), ("5m", 300)):
+            then = next((s for s in self._rates if s[0] >= now - window - self.RATE_SAMPLE_SECS), None)
+            if then is None or now - then[0] < 1:
+                out[label] = None
+                continue
+            elapsed = now - then[0]
+            out[label] = {
+                "processed_per_s": round((STATS["processed"] - then[1]) / elapsed, 2),
+                "failed_per_s": round((STATS["failed"] - then[2]) / elapsed, 2),
+            }
+        return out
+
+    def readiness(self) -> Tuple[bool, List[str]]:
+        problems = []
+        if _shutdown_event.is_set():
+            problems.append("shutting down")
+        if not (STATS["connected"] and app.is_connected):
+            problems.append("telegram disconnected")
+        if _pipeline is None or not _pipeline._tasks:
+            problems.append("pipeline not started")
+        elif any(task.done() for task in _pipeline._tasks):
+            problems.append("a pipeline stage worker exited")
+        for breaker in (_r2_circuit_breaker, _supabase_circuit_breaker):
+            if breaker.state == "open":
+                problems.append(f"{breaker.name} circuit breaker open")
+        return not problems, problems
+
+    def _status(self) -> Dict[str, Any]:
+        ready, problems = self.readiness()
+        stats = dict(STATS)
+        stats["queue_size"] = len(_message_queue)
+        stats["r2_circuit_breaker"] = _r2_circuit_breaker.state
+        stats["supabase_circuit_breaker"] = _supabase_circuit_breaker.state
+        if _pipeline is not None:
+            stats["pipeline"] = _pipeline.depths()
+            stats["lanes"] = _pipeline.lane_backlog()
+        stats["throughput"] = self._throughput()
+        stats["event_loop"] = _loop_monitor.snapshot()
+        stats["memory"] = _memory.summary()
+        return {"ok": ready, "problems": problems, "stats": stats, "channels": CHANNELS}
+
+    def _traces(self, traces: List[Dict[str, Any]], query: Dict[str, List[str]]) -> Tuple[int, Any]:
+        if query.get("format", [""])[0] == "chrome":
+            return 200, chrome_trace(traces)
+        return 200, {"traces": traces}
+
+    async def _debug_memory(self, path: str, query: Dict[str, List[str]]) -> Tuple[int, Any]:
+        try:
+            top = max(1, int(query.get("top", ["25"])[0]))
+            frames = max(1, int(query.get("frames", ["1"])[0]))
+        except ValueError:
+            return 400, {"error": "top and frames must be integers"}
+        if path == "/debug/memory":
+            return 200, _memory.summary()
+        if path == "/debug/memory/snapshot":
+            # Snapshots of a large heap take a while; keep the loop serving meanwhile
+            return 200, await asyncio.to_thread(_memory.snapshot, top, frames)
+        if path == "/debug/memory/diff":
+            try:
+                return 200, await asyncio.to_thread(_memory.diff, top, query.get("rebase", ["0"])[0] == "1")
+            except RuntimeError as e:
+                return 409, {"error": str(e)}
+        if path == "/debug/memory/stop":
+            _memory.stop_tracing()
+            return 200, {"tracemalloc": False}
+        return 404, {"error": "not found"}
+
+    async def _debug_profile(self, query: Dict[str, List[str]]) -> Tuple[int, Any]:
+        if self._profiling.locked():
+            return 409, {"error": "a profile is already running"}
+        arg = lambda name, default: query.get(name, [default])[0]
+        async with self._profiling:
+            try:
+                if arg("mode", "sample") == "cprofile":
+                    chat_id, message_id = int(arg("chat_id", "")), int(arg("message_id", ""))
+                    limit = max(1, int(arg("limit", "40")))
+                    sort = arg("sort", "cumulative")
+                    if sort not in SORT_KEYS:
+                        return 400, {"error": f"unknown sort key {sort}"}
+                    try:
+                        report = await profile_message(chat_id, message_id, sort, limit)
+                    except AlbumPartError as e:
+                        return 409, {"error": str(e)}
+                    return (200, report) if report is not None else (404, {"error": "message not found"})
+                seconds = min(max(float(arg("seconds", "30")), 0.1), 300)
+                hz = min(max(int(arg("hz", "100")), 1), 1000)
+            except ValueError:
+                return 400, {"error": "seconds, hz, chat_id, message_id and limit must be numbers"}
+            # thread=loop samples only the event loop thread; the default is every thread
+            threads = {threading.get_ident(): "event-loop"} if arg("thread", "all") == "loop" else None
+            counts, taken = await asyncio.to_thread(sample_stacks, seconds, hz, threads)
+            logging.info(f"Profiled {seconds}s at {hz}Hz: {taken} samples, {len(counts)} distinct stacks")
+            return 200, collapse(counts)
+
+    async def route(self, path: str, query: Dict[str, List[str]]) -> Tuple[int, Any]:
+        """(status, JSON payload or text body) for a GET request."""
+        if path == "/livez":
+            return 200, {"ok": True, "uptime_secs": round(time.monotonic() - self._started)}
+        if path == "/readyz":
+            ready, problems = self.readiness()
+            return (200 if ready else 503), {"ok": ready, "problems": problems}
+        if path in ("/", "/health", "/status"):
+            return 200, self._status()
+        if path == "/metrics":
+            return 200, render_metrics()
+        if path == "/trace/slowest":
+            try:
+                n = max(1, int(query.get("n", ["20"])[0]))
+            except ValueError:
+                n = 20
+            return self._traces(TRACES.slowest(n), query)
+        if path.startswith("/trace/"):
+            try:
+                message_id = int(path[len("/trace/"):])
+                chat_id = int(query["chat_id"][0]) if "chat_id" in query else None
+            except ValueError:
+                return 400, {"error": "message id and chat_id must be integers"}
+            traces = TRACES.get(message_id, chat_id)
+            if not traces:
+                return 404, {"error": "no trace for this message (not seen recently)"}
+            return self._traces(traces, query)
+        if path == "/debug/profile":
+            return await self._debug_profile(query)
+        if path.startswith("/debug/memory"):
+            return await self._debug_memory(path, query)
+        if path == "/favicon.ico":
+            return 204, None
+        return 404, {"error": "not found"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections.add(writer)
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.READ_TIMEOUT)
+            method, target = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ")[:2]
+            if method not in ("GET", "HEAD"):
+                status, payload = 405, {"error": "method not allowed"}
+            else:
+                url = urlsplit(target)
+                denied = self._debug_denied(head) if url.path.startswith("/debug/") else None
+                status, payload = denied or await self.route(url.path, parse_qs(url.query))
+            if payload is None:
+                body, content_type = b"", None
+            elif isinstance(payload, str):
+                body = payload.encode()
+                content_type = "text/plain; version=0.0.4" if url.path == "/metrics" else "text/plain; charset=utf-8"
+            else:
+                body, content_type = json.dumps(payload, default=str).encode(), "application/json"
+            lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Length: {len(body)}", "Connection: close"]
+            if content_type:
+                lines.append(f"Content-Type: {content_type}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + (body if method != "HEAD" else b""))
+            await asyncio.wait_for(writer.drain(), self.READ_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass  # slow, broken or malformed request: just drop the connection
+        except Exception as e:
+            logging.warning(f"Status request failed: {e}")
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+_status_server = StatusServer()
 
 async def _download(msg: Message) -> Optional[str]:
     """Download media from Telegram message with retry logic."""
@@ -264,6 +602,7 @@ async def _download(msg: Message) -> Optional[str]:
         except FloodWait as e:
             wait_time = e.value + 1
             logging.info(f"Rate limited, waiting {wait_time} seconds...")
+            _telegram_governor.pause(wait_time)
             await asyncio.sleep(wait_time)
             retry_count += 1
         except Exception as e:
@@ -272,30 +611,30 @@ async def _download(msg: Message) -> Optional[str]:
     logging.error(f"Max retries reached for download")
     return None
 
+def _classify_message(msg: Message) -> Tuple[str, Optional[int], Optional[int]]:
+    """Media type and dimensions of a message, without downloading anything."""
+    if msg.photo:
+        return "image", getattr(msg.photo, "width", None), getattr(msg.photo, "height", None)
+    if msg.video:
+        return "video", getattr(msg.video, "width", None), getattr(msg.video, "height", None)
+    if msg.audio:
+        return "audio", None, None
+    if getattr(msg, 'document', None):
+        # Detect PDFs specifically; other documents are not ingested
+        mime = getattr(msg.document, 'mime_type', None)
+        file_name = getattr(msg.document, 'file_name', '') or ''
+        if (mime and mime.lower() == 'application/pdf') or file_name.lower().endswith('.pdf'):
+            return "document", None, None
+    return "none", None, None
+
 async def _media_info(msg: Message) -> Tuple[Optional[str], Optional[int], Optional[int], str]:
     """Extract media information from message."""
     try:
-        if msg.photo:
-            p = await _download(msg)
-            width = getattr(msg.photo, "width", None)
-            height = getattr(msg.photo, "height", None)
-            return p, width, height, "image"
-        if msg.video:
-            p = await _download(msg)
-            width = getattr(msg.video, "width", None)
-            height = getattr(msg.video, "height", None)
-            return p, width, height, "video"
-        if msg.audio:
-            p = await _download(msg)
-            return p, None, None, "audio"
-        if getattr(msg, 'document', None):
-            # Detect PDFs specifically; otherwise mark as document
-            mime = getattr(msg.document, 'mime_type', None)
-            file_name = getattr(msg.document, 'file_name', '') or ''
-            if (mime and mime.lower() == 'application/pdf') or file_name.lower().endswith('.pdf'):
-                p = await _download(msg)
-                return p, None, None, "document"
-        return None, None, None, "none"
+        mt, width, height = _classify_message(msg)
+        if mt == "none":
+            return None, None, None, "none"
+        p = await _download(msg)
+        return p, width, height, mt
     except Exception as e:
         logging.error(f"Error extracting media info: {e}")
         return None, None, None, "none"
@@ -310,8 +649,18 @@ def _validate_r2_url(url: str) -> bool:
         return False
     return True
 
-def _upload_to_r2(file_path: str, object_key: str) -> Optional[str]:
-    """Upload file to R2 storage with retry logic and circuit breaker."""
+def _object_key(url: Optional[str]) -> Optional[str]:
+    """The R2 object key behind a public media URL (None for URLs outside R2_PUBLIC_BASE_URL)."""
+    base = (R2_PUBLIC_BASE_URL or "").rstrip("/") + "/"
+    if not url or base == "/" or not url.startswith(base):
+        return None
+    return url[len(base):]
+
+def _upload_to_r2(file_path: str, object_key: str, overwrite: bool = False) -> Optional[str]:
+    """Upload file to R2 storage with retry logic and circuit breaker.
+
+    An existing object is reused unless `overwrite` is set (media repair).
+    """
     if not _r2_circuit_breaker.can_proceed():
         logging.warning("R2 circuit breaker is open, skipping upload")
         return None
@@ -331,20 +680,24 @@ def _upload_to_r2(file_path: str, object_key: str) -> Optional[str]:
     
     while attempts < max_attempts:
         try:
-            # Idempotency: skip upload if object already exists
-            try:
-                r2.head_object(Bucket=R2_BUCKET, Key=object_key)
-                logging.debug(f"Object already exists: {object_key}")
-                _r2_circuit_breaker.record_success()
-                url = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key.lstrip('/')}"
-                if _validate_r2_url(url):
-                    return url
-                return None
-            except ClientError as e:
-                if e.response['Error']['Code'] != '404':
-                    raise
+            # Idempotency: skip upload if object already exists (repairs replace it)
+            if not overwrite:
+                try:
+                    with R2_HEAD_SECONDS.time():
+                        r2.head_object(Bucket=R2_BUCKET, Key=object_key)
+                    logging.debug(f"Object already exists: {object_key}")
+                    _r2_circuit_breaker.record_success()
+                    url = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key.lstrip('/')}"
+                    if _validate_r2_url(url):
+                        return url
+                    return None
+                except ClientError as e:
+                    if e.response['Error']['Code'] != '404':
+                        raise
             # Upload file
-            _transfer.upload_file(file_path, R2_BUCKET, object_key, extra_args={"ContentType": ct})
+            with R2_UPLOAD_SECONDS.time():
+                _transfer.upload_file(file_path, R2_BUCKET, object_key, extra_args={"ContentType": ct})
+            STAGE_BYTES.inc(os.path.getsize(file_path), "upload")
             logging.debug(f"Uploaded to R2: {object_key}")
             _r2_circuit_breaker.record_success()
             url = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key.lstrip('/')}"
@@ -368,212 +721,1062 @@ def _upload_to_r2(file_path: str, object_key: str) -> Optional[str]:
             raise
     return None
 
-async def process_message(msg, retry_count=0):
-    """Process a message with error handling and retry logic."""
+@dataclass
+class IngestJob:
+    """A message moving through the ingest stages, with everything each stage produced."""
+    msg: Optional[Message]
+    chat_id: int
+    message_id: int
+    retry_count: int = 0
+    seq: int = 0
+    file_path: Optional[str] = None
+    ext: str = ""
+    width: Optional[int] = None
+    height: Optional[int] = None
+    media_type: str = "none"
+    media_url: Optional[str] = None
+    derivatives: List[Tuple[str, str]] = field(default_factory=list)  # (local path, object key)
+    manifest: List[Dict[str, Any]] = field(default_factory=list)  # uploaded objects: {"key", "size", "etag"}
+    lane: str = "media"  # "text" jobs skip the media stages
+    metadata_only: bool = False  # early caption/metadata row for a media post; leaves media_url alone
+    defer_media: bool = False  # write the row with media_status="pending" and leave media to hydration
+    early_metadata: bool = True  # send a metadata row ahead of the media stages
+    overwrite: bool = False  # replace objects already in R2 instead of reusing them (hydration/repair)
+    source: str = "live"  # what submitted it: live, catchup, edit, backfill, retry, reconcile, hydration
+    album_key: Optional[Tuple[int, str]] = None  # (chat_id, media_group_id) for album parts
+    album: Optional[Dict[str, Any]] = None  # set on the single job that writes a merged album post
+    parts: List["IngestJob"] = field(default_factory=list)  # album parts finished along with it
+    mark: float = 0.0  # time.monotonic() of the job's last stage boundary, for its trace
+    done: Optional[asyncio.Future] = None
+
+def _remove_file(path: Optional[str]) -> None:
+    if not path:
+        return
     try:
-        fp, w, h, mt = await _media_info(msg)
-        mu = None
-        if fp:
-            ext = os.path.splitext(fp)[1] if isinstance(fp, str) else ""
-            key = f"{msg.chat.id}/{msg.id}{ext}"
-            mu = _upload_to_r2(fp, key)
-            if mt == "image" and HAS_PIL and isinstance(fp, str):
-                try:
-                    # Check file size before processing (limit to 50MB)
-                    file_size = os.path.getsize(fp) if os.path.exists(fp) else 0
-                    max_image_size = int(os.getenv("MAX_IMAGE_SIZE_BYTES", "52428800"))  # 50MB default
-                    if file_size > max_image_size:
-                        logging.warning(f"Image too large ({file_size} bytes), skipping processing")
-                    else:
-                        with Image.open(fp) as im:
-                            # Limit image dimensions to prevent memory issues
-                            max_dimension = int(os.getenv("MAX_IMAGE_DIMENSION", "8192"))  # 8K default
-                            if im.width > max_dimension or im.height > max_dimension:
-                                logging.warning(f"Image dimensions too large ({im.width}x{im.height}), resizing...")
-                                ratio = min(max_dimension / im.width, max_dimension / im.height)
-                                new_size = (int(im.width * ratio), int(im.height * ratio))
-                                im = im.resize(new_size, Image.Resampling.LANCZOS)
-                            
-                            sizes = IMAGE_SIZES
-                            for s in sizes:
-                                try:
-                                    im_copy = im.copy()
-                                    im_copy.thumbnail((s, s))
-                                    if ENABLE_RESIZED_ORIGINALS:
-                                        try:
-                                            out_path = f"{fp}.resized-{s}"
-                                            im_copy.save(out_path)
-                                            vkey = f"{msg.chat.id}/{msg.id}-w{s}{ext}"
-                                            _upload_to_r2(out_path, vkey)
-                                            try:
-                                                os.remove(out_path)
-                                            except Exception:
-                                                pass
-                                        except Exception:
-                                            pass
-                                    try:
-                                        if ENABLE_WEBP:
-                                            webp_path = f"{fp}.resized-{s}.webp"
-                                            im_copy.save(webp_path, format="WEBP", quality=75)
-                                            vkey_webp = f"{msg.chat.id}/{msg.id}-w{s}.webp"
-                                            _upload_to_r2(webp_path, vkey_webp)
-                                            try:
-                                                os.remove(webp_path)
-                                            except Exception:
-                                                pass
-                                    except Exception:
-                                        pass
-                                    try:
-                                        if ENABLE_AVIF:
-                                            avif_path = f"{fp}.resized-{s}.avif"
-                                            im_copy.save(avif_path, format="AVIF")
-                                            vkey_avif = f"{msg.chat.id}/{msg.id}-w{s}.avif"
-                                            _upload_to_r2(avif_path, vkey_avif)
-                                            try:
-                                                os.remove(avif_path)
-                                            except Exception:
-                                                pass
-                                    except Exception:
-                                        pass
-                                except Exception:
-                                    pass
-                            try:
-                                if ENABLE_WEBP:
-                                    webp_path = f"{fp}.webp"
-                                    im.save(webp_path, format="WEBP", quality=75)
-                                    o_webp_key = f"{msg.chat.id}/{msg.id}.webp"
-                                    _upload_to_r2(webp_path, o_webp_key)
-                                    try:
-                                        os.remove(webp_path)
-                                    except Exception:
-                                        pass
-                            except Exception:
-                                pass
-                            try:
-                                if ENABLE_AVIF:
-                                    avif_path = f"{fp}.avif"
-                                    im.save(avif_path, format="AVIF")
-                                    o_avif_key = f"{msg.chat.id}/{msg.id}.avif"
-                                    _upload_to_r2(avif_path, o_avif_key)
-                                    try:
-                                        os.remove(avif_path)
-                                    except Exception:
-                                        pass
-                            except Exception:
-                                pass
-                except Exception:
-                    pass
+        os.remove(path)
+    except Exception:
+        pass
+
+def _cleanup_job_files(job: IngestJob) -> None:
+    for path, _ in job.derivatives:
+        _remove_file(path)
+    job.derivatives = []
+    _remove_file(job.file_path)
+    job.file_path = None
+
+async def _stage_download(job: IngestJob) -> None:
+    """Download stage: fetch the media file from Telegram."""
+    started = time.perf_counter()
+    fp, w, h, mt = await _media_info(job.msg)
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - started, mt)
+    if isinstance(fp, str):
+        STAGE_BYTES.inc(os.path.getsize(fp), "download")
+    job.file_path, job.width, job.height, job.media_type = fp, w, h, mt
+    job.ext = os.path.splitext(fp)[1] if isinstance(fp, str) else ""
+
+def _stage_transform(job: IngestJob) -> None:
+    """Transform stage (runs in a thread): render image derivatives."""
+    if job.media_type == "image" and HAS_PIL and isinstance(job.file_path, str):
+        job.derivatives = render_derivatives(job.file_path, job.chat_id, job.message_id, job.ext,
+                                             low_memory=_memory.over_budget())
+
+def _stage_upload(job: IngestJob) -> None:
+    """Upload stage (runs in a thread): push the original and its derivatives to R2."""
+    try:
+        key = f"{job.chat_id}/{job.message_id}{job.ext}"
+        job.media_url = _upload_object(job, job.file_path, key)
+        for path, vkey in job.derivatives:
+            try:
+                _upload_object(job, path, vkey)
+            except Exception:
+                pass
+    finally:
+        _cleanup_job_files(job)
+
+def _file_etag(file_path: str) -> str:
+    """The ETag R2 reports for this file once uploaded through `_transfer`:
+    the MD5 of the content, or for multipart uploads the MD5 of the part
+    MD5s followed by "-<parts>"."""
+    size = os.path.getsize(file_path)
+    chunk = _transfer_cfg.multipart_chunksize
+    with open(file_path, "rb") as f:
+        if size < _transfer_cfg.multipart_threshold:
+            md5 = hashlib.md5()
+            for block in iter(lambda: f.read(1 << 20), b""):
+                md5.update(block)
+            return md5.hexdigest()
+        digests = [hashlib.md5(part).digest() for part in iter(lambda: f.read(chunk), b"")]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+def _manifest_entry(file_path: str, object_key: str) -> Dict[str, Any]:
+    return {"key": object_key, "size": os.path.getsize(file_path), "etag": _file_etag(file_path)}
+
+def _upload_object(job: IngestJob, file_path: str, object_key: str) -> Optional[str]:
+    """Upload one of a job's objects and record it in the job's media manifest."""
+    url = _upload_to_r2(file_path, object_key, overwrite=job.overwrite)
+    if url:
+        job.manifest.append(_manifest_entry(file_path, object_key))
+    return url
+
+def _strip_signature(content: Optional[str]) -> Optional[str]:
+    """Drop the trailing channel signature from a caption."""
+    if content:
         try:
-            os.remove(fp)
+            content = re.sub(r"\s*@batarikh\s*$", "", content.strip(), flags=re.IGNORECASE)
         except Exception:
             pass
-        
-        content = msg.caption or msg.text
-        if content:
+    return content
+
+def _clean_content(msg: Message) -> Optional[str]:
+    return _strip_signature(msg.caption or msg.text)
+
+def _media_file(msg: Message):
+    """The photo/video/audio/document object carrying the message's media."""
+    return msg.photo or msg.video or msg.audio or getattr(msg, 'document', None)
+
+def _text_hash(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def _entities_hash(msg: Message) -> Optional[str]:
+    """Hash of the caption/text formatting, so edits that only change entities are noticed."""
+    entities = getattr(msg, "caption_entities", None) or getattr(msg, "entities", None)
+    if not entities:
+        return None
+    return _text_hash(json.dumps([(str(e.type), e.offset, e.length, getattr(e, "url", None)) for e in entities]))
+
+def _build_album_row(job: IngestJob) -> Dict[str, Any]:
+    """One post for a whole album: the lowest message id, the caption and an ordered media list."""
+    album = job.album
+    media = album["media"]
+    lead = media[0] if media else {}
+    post_data = {
+        "id": job.message_id,
+        "channel_id": job.chat_id,
+        "created_at": album["created_at"],
+        "content": album["content"],
+        "content_hash": _text_hash(album["content"]),
+        "entities_hash": album["entities_hash"],
+        "media_type": lead.get("type", "none"),
+        "width": lead.get("width"),
+        "height": lead.get("height"),
+        "media_url": lead.get("url"),
+        "media": media,
+    }
+    if media:
+        post_data["media_status"] = "ready" if all(m["url"] for m in media) else "failed"
+        post_data["media_manifest"] = album["manifest"] or None
+    return post_data
+
+def _build_post_row(job: IngestJob) -> Dict[str, Any]:
+    if job.album is not None:
+        return _build_album_row(job)
+    msg = job.msg
+    post_data = {
+        "id": job.message_id,
+        "channel_id": job.chat_id,
+        "created_at": msg.date.isoformat(),
+        "content": _clean_content(msg),
+        "media_type": job.media_type,
+        "width": job.width,
+        "height": job.height,
+    }
+    post_data["content_hash"] = _text_hash(post_data["content"])
+    post_data["entities_hash"] = _entities_hash(msg)
+    if job.metadata_only:
+        return post_data
+    if job.media_type != "none":
+        media = _media_file(msg)
+        post_data["tg_file_id"] = getattr(media, "file_id", None)
+        post_data["tg_file_unique_id"] = getattr(media, "file_unique_id", None)
+    if job.defer_media:
+        post_data["media_status"] = "pending"
+        return post_data
+    # Only include media_url if it's valid (not None, not empty, and properly formatted)
+    if job.media_url and _validate_r2_url(job.media_url):
+        post_data["media_url"] = job.media_url
+    else:
+        if job.media_url:
+            logging.warning(f"Invalid media_url for post id={job.message_id}, saving without it. URL: {job.media_url}")
+        post_data["media_url"] = None
+    if job.media_type != "none":
+        post_data["media_status"] = "ready" if post_data["media_url"] else "failed"
+        # Every object written for the post, so deleting it can clean up storage
+        post_data["media_manifest"] = job.manifest or None
+    return post_data
+
+def _upsert_rows(rows: List[Dict[str, Any]]) -> None:
+    """Upsert rows in as few requests as possible (PostgREST needs identical keys per request)."""
+    by_columns: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for row in rows:
+        by_columns.setdefault(tuple(sorted(row)), []).append(row)
+    for group in by_columns.values():
+        with SUPABASE_UPSERT_SECONDS.time():
+            supabase.table("posts").upsert(group, on_conflict="channel_id,id").execute()
+        UPSERTED_ROWS.inc(len(group))
+
+def _upsert_post(post_data: Dict[str, Any]) -> Optional[str]:
+    """Upsert a single post, retrying without media_url on R2 access errors.
+
+    Returns an error message if the row could not be written.
+    """
+    post_id = post_data["id"]
+    try:
+        _upsert_rows([post_data])
+        return None
+    except Exception as e:
+        error_str = str(e)
+        # Check if it's an R2 401 error (bucket access issue)
+        if "401" in error_str or "Unauthorized" in error_str or "cloudflare.com" in error_str or "bucket cannot be viewed" in error_str:
+            logging.warning(f"R2 bucket access issue for post id={post_id}: {error_str[:200]}")
+            logging.warning(f"R2_PUBLIC_BASE_URL is set to: {R2_PUBLIC_BASE_URL}")
+            logging.warning(f"Make sure R2 bucket has public access enabled and R2_PUBLIC_BASE_URL is correct")
+            logging.warning(f"Saving post without media_url")
+            # Try again without media_url
             try:
-                content = re.sub(r"\s*@batarikh\s*$", "", content.strip(), flags=re.IGNORECASE)
-            except Exception:
-                pass
-        created = msg.date.isoformat()
+                _upsert_rows([dict(post_data, media_url=None)])
+                logging.info(f"Upserted post id={post_id} without media_url (R2 access issue)")
+                return None
+            except Exception as e2:
+                logging.error(f"Failed to upsert post id={post_id} even without media_url: {e2}")
+                return str(e2)
+        logging.error(f"Failed to upsert post id={post_id}: {e}")
+        return error_str
+
+def _write_rows(rows: List[Dict[str, Any]]) -> Dict[Tuple[int, int], str]:
+    """Write a batch of rows (runs in a thread). Returns errors keyed by (channel_id, id)."""
+    try:
+        _upsert_rows(rows)
+        return {}
+    except Exception as e:
+        logging.warning(f"Batch upsert of {len(rows)} post(s) failed, falling back to per-row upserts: {e}")
+    errors = {}
+    for row in rows:
+        error = _upsert_post(row)
+        if error:
+            errors[(row["channel_id"], row["id"])] = error
+    return errors
+
+def _delete_album_parts(parts: Dict[int, List[int]]) -> None:
+    """Drop the per-message rows an album was written as before it was merged (runs in a thread)."""
+    for chat_id, ids in parts.items():
+        try:
+            supabase.table("posts").delete().eq("channel_id", chat_id).in_("id", ids).execute()
+        except Exception as e:
+            logging.warning(f"Failed to delete album part rows {ids} in chat_id={chat_id}: {e}")
+
+def _iter_posts(columns: str, page_size: int = 1000, include_deleted: bool = False,
+                after: Optional[Tuple[int, int]] = None, where=None):
+    """Stream posts in (channel_id, id) keyset order, one page per request.
+
+    `after` resumes behind a (channel_id, id) position; `where` can add
+    filters to each page query. Used by the maintenance commands.
+    """
+    while True:
+        query = supabase.table("posts").select(f"channel_id,id,{columns}")
+        if not include_deleted:
+            query = query.is_("deleted_at", "null")
+        if where is not None:
+            query = where(query)
+        if after is not None:
+            query = query.or_(f"channel_id.gt.{after[0]},and(channel_id.eq.{after[0]},id.gt.{after[1]})")
+        rows = query.order("channel_id").order("id").limit(page_size).execute().data or []
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = (rows[-1]["channel_id"], rows[-1]["id"])
+
+async def _persist_jobs(jobs: List[IngestJob]) -> set:
+    """Persist stage: upsert the post rows for a batch of jobs.
+
+    Returns the (chat_id, id) pairs whose rows were not written (they are queued for retry).
+    """
+    failed = set()
+    rows = []
+    for job in jobs:
+        rows.append(_build_post_row(job))
+        if job.metadata_only:
+            continue
         STATS["processed"] += 1
-        STATS["last_id"] = msg.id
-        STATS["last_time"] = created
-        
-        # Upsert to Supabase with circuit breaker
-        if supabase and _supabase_circuit_breaker.can_proceed():
+        channel_stats = _channel_stats(job.chat_id)
+        channel_stats["processed"] += 1
+        channel_stats["last_id"] = job.message_id
+        STATS["last_id"] = job.message_id
+        STATS["last_time"] = rows[-1]["created_at"]
+    
+    # Upsert to Supabase with circuit breaker
+    if supabase and _supabase_circuit_breaker.can_proceed():
+        album_parts: Dict[int, List[int]] = {}
+        errors = await asyncio.to_thread(_write_rows, rows)
+        if len(errors) < len(rows):
+            _supabase_circuit_breaker.record_success()
+        for job, row in zip(jobs, rows):
+            error = errors.get((job.chat_id, job.message_id))
+            if job.metadata_only:
+                # The full row follows once the media is uploaded
+                if error:
+                    logging.warning(f"Failed to upsert metadata for post id={job.message_id}: {error}")
+                continue
+            if error:
+                failed.add((job.chat_id, job.message_id))
+                STATS["last_error"] = error
+                _supabase_circuit_breaker.record_failure()
+                if job.retry_count < _max_retries:
+                    _queue_message_for_retry(job.msg, error, job.retry_count)
+            else:
+                logging.info(f"Upserted post id={job.message_id} type={job.media_type} media_url={'set' if row.get('media_url') else 'none'}")
+                if job.album and len(job.album["ids"]) > 1:
+                    album_parts.setdefault(job.chat_id, []).extend(job.album["ids"][1:])
+        if album_parts:
+            await asyncio.to_thread(_delete_album_parts, album_parts)
+    elif supabase:
+        logging.warning("Supabase circuit breaker is open, skipping upsert")
+        for job in jobs:
+            failed.add((job.chat_id, job.message_id))
+            if not job.metadata_only and job.retry_count < _max_retries:
+                _queue_message_for_retry(job.msg, "Supabase circuit breaker open", job.retry_count)
+    return failed
+
+def _record_job_failure(job: IngestJob, error: Exception) -> None:
+    logging.error(f"Error processing message id={job.message_id}: {error}", exc_info=error)
+    STATS["failed"] += 1
+    STATS["last_error"] = str(error)
+    _channel_stats(job.chat_id)["failed"] += 1
+    if job.retry_count < _max_retries:
+        _queue_id_for_retry(job.chat_id, job.message_id, str(error), job.retry_count)
+    else:
+        logging.error(f"Message id={job.message_id} exceeded max retries, giving up")
+
+def _job_for(msg: Message, retry_count: int = 0) -> IngestJob:
+    return IngestJob(msg=msg, chat_id=msg.chat.id, message_id=msg.id, retry_count=retry_count)
+
+async def process_message(msg, retry_count=0, profiles: Optional[List[cProfile.Profile]] = None):
+    """Process a message through every stage inline, with error handling and retry logic.
+
+    The live worker feeds messages through IngestPipeline instead; this is the
+    single-message path for tools and one-off processing. With `profiles`,
+    the thread stages run under cProfile and their profiles are added to it.
+    """
+    job = _job_for(msg, retry_count)
+    try:
+        await _stage_download(job)
+        await asyncio.to_thread(profiled(_stage_transform, profiles), job)
+        if job.file_path:
+            await asyncio.to_thread(profiled(_stage_upload, profiles), job)
+        await _persist_jobs([job])
+    except Exception as e:
+        _record_job_failure(job, e)
+    finally:
+        _cleanup_job_files(job)
+
+class AlbumPartError(Exception):
+    """The message is part of an album, which process_message can't write on its own."""
+
+async def profile_message(chat_id: int, message_id: int, sort: str = "cumulative", limit: int = 40) -> Optional[str]:
+    """Refetch a message and run process_message on it under cProfile; None if it is gone.
+
+    The loop thread's profile also covers whatever else ran on the loop
+    meanwhile; the thread stages get profiles of their own. The post is
+    written again, which the upsert makes harmless. Album parts are refused:
+    on its own a part would replace or duplicate the merged album post.
+    """
+    msgs = await _get_messages_batched(chat_id, [message_id])
+    if not msgs:
+        return None
+    if getattr(msgs[0], "media_group_id", None):
+        raise AlbumPartError(f"message id={message_id} is part of an album; profile a single-media post instead")
+    profiles = [cProfile.Profile()]
+    profiles[0].enable()
+    try:
+        await process_message(msgs[0], profiles=profiles)
+    finally:
+        profiles[0].disable()
+    return pstats_text(profiles, sort, limit)
+
+class FairQueue:
+    """Bounded queue with one FIFO per channel, served by smooth weighted round robin.
+
+    Each channel gets its own capacity, so a backlog in one never blocks
+    producers of another, and consumers take items from the non-empty
+    channels in proportion to their weights.
+    """
+
+    def __init__(self, maxsize: int, weight) -> None:
+        self.maxsize = maxsize
+        self._weight = weight
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._current: Dict[int, int] = {}
+        self._available = asyncio.Semaphore(0)
+
+    def _queue(self, key: int) -> asyncio.Queue:
+        if key not in self._queues:
+            self._queues[key] = asyncio.Queue(maxsize=self.maxsize)
+            self._current[key] = 0
+        return self._queues[key]
+
+    async def put(self, item: IngestJob) -> None:
+        await self._queue(item.chat_id).put(item)
+        self._available.release()
+
+    async def get(self) -> IngestJob:
+        await self._available.acquire()
+        ready = [k for k, q in self._queues.items() if not q.empty()]
+        total = 0
+        for k in ready:
+            self._current[k] += self._weight(k)
+            total += self._weight(k)
+        chosen = max(ready, key=lambda k: self._current[k])
+        self._current[chosen] -= total
+        return self._queues[chosen].get_nowait()
+
+    def task_done(self) -> None:
+        pass
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self._queues.values())
+
+    def sizes(self) -> Dict[str, int]:
+        return {str(k): q.qsize() for k, q in self._queues.items()}
+
+# Telegram albums hold at most 10 messages, sent together with consecutive ids,
+# so a part is never more than this far above its album's lead
+ALBUM_MAX_PARTS = 10
+
+class AlbumAssembler:
+    """Collects the parts of a Telegram album (messages sharing a media_group_id)
+    into a single post.
+
+    Parts run through the media stages concurrently like any other job. Once
+    ALBUM_WINDOW_MS has passed without a new part and every part seen so far is
+    done, one row is written under the lowest message id with the caption and
+    an ordered `media` list. Recently written albums are remembered, so a part
+    arriving late (or coming back from the retry queue) rewrites the post with
+    itself merged in. A refetched group with nothing remembered (written before
+    a restart) looks its stored row up once before it is written.
+    """
+
+    def __init__(self, pipeline: "IngestPipeline") -> None:
+        self.pipeline = pipeline
+        self.window = _env_int("ALBUM_WINDOW_MS", 1500) / 1000
+        self._open: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        self._closed: "OrderedDict[Tuple[int, str], Dict[str, Any]]" = OrderedDict()
+        self._max_closed = _env_int("ALBUM_MEMORY", 512)
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    def add(self, job: IngestJob) -> None:
+        key = (job.chat_id, str(job.msg.media_group_id))
+        job.album_key = key
+        group = self._open.get(key)
+        if group is None:
+            closed = self._closed.pop(key, None)
+            empty = {"entries": {}, "captions": {}, "dates": {}, "entities": {}, "manifests": {}}
+            group = dict(closed or empty, jobs={}, handle=None, seeded=closed is not None or not supabase, lookup=None)
+            self._open[key] = group
+        group["jobs"][job.message_id] = job
+        group["entries"].pop(job.message_id, None)
+        loop = asyncio.get_running_loop()
+        group["deadline"] = loop.time() + self.window
+        if group["handle"]:
+            group["handle"].cancel()
+        group["handle"] = loop.call_later(self.window, self._check, key)
+
+    def part_done(self, job: IngestJob) -> None:
+        group = self._open[job.album_key]
+        url = job.media_url if job.media_url and _validate_r2_url(job.media_url) else None
+        group["entries"][job.message_id] = {
+            "id": job.message_id,
+            "type": job.media_type,
+            "url": url,
+            "width": job.width,
+            "height": job.height,
+            "file_unique_id": getattr(_media_file(job.msg), "file_unique_id", None),
+        }
+        group["dates"][job.message_id] = job.msg.date.isoformat()
+        group["manifests"][job.message_id] = job.manifest
+        group["captions"].pop(job.message_id, None)
+        caption = _clean_content(job.msg)
+        if caption:
+            group["captions"][job.message_id] = caption
+            group["entities"][job.message_id] = _entities_hash(job.msg)
+        self._check(job.album_key)
+
+    def remember(self, chat_id: int, group_id: Any, row: Dict[str, Any]) -> None:
+        """Seed a written album from its stored row, so a part resubmitted after a
+        restart is merged into the existing media list instead of replacing it."""
+        key = (chat_id, str(group_id))
+        if key in self._open or key in self._closed:
+            return
+        self._closed[key] = self._stored_state(row)
+
+    @staticmethod
+    def _stored_state(row: Dict[str, Any]) -> Dict[str, Any]:
+        entries = {m["id"]: m for m in row.get("media") or []}
+        lead = row["id"]
+        return {
+            "entries": entries,
+            "captions": {lead: row["content"]} if row.get("content") else {},
+            "dates": {i: row["created_at"] for i in list(entries) + [lead]},
+            "entities": {lead: row.get("entities_hash")},
+            # Stored objects can't be split per part; 0 keeps them apart from re-uploaded parts
+            "manifests": {0: row.get("media_manifest") or []},
+        }
+
+    async def _seed(self, key: Tuple[int, str], group: Dict[str, Any]) -> None:
+        """Merge the stored row of an album into an open group with no remembered
+        state, so parts refetched after a restart don't replace the post."""
+        try:
+            row = await asyncio.to_thread(_fetch_album_row, key[0], min(group["jobs"]))
+        except Exception as e:
+            logging.warning(f"Album lookup failed for chat_id={key[0]}: {e}; writing the album from the parts at hand")
+            row = None
+        if self._open.get(key) is not group:
+            return
+        if row:
+            stored = self._stored_state(row)
+            for name, values in stored.items():
+                for i, value in values.items():
+                    if i not in group["jobs"]:
+                        group[name].setdefault(i, value)
+        group["seeded"] = True
+        self._check(key)
+
+    def forget(self, chat_id: int, ids) -> None:
+        """Drop deleted parts from remembered albums, so a later part doesn't bring them back."""
+        gone = set(ids)
+        for (chat, _), group in self._closed.items():
+            if chat == chat_id:
+                for name in ("entries", "captions", "dates", "entities", "manifests"):
+                    for i in gone & set(group[name]):
+                        del group[name][i]
+                if 0 in group["manifests"]:
+                    group["manifests"][0] = [o for o in group["manifests"][0] if _key_message_id(chat_id, o["key"]) not in gone]
+
+    def _check(self, key: Tuple[int, str]) -> None:
+        group = self._open.get(key)
+        if group is None or asyncio.get_running_loop().time() < group["deadline"]:
+            return
+        if any(i not in group["entries"] for i in group["jobs"]):
+            return
+        # Only a refetch (a part at or below what was already persisted) can have a stored row
+        if not group["seeded"] and min(group["jobs"]) <= _persisted_through(key[0]):
+            if group["lookup"] is None:
+                group["lookup"] = asyncio.get_running_loop().create_task(self._seed(key, group))
+            return
+        del self._open[key]
+        ids = sorted(group["entries"])
+        captions = group["captions"]
+        caption_id = next((i for i in ids if i in captions), None)
+        parts = sorted(group["jobs"].values(), key=lambda j: j.message_id)
+        album = IngestJob(
+            msg=parts[0].msg,
+            chat_id=key[0],
+            message_id=ids[0],
+            retry_count=parts[0].retry_count,
+            source=parts[0].source,
+            media_type="album",
+            album={
+                "ids": ids,
+                "media": [group["entries"][i] for i in ids if group["entries"][i]["type"] != "none"],
+                "content": captions.get(caption_id),
+                "entities_hash": group["entities"].get(caption_id),
+                "created_at": group["dates"][ids[0]],
+                "manifest": list({o["key"]: o for m in group["manifests"].values() for o in m}.values()),
+            },
+        )
+        self._closed[key] = {k: group[k] for k in ("entries", "captions", "dates", "entities", "manifests")}
+        while len(self._closed) > self._max_closed:
+            self._closed.popitem(last=False)
+        self.pipeline._emit_album(album, parts)
+
+class IngestPipeline:
+    """Staged ingest: fetch -> download -> transform -> upload -> persist.
+
+    Each stage has its own bounded queue and worker pool, so a slow stage
+    applies backpressure to the ones before it while the others keep working.
+    The number of jobs in flight is capped at admission. Rows for a chat are
+    handed to the persist stage in the order their messages were admitted,
+    whatever order the media stages finish in.
+
+    Messages are classified on arrival: text-only posts take the "text" lane
+    straight to persist, and media posts get their caption/metadata row
+    written the same way while the media itself catches up. Ordering is kept
+    per chat and lane, so a slow video never holds back a text post.
+
+    With several channels, each one has its own admission cap and its own
+    slice of every media queue; download, transform and upload workers are
+    shared by weighted fair scheduling (CHANNEL_WEIGHTS).
+    """
+
+    def __init__(self) -> None:
+        self.workers = {
+            "fetch": _env_int("PIPELINE_FETCH_WORKERS", 1),
+            "download": _env_int("PIPELINE_DOWNLOAD_WORKERS", 4),
+            "transform": _env_int("PIPELINE_TRANSFORM_WORKERS", 2),
+            "upload": _env_int("PIPELINE_UPLOAD_WORKERS", 4),
+            "persist": _env_int("PIPELINE_PERSIST_WORKERS", 1),
+        }
+        queue_size = _env_int("PIPELINE_QUEUE_SIZE", 32)
+        self.queues: Dict[str, Any] = {
+            name: FairQueue(queue_size, _channel_weight) for name in ("download", "transform", "upload")
+        }
+        # Large enough for a full get_messages batch to accumulate
+        self.queues["fetch"] = asyncio.Queue(maxsize=max(queue_size, TELEGRAM_BATCH_SIZE))
+        # Persist is sharded by chat so each chat's rows are written by one worker, in order
+        self.persist_queues: List[asyncio.Queue] = [asyncio.Queue() for _ in range(self.workers["persist"])]
+        self.batch_size = _env_int("PERSIST_BATCH_SIZE", 50)
+        self.flush_interval = _env_int("PERSIST_FLUSH_MS", 200) / 1000
+        self._max_in_flight = _env_int("PIPELINE_MAX_IN_FLIGHT", 256)
+        self._slots: Dict[int, asyncio.Semaphore] = {}
+        self._in_flight = 0
+        self._next_seq: Dict[Tuple[int, str], int] = {}
+        self._commit_seq: Dict[Tuple[int, str], int] = {}
+        self._ready: Dict[Tuple[int, str], Dict[int, Optional[IngestJob]]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._busy: Dict[str, int] = {}  # stage -> jobs its workers are handling right now
+        self._open: Dict[int, Dict[int, int]] = {}  # chat -> message ids admitted and not finished (with counts)
+        self.albums = AlbumAssembler(self)
+        self._held: Deque[IngestJob] = deque()  # media jobs waiting for RSS to drop below budget
+        self._gate: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        handlers = {
+            "fetch": self._fetch,
+            "download": self._download,
+            "transform": self._transform,
+            "upload": self._upload,
+        }
+        for name, handler in handlers.items():
+            for _ in range(self.workers[name]):
+                self._tasks.append(asyncio.create_task(self._run_stage(name, handler)))
+        for queue in self.persist_queues:
+            self._tasks.append(asyncio.create_task(self._run_persist(queue)))
+        logging.info(f"Ingest pipeline started with workers {self.workers}")
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Let in-flight jobs drain for up to `timeout` seconds, then cancel the workers."""
+        deadline = time.monotonic() + timeout
+        while self._in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if self._in_flight:
+            logging.warning(f"Stopping pipeline with {self._in_flight} job(s) still in flight")
+        tasks = self._tasks + ([self._gate] if self._gate else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._gate = None
+
+    def lowest_open(self, chat_id: int, above: int = 0) -> Optional[int]:
+        """The lowest message id above `above` still in flight for a chat."""
+        return min((i for i in self._open.get(chat_id, ()) if i > above), default=None)
+
+    def lane_backlog(self) -> Dict[str, int]:
+        """Jobs admitted but not yet handed to persist, per lane."""
+        backlog: Dict[str, int] = {}
+        for (chat_id, lane), seq in list(self._next_seq.items()):
+            backlog[lane] = backlog.get(lane, 0) + seq - self._commit_seq.get((chat_id, lane), 0)
+        return backlog
+
+    def depths(self) -> Dict[str, Any]:
+        depths: Dict[str, Any] = {name: q.qsize() for name, q in self.queues.items()}
+        depths["persist"] = sum(q.qsize() for q in self.persist_queues)
+        depths["in_flight"] = self._in_flight
+        depths["albums_open"] = len(self.albums)
+        depths["media_held"] = len(self._held)
+        depths["by_channel"] = {name: self.queues[name].sizes() for name in ("download", "transform", "upload")}
+        return depths
+
+    async def submit(self, msg: Message, retry_count: int = 0, defer_media: bool = False,
+                     source: str = "live") -> asyncio.Future:
+        """Admit a message. Waits while the pipeline is full; returns a future
+        that resolves to True once the post is persisted (False if it failed).
+
+        With `defer_media` only the row (caption, type, dimensions, Telegram
+        file ids) is written; the media pipeline runs later in hydration.
+        `source` labels the end-to-end latency metric.
+        """
+        job = _job_for(msg, retry_count)
+        job.defer_media = defer_media
+        job.source = source
+        job.media_type, job.width, job.height = _classify_message(msg)
+        if job.media_type == "none" or defer_media:
+            job.lane = "text"
+        await self._admit(job)
+        await self._dispatch(job)
+        return job.done
+
+    async def submit_ids(self, chat_id: int, message_ids, retry_counts: Optional[Dict[int, int]] = None,
+                         early_metadata: bool = True, overwrite: bool = False,
+                         source: str = "retry") -> Dict[int, asyncio.Future]:
+        """Admit messages by id; the fetch stage resolves them in batches.
+
+        The returned futures resolve to None for ids Telegram no longer has
+        (or that were merged into an album post under another id).
+        Pass `early_metadata=False` when the rows already exist, and
+        `overwrite=True` to replace their stored objects.
+        """
+        retry_counts = retry_counts or {}
+        futures = {}
+        for message_id in message_ids:
+            job = IngestJob(msg=None, chat_id=chat_id, message_id=message_id,
+                            retry_count=retry_counts.get(message_id, 0), early_metadata=early_metadata,
+                            overwrite=overwrite, source=source)
+            await self._admit(job)
+            await self.queues["fetch"].put(job)
+            futures[message_id] = job.done
+        return futures
+
+    def _trace(self, job: IngestJob, name: str, start: float, end: float) -> None:
+        """Add a span to the job's message trace and move its stage boundary to `end`."""
+        if job.album is not None:
+            name += " (album)"
+        elif job.metadata_only:
+            name += " (metadata)"
+        TRACES.span(job.chat_id, job.message_id, name, start, end)
+        job.mark = end
+
+    async def _admit(self, job: IngestJob) -> None:
+        waited = time.monotonic()
+        # Metadata rows are cheap and must never wait behind the media jobs they belong to
+        if not job.metadata_only:
+            if job.chat_id not in self._slots:
+                self._slots[job.chat_id] = asyncio.Semaphore(self._max_in_flight)
+            await self._slots[job.chat_id].acquire()
+            open_ids = self._open.setdefault(job.chat_id, {})
+            open_ids[job.message_id] = open_ids.get(job.message_id, 0) + 1
+        self._trace(job, "admit", waited, time.monotonic())
+        self._in_flight += 1
+        job.done = asyncio.get_running_loop().create_future()
+        key = (job.chat_id, job.lane)
+        job.seq = self._next_seq.get(key, 0)
+        self._next_seq[key] = job.seq + 1
+
+    def _emit_album(self, album: IngestJob, parts: List[IngestJob]) -> None:
+        """Release a merged album post in place of its parts.
+
+        The post takes over the order slot of its first media part; the other
+        parts just give theirs up. Parts stay in flight (holding their
+        admission slots) until the post is persisted.
+        """
+        anchor = min(parts, key=lambda p: (p.lane != "media", p.message_id))
+        album.lane, album.seq, album.parts = anchor.lane, anchor.seq, parts
+        album.done = asyncio.get_running_loop().create_future()
+        self._in_flight += 1
+        now = time.monotonic()
+        album.mark = now
+        for part in parts:
+            self._trace(part, "album wait", part.mark, now)
+            if part is not anchor:
+                self._advance(part, None)
+        self._advance(album, album)
+
+    async def _dispatch(self, job: IngestJob) -> None:
+        """Route a classified job: text goes straight to persist, media also
+        sends a metadata row ahead of itself through the text lane. Album
+        parts skip the metadata row and are collected into one post."""
+        if getattr(job.msg, "media_group_id", None) and not job.defer_media:
+            self.albums.add(job)
+            if job.media_type == "none":
+                self.albums.part_done(job)
+            else:
+                await self._start_media(job)
+            return
+        if job.media_type == "none" or job.defer_media:
+            self._release(job, True)
+            return
+        if not job.early_metadata:
+            await self._start_media(job)
+            return
+        meta = IngestJob(
+            msg=job.msg,
+            chat_id=job.chat_id,
+            message_id=job.message_id,
+            retry_count=job.retry_count,
+            width=job.width,
+            height=job.height,
+            media_type=job.media_type,
+            lane="text",
+            metadata_only=True,
+            source=job.source,
+        )
+        await self._admit(meta)
+        self._release(meta, True)
+        await self._start_media(job)
+
+    def _media_in_progress(self) -> bool:
+        return any(self._busy.get(name) or self.queues[name].qsize() for name in ("download", "transform", "upload"))
+
+    async def _start_media(self, job: IngestJob) -> None:
+        """Send a job into the media stages, or hold it while RSS is over budget.
+
+        Held jobs wait in order behind a gate task, so the fetch stage (and with
+        it text posts and metadata rows) keeps going. Media already in the
+        stages is left to finish and free its memory; with nothing left in them,
+        waiting can't help and the jobs go ahead.
+        """
+        if self._held or (_memory.over_budget() and self._media_in_progress()):
+            self._held.append(job)
+            if self._gate is None:
+                self._gate = asyncio.create_task(self._release_held())
+            return
+        await self.queues["download"].put(job)
+
+    async def _release_held(self) -> None:
+        STATS["memory_paused"] = True
+        logging.warning(f"RSS over budget ({rss_bytes() // 1048576} MB), holding new media jobs")
+        try:
+            await asyncio.to_thread(trim_heap)
+            while self._held:
+                while _memory.over_budget() and self._media_in_progress():
+                    await asyncio.sleep(0.5)
+                await self.queues["download"].put(self._held.popleft())
+        finally:
+            STATS["memory_paused"] = False
+            self._gate = None
+        logging.info(f"Resuming media jobs (RSS {rss_bytes() // 1048576} MB)")
+
+    def _finish(self, job: IngestJob, result: Optional[bool]) -> None:
+        _cleanup_job_files(job)
+        if not job.done.done():
+            job.done.set_result(result)
+        self._in_flight -= 1
+        if not job.metadata_only and job.album is None:
+            self._slots[job.chat_id].release()
+            open_ids = self._open[job.chat_id]
+            open_ids[job.message_id] -= 1
+            if not open_ids[job.message_id]:
+                del open_ids[job.message_id]
+        for part in job.parts:
+            # Merged into the album post: no row of their own
+            self._finish(part, None if part.message_id != job.message_id else result)
+
+    def _release(self, job: IngestJob, ok: bool, result: Optional[bool] = False) -> None:
+        """Hand a finished job to persist once every earlier job of its chat is released.
+
+        Jobs that did not make it (`ok=False`) just free their place in the order.
+        """
+        if not ok:
+            self._finish(job, result)
+        self._advance(job, job if ok else None)
+
+    def _advance(self, job: IngestJob, item: Optional[IngestJob]) -> None:
+        key = (job.chat_id, job.lane)
+        ready = self._ready.setdefault(key, {})
+        ready[job.seq] = item
+        nxt = self._commit_seq.get(key, 0)
+        while nxt in ready:
+            item = ready.pop(nxt)
+            nxt += 1
+            if item is not None:
+                self._trace(item, "reorder", item.mark, time.monotonic())
+                self.persist_queues[item.chat_id % len(self.persist_queues)].put_nowait(item)
+        self._commit_seq[key] = nxt
+
+    async def _route(self, job: IngestJob, stage: str) -> None:
+        """Send a job to the next stage it needs after `stage`."""
+        if stage == "fetch":
+            job.media_type, job.width, job.height = _classify_message(job.msg)
+            await self._dispatch(job)
+        elif stage == "download" and job.media_type == "image" and job.file_path:
+            await self.queues["transform"].put(job)
+        elif stage in ("download", "transform") and job.file_path:
+            await self.queues["upload"].put(job)
+        elif job.album_key:
+            self.albums.part_done(job)
+        else:
+            self._release(job, True)
+
+    async def _run_stage(self, name: str, handler) -> None:
+        queue = self.queues[name]
+        while True:
+            job = await queue.get()
+            started = time.monotonic()
+            if name != "fetch":
+                # Fetch traces each job of its batch itself
+                self._trace(job, f"queue:{name}", job.mark, started)
+            self._busy[name] = self._busy.get(name, 0) + 1
             try:
-                # Prepare data for upsert
-                post_data = {
-                    "id": msg.id,
-                    "created_at": created,
-                    "content": content,
-                    "media_type": mt,
-                    "width": w,
-                    "height": h,
-                }
-                # Only include media_url if it's valid (not None, not empty, and properly formatted)
-                if mu and _validate_r2_url(mu):
-                    post_data["media_url"] = mu
+                forward = await handler(job)
+                if name != "fetch":
+                    self._trace(job, name, started, time.monotonic())
+            except Exception as e:
+                self._trace(job, f"{name} failed", started, time.monotonic())
+                _record_job_failure(job, e)
+                if job.album_key:
+                    # The album goes out without this part; its retry merges it in later
+                    _cleanup_job_files(job)
+                    job.media_url = None
+                    self.albums.part_done(job)
                 else:
-                    if mu:
-                        logging.warning(f"Invalid media_url for post id={msg.id}, saving without it. URL: {mu}")
-                    post_data["media_url"] = None
-                
-                supabase.table("posts").upsert(post_data).execute()
-                logging.info(f"Upserted post id={msg.id} type={mt} media_url={'set' if post_data.get('media_url') else 'none'}")
-                _supabase_circuit_breaker.record_success()
+                    self._release(job, False)
+            else:
+                if forward:
+                    await self._route(job, name)
+            finally:
+                self._busy[name] -= 1
+                _memory.note(name)
+                queue.task_done()
+
+    async def _fetch(self, job: IngestJob) -> bool:
+        if job.msg is not None:
+            return True
+        # Drain other id-only jobs already waiting so they share get_messages calls
+        batch = [job]
+        queue = self.queues["fetch"]
+        while len(batch) < TELEGRAM_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+            queue.task_done()
+        started = time.monotonic()
+        by_chat: Dict[int, List[IngestJob]] = {}
+        for j in batch:
+            self._trace(j, "queue:fetch", j.mark, started)
+            by_chat.setdefault(j.chat_id, []).append(j)
+        for chat_id, jobs in by_chat.items():
+            fetch_started = time.monotonic()
+            try:
+                msgs = {m.id: m for m in await _get_messages_batched(chat_id, [j.message_id for j in jobs])}
             except Exception as e:
-                error_str = str(e)
-                # Check if it's an R2 401 error (bucket access issue)
-                if "401" in error_str or "Unauthorized" in error_str or "cloudflare.com" in error_str or "bucket cannot be viewed" in error_str:
-                    logging.warning(f"R2 bucket access issue for post id={msg.id}: {error_str[:200]}")
-                    logging.warning(f"R2_PUBLIC_BASE_URL is set to: {R2_PUBLIC_BASE_URL}")
-                    logging.warning(f"Make sure R2 bucket has public access enabled and R2_PUBLIC_BASE_URL is correct")
-                    logging.warning(f"Saving post without media_url")
-                    # Try again without media_url
-                    try:
-                        post_data_no_media = {
-                            "id": msg.id,
-                            "created_at": created,
-                            "content": content,
-                            "media_type": mt,
-                            "media_url": None,  # Set to None instead of invalid URL
-                            "width": w,
-                            "height": h,
-                        }
-                        supabase.table("posts").upsert(post_data_no_media).execute()
-                        logging.info(f"Upserted post id={msg.id} without media_url (R2 access issue)")
-                        _supabase_circuit_breaker.record_success()
-                    except Exception as e2:
-                        logging.error(f"Failed to upsert post id={msg.id} even without media_url: {e2}")
-                        STATS["last_error"] = str(e2)
-                        _supabase_circuit_breaker.record_failure()
-                        if retry_count < _max_retries:
-                            _queue_message_for_retry(msg, str(e2), retry_count)
+                for j in jobs:
+                    self._trace(j, "fetch failed", fetch_started, time.monotonic())
+                logging.error(f"Failed to fetch {len(jobs)} message(s) from chat_id={chat_id}: {e}")
+                for j in jobs:
+                    _record_job_failure(j, e)
+                    self._release(j, False)
+                continue
+            fetched = time.monotonic()
+            for j in jobs:
+                self._trace(j, "fetch", fetch_started, fetched)
+                j.msg = msgs.get(j.message_id)
+                if j.msg is None:
+                    self._release(j, False, result=None)
                 else:
-                    logging.error(f"Failed to upsert post id={msg.id}: {e}")
-                    STATS["last_error"] = str(e)
-                    _supabase_circuit_breaker.record_failure()
-                    # Queue message for retry if critical
-                    if retry_count < _max_retries:
-                        _queue_message_for_retry(msg, str(e), retry_count)
-        elif supabase:
-            logging.warning("Supabase circuit breaker is open, skipping upsert")
-            if retry_count < _max_retries:
-                _queue_message_for_retry(msg, "Supabase circuit breaker open", retry_count)
-        
-        # Force garbage collection after processing to free memory
-        if STATS["processed"] % 10 == 0:
-            gc.collect()
-    except Exception as e:
-        logging.error(f"Error processing message id={getattr(msg, 'id', '?')}: {e}", exc_info=True)
-        STATS["failed"] += 1
-        STATS["last_error"] = str(e)
-        if retry_count < _max_retries:
-            _queue_message_for_retry(msg, str(e), retry_count)
-        else:
-            logging.error(f"Message id={getattr(msg, 'id', '?')} exceeded max retries, giving up")
+                    await self._route(j, "fetch")
+        return False
+
+    async def _download(self, job: IngestJob) -> bool:
+        await _stage_download(job)
+        return True
+
+    async def _transform(self, job: IngestJob) -> bool:
+        await asyncio.to_thread(_stage_transform, job)
+        return True
+
+    async def _upload(self, job: IngestJob) -> bool:
+        await asyncio.to_thread(_stage_upload, job)
+        return True
+
+    async def _run_persist(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            started = time.monotonic()
+            for job in batch:
+                self._trace(job, "queue:persist", job.mark, started)
+            try:
+                failed = await _persist_jobs(batch)
+                _memory.note("persist")
+                ended = time.monotonic()
+                for job in batch:
+                    self._trace(job, "persist" if (job.chat_id, job.message_id) not in failed else "persist failed", started, ended)
+                now = time.time()
+                for job in batch:
+                    if not job.metadata_only and (job.chat_id, job.message_id) not in failed:
+                        END_TO_END_SECONDS.observe(now - job.msg.date.timestamp(), job.lane, job.source)
+                for job in batch:
+                    # Failed rows were queued for retry; their futures must not report success
+                    ok = (job.chat_id, job.message_id) not in failed
+                    if ok and not job.metadata_only:
+                        logging.info(f"Successfully processed message id={job.message_id}")
+                    self._finish(job, ok)
+                # After _finish, so the batch no longer counts as in flight
+                await _note_persisted([j for j in batch if not j.metadata_only and (j.chat_id, j.message_id) not in failed])
+            except Exception as e:
+                ended = time.monotonic()
+                for job in batch:
+                    if job.mark < started:
+                        self._trace(job, "persist failed", started, ended)
+                    _record_job_failure(job, e)
+                    self._finish(job, False)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+_pipeline: Optional[IngestPipeline] = None
+
+# Newest persisted message id per chat
+_last_persisted: Dict[int, int] = {}
+_last_persisted_saved = 0.0
+
+def _persisted_through(chat_id: int) -> int:
+    """The highest message id of a chat known to be persisted (0 if none)."""
+    return max(_last_persisted.get(chat_id, 0), _state.get(f"last_seen:{chat_id}") or 0)
+
+async def _note_persisted(jobs: List[IngestJob]) -> None:
+    """Move each chat's catch-up watermark (`last_seen:<chat_id>`) up after a persist.
+
+    The watermark is contiguous: every id at or below it is persisted, or
+    was given up on. Text posts persist ahead of media posts with lower ids,
+    so it stops below the lowest id still in the pipeline or the retry queue
+    instead of following the newest persisted id.
+    """
+    global _last_persisted_saved
+    for job in jobs:
+        newest = job.album["ids"][-1] if job.album else job.message_id
+        _last_persisted[job.chat_id] = max(_last_persisted.get(job.chat_id, 0), newest)
+    for chat_id in {job.chat_id for job in jobs}:
+        mark = _state.get(f"last_seen:{chat_id}") or 0
+        # Ids below the watermark are older work (backfill, reconcile) that catch-up never reaches
+        pending = [q.message_id for q in _message_queue if q.chat_id == chat_id and q.message_id > mark]
+        lowest = _pipeline.lowest_open(chat_id, mark) if _pipeline else None
+        if lowest is not None:
+            pending.append(lowest)
+        watermark = min([_last_persisted[chat_id]] + [i - 1 for i in pending])
+        if watermark > mark:
+            _state.set(f"last_seen:{chat_id}", watermark)
+    if jobs and time.monotonic() - _last_persisted_saved > _env_int("CATCHUP_SAVE_SECS", 10):
+        _last_persisted_saved = time.monotonic()
+        await _state.flush()
 
 def _queue_message_for_retry(msg: Message, error: str, current_retry: int):
     """Queue a message for retry processing."""
+    _queue_id_for_retry(msg.chat.id, msg.id, error, current_retry, message_data={
+        "id": msg.id,
+        "chat_id": msg.chat.id,
+        "date": msg.date.isoformat() if hasattr(msg, 'date') else None,
+        "caption": msg.caption,
+        "text": msg.text,
+    })
+
+def _queue_id_for_retry(chat_id: int, message_id: int, error: str, current_retry: int,
+                        message_data: Optional[Dict[str, Any]] = None):
+    """Queue a message id for retry processing (refetched from Telegram on retry)."""
     try:
         queued = QueuedMessage(
-            message_id=msg.id,
-            chat_id=msg.chat.id,
+            message_id=message_id,
+            chat_id=chat_id,
             timestamp=time.time(),
             retry_count=current_retry + 1,
             last_error=error,
-            message_data={
-                "id": msg.id,
-                "chat_id": msg.chat.id,
-                "date": msg.date.isoformat() if hasattr(msg, 'date') else None,
-                "caption": msg.caption,
-                "text": msg.text,
-            }
+            message_data=message_data or {"id": message_id, "chat_id": chat_id},
         )
         _message_queue.append(queued)
         STATS["retried"] += 1
-        logging.info(f"Queued message id={msg.id} for retry (attempt {queued.retry_count}/{_max_retries})")
+        logging.info(f"Queued message id={message_id} for retry (attempt {queued.retry_count}/{_max_retries})")
     except Exception as e:
         logging.error(f"Failed to queue message for retry: {e}")
 
@@ -590,29 +1793,53 @@ def normalize_channel(channel: str) -> str:
         return f'@{channel}'
     return channel
 
-NORMALIZED_CHANNEL = normalize_channel(TARGET_CHANNEL) if TARGET_CHANNEL else None
+CHANNELS = [normalize_channel(c) for c in TARGET_CHANNELS]
 
-# Use more flexible filter - accept both channel username and ID
-if NORMALIZED_CHANNEL:
-    if NORMALIZED_CHANNEL.lstrip('-@').isdigit():
-        # It's a numeric ID
-        chat_filter = filters.chat(int(NORMALIZED_CHANNEL.lstrip('-')))
-    else:
-        # It's a username
-        chat_filter = filters.chat(NORMALIZED_CHANNEL)
-    logging.info(f"Listening for messages from channel: {NORMALIZED_CHANNEL}")
+def _parse_channel_weights(spec: str) -> Dict[str, int]:
+    """Parse CHANNEL_WEIGHTS, e.g. "batarikh:3,otherchannel:1"."""
+    weights = {}
+    for part in spec.split(","):
+        name, _, weight = part.strip().rpartition(":")
+        if name and weight.isdigit() and int(weight) > 0:
+            weights[normalize_channel(name)] = int(weight)
+    return weights
+
+CHANNEL_WEIGHTS = _parse_channel_weights(os.getenv("CHANNEL_WEIGHTS", ""))
+
+# Chat id -> configured channel, filled in by resolve_channels() at startup
+_channels: Dict[int, str] = {}
+
+def _channel_weight(chat_id: int) -> int:
+    return CHANNEL_WEIGHTS.get(_channels.get(chat_id), 1)
+
+def _channel_stats(chat_id: int) -> Dict[str, Any]:
+    return STATS["channels"].setdefault(str(chat_id), {
+        "channel": _channels.get(chat_id),
+        "processed": 0,
+        "failed": 0,
+        "last_id": None,
+        "backfill": None,
+        "reconcile": None,
+    })
+
+# Use more flexible filter - accept both channel usernames and IDs
+if CHANNELS:
+    chat_filter = filters.chat([int(c) if c.lstrip('-').isdigit() else c for c in CHANNELS])
+    logging.info(f"Listening for messages from channels: {', '.join(CHANNELS)}")
 else:
     chat_filter = filters.channel
     logging.warning("No TARGET_CHANNEL specified, listening to all channels")
 
-# Debug handler to log all incoming messages (can be disabled in production)
-@app.on_message(filters.all)
-async def debug_all_messages(client, message):
-    """Debug handler to see all incoming messages."""
-    if hasattr(message, 'chat') and message.chat:
-        chat_title = getattr(message.chat, 'title', 'Unknown')
-        chat_username = getattr(message.chat, 'username', 'None')
-        logging.debug(f"Received message from chat: {chat_title} (@{chat_username}, id: {message.chat.id})")
+# Debug handler to log every incoming update from every chat (DEBUG_ALL_MESSAGES=1).
+# Group -1 runs it before, not instead of, the handlers below.
+if os.getenv("DEBUG_ALL_MESSAGES") == "1":
+    @app.on_message(filters.all, group=-1)
+    async def debug_all_messages(client, message):
+        """Debug handler to see all incoming messages."""
+        if hasattr(message, 'chat') and message.chat:
+            chat_title = getattr(message.chat, 'title', 'Unknown')
+            chat_username = getattr(message.chat, 'username', 'None')
+            logging.info(f"Received message from chat: {chat_title} (@{chat_username}, id: {message.chat.id})")
 
 @app.on_message(chat_filter)
 async def handle_message(client, message):
@@ -623,12 +1850,125 @@ async def handle_message(client, message):
         if hasattr(message.chat, 'username'):
             chat_info += f" username=@{message.chat.username}"
         logging.info(f"Received message id={message.id} from {chat_info}")
-        await process_message(message, retry_count=0)
-        logging.info(f"Successfully processed message id={message.id}")
+        # Only waits when the pipeline is full; processing continues in the stages
+        await _pipeline.submit(message)
     except Exception as e:
         logging.error(f"Error processing message id={getattr(message, 'id', '?')}: {e}", exc_info=True)
         STATS["failed"] += 1
 
+@app.on_edited_message(chat_filter)
+async def handle_edited_message(client, message):
+    # Diffed against the stored row in batches by edit_sync_loop
+    STATS["edits"]["seen"] += 1
+    _pending_edits[(message.chat.id, message.id)] = message
+
+# Unfiltered: deletion updates carry only the chat id, so a username-based
+# chat_filter never matches them. _channels holds the resolved ids.
+@app.on_deleted_messages()
+async def handle_deleted_messages(client, messages):
+    # Soft-deleted in batches by deletion_loop
+    for message in messages:
+        chat = getattr(message, "chat", None)
+        if chat is not None and chat.id in _channels:
+            _pending_deletes.setdefault(chat.id, set()).add(message.id)
+
+class RateGovernor:
+    """Global pacing for Telegram RPCs.
+
+    A token bucket shared by every caller (TELEGRAM_RPS, TELEGRAM_BURST), plus a
+    shared pause: when any call hits FloodWait, everyone waits it out instead
+    of piling more requests onto the same limit.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._resume_at = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._resume_at:
+                await asyncio.sleep(self._resume_at - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        FLOODWAIT_SECONDS.inc(seconds)
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+_telegram_governor = RateGovernor(
+    rate=max(0.1, float(os.getenv("TELEGRAM_RPS", "10"))),
+    burst=max(1, _env_int("TELEGRAM_BURST", 10)),
+)
+
+async def _telegram_call(fn, *args, max_retries: int = 5, **kwargs):
+    """Call a Telegram API method under the rate governor, waiting out FloodWait errors."""
+    attempts = 0
+    while True:
+        await _telegram_governor.acquire()
+        try:
+            return await fn(*args, **kwargs)
+        except FloodWait as e:
+            attempts += 1
+            if attempts > max_retries:
+                raise
+            wait_time = e.value + 1
+            logging.info(f"Rate limited, pausing Telegram calls for {wait_time} seconds...")
+            _telegram_governor.pause(wait_time)
+
+async def _get_messages_batched(chat_id, message_ids) -> List[Message]:
+    """Fetch messages by id, up to TELEGRAM_BATCH_SIZE ids per get_messages call.
+
+    Ids that no longer exist (deleted or service gaps) are dropped from the result.
+    """
+    ids = sorted(set(message_ids))
+    found: List[Message] = []
+    for i in range(0, len(ids), TELEGRAM_BATCH_SIZE):
+        chunk = ids[i:i + TELEGRAM_BATCH_SIZE]
+        msgs = await _telegram_call(app.get_messages, chat_id, chunk)
+        if not isinstance(msgs, list):
+            msgs = [msgs]
+        for m in msgs:
+            if m and not getattr(m, "empty", False):
+                found.append(m)
+    return found
+
+HISTORY_PAGE_SIZE = 100  # messages per GetHistory request, Telegram's maximum
+
+async def _history_page(chat_id: int, limit: int, offset_id: int) -> List[Message]:
+    return [msg async for msg in app.get_chat_history(chat_id, limit=limit, offset_id=offset_id)]
+
+async def _iter_history(chat_id: int, limit: int, offset_id: int = 0):
+    """get_chat_history newest to oldest (below `offset_id` if given), one
+    rate-governed request per page instead of Pyrogram's unthrottled paging."""
+    while limit > 0:
+        size = min(limit, HISTORY_PAGE_SIZE)
+        page = await _telegram_call(_history_page, chat_id, size, offset_id)
+        for msg in page:
+            yield msg
+        if len(page) < size:
+            return
+        limit -= len(page)
+        offset_id = page[-1].id
+
+async def refetch_messages(chat_id, message_ids, retry_counts: Optional[Dict[int, int]] = None) -> List[int]:
+    """Refetch messages in batches and feed them through the pipeline concurrently.
+
+    Shared by the retry queue and gap-fill paths. Returns the ids that could
+    not be fetched from Telegram.
+    """
+    futures = await _pipeline.submit_ids(chat_id, message_ids, retry_counts)
+    results = await asyncio.gather(*futures.values())
+    return [message_id for message_id, result in zip(futures, results) if result is None]
+
 async def process_retry_queue():
     """Process messages in the retry queue."""
     while not _shutdown_event.is_set():
@@ -637,62 +1977,759 @@ async def process_retry_queue():
                 await asyncio.sleep(30)  # Check every 30 seconds
                 continue
             
-            # Process oldest message
-            queued = _message_queue.popleft()
-            
-            # Check if enough time has passed since last retry
-            delay = _retry_delay_base * (2 ** queued.retry_count)
-            if time.time() - queued.timestamp < delay:
-                # Put it back at the end
-                _message_queue.append(queued)
+            # Collect every message whose backoff has elapsed; put the rest back
+            now = time.time()
+            due: Dict[int, List[QueuedMessage]] = {}
+            pending = []
+            while _message_queue:
+                queued = _message_queue.popleft()
+                delay = _retry_delay_base * (2 ** queued.retry_count)
+                if now - queued.timestamp < delay:
+                    pending.append(queued)
+                else:
+                    due.setdefault(queued.chat_id, []).append(queued)
+            _message_queue.extend(pending)
+            if not due:
                 await asyncio.sleep(10)
                 continue
             
-            logging.info(f"Retrying message id={queued.message_id} (attempt {queued.retry_count}/{_max_retries})")
-            
-            try:
-                # Fetch message from Telegram
-                msg = await app.get_messages(queued.chat_id, queued.message_id)
-                if msg:
-                    await process_message(msg, retry_count=queued.retry_count)
-                else:
-                    logging.warning(f"Could not fetch message id={queued.message_id} for retry")
-            except Exception as e:
-                logging.error(f"Retry failed for message id={queued.message_id}: {e}")
-                if queued.retry_count < _max_retries:
-                    queued.timestamp = time.time()
-                    queued.last_error = str(e)
-                    queued.retry_count += 1
-                    _message_queue.append(queued)
-                else:
-                    logging.error(f"Message id={queued.message_id} exceeded max retries, giving up")
+            for chat_id, batch in due.items():
+                logging.info(f"Retrying {len(batch)} message(s) from chat_id={chat_id}")
+                try:
+                    # One get_messages call per TELEGRAM_BATCH_SIZE ids instead of one per message
+                    missing = await refetch_messages(
+                        chat_id,
+                        [q.message_id for q in batch],
+                        retry_counts={q.message_id: q.retry_count for q in batch},
+                    )
+                    for message_id in missing:
+                        logging.warning(f"Could not fetch message id={message_id} for retry")
+                except Exception as e:
+                    logging.error(f"Retry failed for {len(batch)} message(s) from chat_id={chat_id}: {e}")
+                    for queued in batch:
+                        if queued.retry_count < _max_retries:
+                            queued.timestamp = time.time()
+                            queued.last_error = str(e)
+                            queued.retry_count += 1
+                            _message_queue.append(queued)
+                        else:
+                            logging.error(f"Message id={queued.message_id} exceeded max retries, giving up")
             
-            await asyncio.sleep(1)  # Small delay between retries
+            await asyncio.sleep(1)  # Small delay between retry rounds
         except Exception as e:
             logging.error(f"Error in retry queue processor: {e}", exc_info=True)
             await asyncio.sleep(10)
 
+# Edited messages waiting to be compared with their rows, latest edit per message
+_pending_edits: Dict[Tuple[int, int], Message] = {}
+
+_EDIT_COLUMNS = "id,created_at,content,content_hash,entities_hash,media_type,tg_file_unique_id,media,media_manifest"
+
+def _fetch_edit_rows(chat_id: int, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    rows = (
+        supabase.table("posts").select(_EDIT_COLUMNS)
+        .eq("channel_id", chat_id).in_("id", ids)
+        .execute().data or []
+    )
+    return {row["id"]: row for row in rows}
+
+def _fetch_album_row(chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+    """The merged album post that holds `message_id` as one of its parts."""
+    rows = (
+        supabase.table("posts").select(_EDIT_COLUMNS)
+        .eq("channel_id", chat_id).contains("media", [{"id": message_id}]).limit(1)
+        .execute().data or []
+    )
+    return rows[0] if rows else None
+
+def _diff_edit(msg: Message, row: Dict[str, Any]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Compare an edited message with its stored row.
+
+    Returns whether the media itself changed, and otherwise the partial row
+    to write (None when nothing we store changed).
+    """
+    media_type, _, _ = _classify_message(msg)
+    file_unique_id = getattr(_media_file(msg), "file_unique_id", None)
+    in_album = bool(row.get("media")) and bool(getattr(msg, "media_group_id", None))
+    if in_album:
+        entry = next((m for m in row["media"] if m["id"] == msg.id), {})
+        stored_type, stored_file = entry.get("type"), entry.get("file_unique_id")
+    else:
+        stored_type, stored_file = row.get("media_type"), row.get("tg_file_unique_id")
+    # Rows written before file ids were stored can only show a change of media type
+    if stored_type != media_type or (stored_file and stored_file != file_unique_id):
+        return True, None
+    content = _clean_content(msg)
+    if in_album and not content and row["id"] != msg.id:
+        # Which part carried the album caption is not stored; leave it alone
+        return False, None
+    content_hash = _text_hash(content)
+    entities_hash = _entities_hash(msg)
+    if content_hash == (row.get("content_hash") or _text_hash(row.get("content"))) and entities_hash == row.get("entities_hash"):
+        return False, None
+    return False, {
+        "id": row["id"],
+        "channel_id": msg.chat.id,
+        "created_at": row["created_at"],
+        "content": content,
+        "content_hash": content_hash,
+        "entities_hash": entities_hash,
+    }
+
+async def sync_edits() -> None:
+    """Apply buffered edits.
+
+    Caption and formatting changes become one batched partial update; only
+    messages whose media changed (or that have no row yet) go back through
+    the pipeline.
+    """
+    if not _pending_edits or not supabase or not _supabase_circuit_breaker.can_proceed():
+        return
+    edits = list(_pending_edits.values())
+    _pending_edits.clear()
+    by_chat: Dict[int, List[Message]] = {}
+    for msg in edits:
+        by_chat.setdefault(msg.chat.id, []).append(msg)
+    updates = []
+    reprocess = []
+    for chat_id, msgs in by_chat.items():
+        rows = await asyncio.to_thread(_fetch_edit_rows, chat_id, [m.id for m in msgs])
+        for msg in msgs:
+            row = rows.get(msg.id)
+            if row is None and getattr(msg, "media_group_id", None):
+                row = await asyncio.to_thread(_fetch_album_row, chat_id, msg.id)
+            if row is None:
+                reprocess.append(msg)
+                continue
+            media_changed, update = _diff_edit(msg, row)
+            if media_changed:
+                if row.get("media") and getattr(msg, "media_group_id", None):
+                    _pipeline.albums.remember(chat_id, msg.media_group_id, row)
+                reprocess.append(msg)
+            elif update:
+                updates.append(update)
+            else:
+                STATS["edits"]["unchanged"] += 1
+    if updates:
+        errors = await asyncio.to_thread(_write_rows, updates)
+        for (chat_id, post_id), error in errors.items():
+            logging.warning(f"Failed to apply edit to post id={post_id} in chat_id={chat_id}: {error}")
+            STATS["last_error"] = error
+        STATS["edits"]["updated"] += len(updates) - len(errors)
+    for msg in reprocess:
+        await _pipeline.submit(msg, source="edit")
+    STATS["edits"]["reprocessed"] += len(reprocess)
+    logging.info(f"Synced {len(edits)} edit(s): {len(updates)} updated in place, {len(reprocess)} reprocessed")
+
+async def edit_sync_loop() -> None:
+    """Flush buffered edits every EDIT_FLUSH_MS, so bursts of edits share one write."""
+    interval = _env_int("EDIT_FLUSH_MS", 2000) / 1000
+    while not _shutdown_event.is_set():
+        await asyncio.sleep(interval)
+        try:
+            await sync_edits()
+        except Exception as e:
+            logging.error(f"Edit sync failed: {e}", exc_info=True)
+
+# Deleted message ids per chat, waiting for the next batched soft delete
+_pending_deletes: Dict[int, set] = {}
+# R2 keys of deleted posts, removed by delete_objects in batches
+_r2_garbage: Deque[str] = deque()
+R2_DELETE_BATCH = 1000  # delete_objects accepts at most 1000 keys per request
+
+def _list_keys(prefix: str) -> List[str]:
+    keys: List[str] = []
+    for page in r2.get_paginator("list_objects_v2").paginate(Bucket=R2_BUCKET, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+def _post_object_keys(chat_id: int, row: Dict[str, Any]) -> List[str]:
+    """R2 keys of a post, from its media manifest or, for rows written before
+    manifests existed, by listing the original and variant prefixes of its ids."""
+    if row.get("media_manifest"):
+        return [o["key"] for o in row["media_manifest"]]
+    if row.get("media_type", "none") == "none" and not row.get("media"):
+        return []
+    keys: List[str] = []
+    ids = {row["id"]} | {m["id"] for m in row.get("media") or []}
+    for message_id in sorted(ids):
+        keys += _list_keys(f"{chat_id}/{message_id}.") + _list_keys(f"{chat_id}/{message_id}-w")
+    return keys
+
+def _key_message_id(chat_id: int, key: str) -> Optional[int]:
+    """The message id an R2 key belongs to: "<chat>/<id>.<ext>" or "<chat>/<id>-w<size>.<ext>"."""
+    m = re.match(rf"{re.escape(str(chat_id))}/(\d+)[.-]", key)
+    return int(m.group(1)) if m else None
+
+def _rows_holding(chat_id: int, ids: List[int], chunk: int = 500) -> Dict[int, Tuple[Dict[str, Any], set]]:
+    """Map message ids to the live rows holding them (runs in a thread): their
+    own row, or the album post whose `media` lists them.
+
+    Album parts follow their lead within ALBUM_MAX_PARTS ids, so only rows in
+    that reach are read. Returns {row id: (row, the ids of `ids` it holds)}.
+    """
+    wanted = set(ids)
+    candidates = sorted({i - k for i in wanted for k in range(ALBUM_MAX_PARTS) if i - k > 0})
+    held: Dict[int, set] = {}
+    for i in range(0, len(candidates), chunk):
+        rows = (
+            supabase.table("posts").select("id,media")
+            .eq("channel_id", chat_id).in_("id", candidates[i:i + chunk]).is_("deleted_at", "null")
+            .execute().data or []
+        )
+        for row in rows:
+            hit = ({row["id"]} | {m["id"] for m in row.get("media") or []}) & wanted
+            if hit:
+                held[row["id"]] = hit
+    found: Dict[int, Tuple[Dict[str, Any], set]] = {}
+    row_ids = sorted(held)
+    for i in range(0, len(row_ids), chunk):
+        rows = (
+            supabase.table("posts").select("*")
+            .eq("channel_id", chat_id).in_("id", row_ids[i:i + chunk])
+            .execute().data or []
+        )
+        for row in rows:
+            found[row["id"]] = (row, held[row["id"]])
+    return found
+
+def _remove_album_parts(chat_id: int, row: Dict[str, Any], gone: set, now: str) -> List[str]:
+    """Rewrite an album post without its deleted parts (runs in a thread).
+
+    The first remaining part becomes the lead (type, URL and size), and when
+    the post's own id was deleted it moves to that part's id. Returns the R2
+    keys of the deleted parts only.
+    """
+    remaining = [m for m in row["media"] if m["id"] not in gone]
+    manifest = row.get("media_manifest") or []
+    kept = [o for o in manifest if _key_message_id(chat_id, o["key"]) not in gone]
+    dropped = [o for o in manifest if _key_message_id(chat_id, o["key"]) in gone]
+    keys = [o["key"] for o in dropped]
+    if not manifest:
+        try:
+            for message_id in sorted(gone):
+                keys += _list_keys(f"{chat_id}/{message_id}.") + _list_keys(f"{chat_id}/{message_id}-w")
+        except Exception as e:
+            logging.warning(f"Could not list R2 objects of deleted album parts {sorted(gone)}: {e}")
+    lead = remaining[0]
+    fields = {
+        "media": remaining,
+        "media_type": lead["type"],
+        "media_url": lead["url"],
+        "width": lead["width"],
+        "height": lead["height"],
+        "media_manifest": kept or None,
+    }
+    posts = supabase.table("posts")
+    if row["id"] in gone:
+        _upsert_rows([dict(row, **fields, id=lead["id"])])
+        # The old id keeps only what was deleted, so album lookups no longer find it
+        posts.update({"deleted_at": now, "media": None, "media_manifest": dropped or None}) \
+            .eq("channel_id", chat_id).eq("id", row["id"]).execute()
+    else:
+        posts.update(fields).eq("channel_id", chat_id).eq("id", row["id"]).execute()
+    return keys
+
+def _delete_posts(chat_id: int, ids: List[int], chunk: int = 500) -> Tuple[int, List[str]]:
+    """Soft-delete the posts of deleted messages (runs in a thread).
+
+    A deleted album part is taken out of its album post, which is only
+    soft-deleted once every part is gone. Returns how many posts were marked
+    and the R2 keys of what was deleted.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    doomed: List[int] = []
+    keys: List[str] = []
+    for row, gone in _rows_holding(chat_id, ids, chunk).values():
+        media = row.get("media") or []
+        if media and any(m["id"] not in gone for m in media):
+            keys += _remove_album_parts(chat_id, row, gone, now)
+            continue
+        doomed.append(row["id"])
+        try:
+            keys += _post_object_keys(chat_id, row)
+        except Exception as e:
+            logging.warning(f"Could not list R2 objects of deleted post id={row['id']}: {e}")
+    for i in range(0, len(doomed), chunk):
+        supabase.table("posts").update({"deleted_at": now}).eq("channel_id", chat_id).in_("id", doomed[i:i + chunk]).execute()
+    return len(doomed), keys
+
+def _delete_r2_objects(keys: List[str]) -> List[str]:
+    """Delete R2 objects in batches (runs in a thread). Returns the keys that failed."""
+    failed: List[str] = []
+    for i in range(0, len(keys), R2_DELETE_BATCH):
+        chunk = keys[i:i + R2_DELETE_BATCH]
+        try:
+            res = r2.delete_objects(Bucket=R2_BUCKET, Delete={"Objects": [{"Key": k} for k in chunk], "Quiet": True})
+            errors = res.get("Errors", [])
+            for error in errors[:5]:
+                logging.warning(f"Failed to delete R2 object {error.get('Key')}: {error.get('Message')}")
+            failed += [e["Key"] for e in errors]
+        except Exception as e:
+            logging.warning(f"Failed to delete {len(chunk)} R2 object(s): {e}")
+            failed += chunk
+    return failed
+
+async def sync_deletes() -> None:
+    """Soft-delete the rows of buffered deletions, then release their storage."""
+    if _pending_deletes and supabase and _supabase_circuit_breaker.can_proceed():
+        pending = dict(_pending_deletes)
+        _pending_deletes.clear()
+        for chat_id, ids in pending.items():
+            if _pipeline is not None:
+                _pipeline.albums.forget(chat_id, ids)
+            try:
+                marked, keys = await asyncio.to_thread(_delete_posts, chat_id, sorted(ids))
+            except Exception as e:
+                logging.error(f"Failed to mark {len(ids)} deleted message(s) of chat_id={chat_id}: {e}")
+                _pending_deletes.setdefault(chat_id, set()).update(ids)
+                continue
+            _r2_garbage.extend(keys)
+            STATS["deleted"]["posts"] += marked
+            logging.info(f"Marked {marked} post(s) of chat_id={chat_id} deleted, {len(keys)} R2 object(s) queued for removal")
+    if _r2_garbage and _r2_circuit_breaker.can_proceed():
+        keys = list(_r2_garbage)
+        _r2_garbage.clear()
+        failed = await asyncio.to_thread(_delete_r2_objects, keys)
+        # Failed keys wait for the next round
+        _r2_garbage.extend(failed)
+        STATS["deleted"]["objects"] += len(keys) - len(failed)
+
+def _live_post_ids(chat_id: int, limit: int, page_size: int = 1000) -> List[int]:
+    """Message ids held by the newest `limit` live rows of a channel, album parts
+    included, in keyset pages (runs in a thread)."""
+    ids: List[int] = []
+    rows_seen = 0
+    last = None
+    while not limit or rows_seen < limit:
+        query = (
+            supabase.table("posts").select("id,media")
+            .eq("channel_id", chat_id).is_("deleted_at", "null").order("id", desc=True).limit(page_size)
+        )
+        if last is not None:
+            query = query.lt("id", last)
+        rows = query.execute().data or []
+        for row in rows[:limit - rows_seen] if limit else rows:
+            ids.append(row["id"])
+            ids.extend(m["id"] for m in row.get("media") or [] if m["id"] != row["id"])
+        rows_seen += len(rows)
+        if len(rows) < page_size:
+            break
+        last = rows[-1]["id"]
+    return ids
+
+async def probe_deletions(chat_id: int) -> int:
+    """Catch deletions Telegram never announced by probing stored ids with batched get_messages.
+
+    Checks the newest DELETE_SWEEP_IDS rows (0 checks all of them), every
+    part of an album included, and queues the message ids Telegram no longer
+    returns; sync_deletes maps them back to rows. Returns how many were found.
+    """
+    ids = await asyncio.to_thread(_live_post_ids, chat_id, _env_int("DELETE_SWEEP_IDS", 5000))
+    if not ids:
+        return 0
+    found = {m.id for m in await _get_messages_batched(chat_id, ids)}
+    gone = [i for i in ids if i not in found]
+    if gone:
+        _pending_deletes.setdefault(chat_id, set()).update(gone)
+    logging.info(f"Deletion sweep of chat_id={chat_id}: probed {len(ids)} post(s), {len(gone)} gone from the channel")
+    return len(gone)
+
+async def deletion_loop() -> None:
+    """Apply deletions every DELETE_FLUSH_MS and sweep for missed ones every
+    DELETE_SWEEP_SECS (0 disables the sweep)."""
+    interval = _env_int("DELETE_FLUSH_MS", 5000) / 1000
+    sweep_every = _env_int("DELETE_SWEEP_SECS", 21600)
+    next_sweep = time.monotonic()
+    while not _shutdown_event.is_set():
+        await asyncio.sleep(interval)
+        try:
+            if sweep_every > 0 and supabase and app.is_connected and time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + sweep_every
+                for chat_id in list(_channels):
+                    await probe_deletions(chat_id)
+            await sync_deletes()
+        except Exception as e:
+            logging.error(f"Deletion sync failed: {e}", exc_info=True)
+
+class BackfillProgress:
+    """Tracks backfill completion for checkpoints and /status.
+
+    Each partition submits ids newest to oldest, and jobs may finish out of
+    order, so a partition's checkpoint only moves down to the lowest id whose
+    newer siblings have all finished. History mode uses a single partition.
+    """
+
+    def __init__(self, chat_id: int, total: int, done: int, lowest_done: Dict[int, Optional[int]]) -> None:
+        self.chat_id = chat_id
+        self.total = total
+        self.done = done
+        self.lowest_done = dict(lowest_done)
+        self.started = time.monotonic()
+        self.done_this_run = 0
+        self._order: Dict[int, Deque[int]] = {}
+        self._finished: Dict[int, set] = {}
+        self._outstanding = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def track(self, message_id: int, future: Optional[asyncio.Future] = None, partition: int = 0) -> None:
+        """Track a submitted id; without a future the id counts as done right away."""
+        self._order.setdefault(partition, deque()).append(message_id)
+        self._finished.setdefault(partition, set())
+        self._outstanding += 1
+        self._idle.clear()
+        if future is None:
+            self._finish(partition, message_id)
+        else:
+            future.add_done_callback(lambda _f, p=partition, i=message_id: self._finish(p, i))
+
+    def _finish(self, partition: int, message_id: int) -> None:
+        order, finished = self._order[partition], self._finished[partition]
+        finished.add(message_id)
+        self.done += 1
+        self.done_this_run += 1
+        while order and order[0] in finished:
+            self.lowest_done[partition] = order.popleft()
+            finished.discard(self.lowest_done[partition])
+        self._outstanding -= 1
+        if not self._outstanding:
+            self._idle.set()
+        _channel_stats(self.chat_id)["backfill"] = self.snapshot()
+
+    async def wait(self) -> None:
+        await self._idle.wait()
+
+    def checkpoint(self, completed: bool = False) -> Dict[str, Any]:
+        # Messages finished above a still-running one are redone on resume, so don't count them
+        done = self.done - sum(len(f) for f in self._finished.values())
+        return {
+            "lowest_done": self.lowest_done.get(0),
+            "partitions": {str(p): i for p, i in self.lowest_done.items()},
+            "done": done,
+            "total": self.total,
+            "completed": completed,
+        }
+
+    def snapshot(self, state: str = "running") -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = self.done_this_run / elapsed
+        remaining = max(self.total - self.done, 0)
+        return {
+            "state": state,
+            "chat_id": self.chat_id,
+            "done": self.done,
+            "total": self.total,
+            "lowest_done": self.lowest_done,
+            "rate_per_sec": round(rate, 2),
+            "eta_secs": round(remaining / rate) if rate > 0 else None,
+        }
+
+def _partition_ids(lo: int, hi: int, partitions: int) -> List[Tuple[int, int]]:
+    """Split [lo, hi] into up to `partitions` contiguous (bottom, top) ranges."""
+    size = max(1, -(-(hi - lo + 1) // partitions))
+    return [(bottom, min(bottom + size - 1, hi)) for bottom in range(lo, hi + 1, size)]
+
+async def _backfill_history(chat_id: int, limit: int, key: str, checkpoint: Dict[str, Any], defer_media: bool) -> BackfillProgress:
+    """Walk get_chat_history newest to oldest, resuming below the checkpoint."""
+    total = min(limit, await _telegram_call(app.get_chat_history_count, chat_id))
+    done = checkpoint.get("done", 0)
+    offset_id = checkpoint.get("lowest_done") or 0
+    if offset_id:
+        logging.info(f"Resuming backfill below message id={offset_id} ({done}/{total} done)")
+    progress = BackfillProgress(chat_id, total, done, {0: checkpoint.get("lowest_done")})
+    _channel_stats(chat_id)["backfill"] = progress.snapshot()
+    
+    checkpoint_every = _env_int("BACKFILL_CHECKPOINT_EVERY", 50)
+    last_saved = progress.done
+    remaining = total - done
+    # limit=0 means "no limit" to Pyrogram, so only walk history when something is left
+    if remaining > 0:
+        async for msg in _iter_history(chat_id, remaining, offset_id):
+            progress.track(msg.id, await _pipeline.submit(msg, defer_media=defer_media, source="backfill"))
+            if progress.done - last_saved >= checkpoint_every:
+                last_saved = progress.done
+                _state.set(key, progress.checkpoint())
+                await _state.flush()
+                logging.info(f"Backfill progress: {progress.done}/{total} messages processed")
+    return progress
+
+async def _backfill_ranges(chat_id: int, limit: int, key: str, checkpoint: Dict[str, Any], defer_media: bool) -> BackfillProgress:
+    """Fetch the newest `limit` message ids by id range, partitions in parallel.
+
+    Channel ids are dense, so [last_id - limit + 1, last_id] is split into
+    BACKFILL_PARTITIONS ranges, each walked newest to oldest with
+    get_messages batches under the Telegram rate governor. Progress counts
+    ids, including ones that no longer exist.
+    """
+    if checkpoint.get("bounds"):
+        bounds = [tuple(b) for b in checkpoint["bounds"]]
+    else:
+        last_id = 0
+        async for msg in _iter_history(chat_id, 1):
+            last_id = msg.id
+        bounds = _partition_ids(max(1, last_id - limit + 1), last_id, _env_int("BACKFILL_PARTITIONS", 4)) if last_id else []
+    total = sum(top - bottom + 1 for bottom, top in bounds)
+    lowest = {int(p): i for p, i in (checkpoint.get("partitions") or {}).items()}
+    progress = BackfillProgress(chat_id, total, checkpoint.get("done", 0), lowest)
+    _channel_stats(chat_id)["backfill"] = progress.snapshot()
+    if lowest:
+        logging.info(f"Resuming range backfill ({progress.done}/{total} ids done)")
+
+    async def save() -> None:
+        _state.set(key, dict(progress.checkpoint(), bounds=bounds))
+        await _state.flush()
+
+    async def run_partition(partition: int, bottom: int, top: int) -> None:
+        start = (lowest.get(partition) or top + 1) - 1
+        for batch_top in range(start, bottom - 1, -TELEGRAM_BATCH_SIZE):
+            ids = list(range(batch_top, max(bottom, batch_top - TELEGRAM_BATCH_SIZE + 1) - 1, -1))
+            msgs = {m.id: m for m in await _get_messages_batched(chat_id, ids)}
+            for message_id in ids:
+                msg = msgs.get(message_id)
+                future = await _pipeline.submit(msg, defer_media=defer_media, source="backfill") if msg else None
+                progress.track(message_id, future, partition)
+            await save()
+            logging.info(f"Backfill progress: {progress.done}/{total} ids (partition {partition} at id={batch_top})")
+
+    await save()
+    await asyncio.gather(*(run_partition(p, bottom, top) for p, (bottom, top) in enumerate(bounds)))
+    return progress
+
 async def backfill() -> None:
-    """Backfill historical messages from the channel."""
+    """Backfill every configured channel concurrently (see backfill_channel)."""
+    await asyncio.gather(*(backfill_channel(chat_id) for chat_id in list(_channels)))
+
+async def backfill_channel(chat_id: int) -> None:
+    """Backfill historical messages from a channel, resuming from the last checkpoint.
+
+    BACKFILL_MODE=history (default) walks get_chat_history; BACKFILL_MODE=ranges
+    fetches id ranges in parallel partitions. The checkpoint (per partition,
+    the lowest id below which nothing has been done yet) is kept in
+    WorkerState under `backfill:<chat_id>` or `backfill-ranges:<chat_id>`.
+    Set BACKFILL_RESET=1 to start over.
+
+    BACKFILL_MEDIA=defer writes rows only (caption, type, dimensions, Telegram
+    file ids, media_status="pending"); hydration_loop fills in the media later.
+    """
     try:
         limit = int(os.getenv("BACKFILL_LIMIT", "0"))
     except (ValueError, TypeError) as e:
         logging.warning(f"Invalid BACKFILL_LIMIT, using 0: {e}")
         limit = 0
-    if not TARGET_CHANNEL or limit <= 0:
-        logging.info("Backfill skipped: no limit set or no target channel")
+    if limit <= 0:
+        logging.info("Backfill skipped: no limit set")
         return
-    count = 0
+    mode = os.getenv("BACKFILL_MODE", "history")
+    defer_media = os.getenv("BACKFILL_MEDIA") == "defer"
+    progress: Optional[BackfillProgress] = None
+    key = f"backfill-ranges:{chat_id}" if mode == "ranges" else f"backfill:{chat_id}"
     try:
-        async for msg in app.get_chat_history(TARGET_CHANNEL, limit=limit):
-            await process_message(msg)
-            count += 1
-            if count % 50 == 0:
-                logging.info(f"Backfill progress: {count}/{limit} messages processed")
-        logging.info(f"Backfill completed: {count} messages processed")
+        checkpoint = None if os.getenv("BACKFILL_RESET") == "1" else _state.get(key)
+        if checkpoint and checkpoint.get("completed"):
+            logging.info(f"Backfill of chat_id={chat_id} skipped: already completed ({checkpoint.get('done')} messages)")
+            return
+        if mode == "ranges":
+            progress = await _backfill_ranges(chat_id, limit, key, checkpoint or {}, defer_media)
+        else:
+            progress = await _backfill_history(chat_id, limit, key, checkpoint or {}, defer_media)
+        await progress.wait()
+        _state.set(key, dict(_state.get(key) or {}, **progress.checkpoint(completed=True)))
+        await _state.flush()
+        _channel_stats(chat_id)["backfill"] = progress.snapshot("completed")
+        logging.info(f"Backfill of chat_id={chat_id} completed: {progress.done_this_run} processed this run ({progress.done}/{progress.total} total)")
     except Exception as e:
-        logging.error(f"Backfill failed: {e}")
-        raise
+        logging.error(f"Backfill of chat_id={chat_id} failed: {e}")
+        if progress is not None:
+            _state.set(key, dict(_state.get(key) or {}, **progress.checkpoint()))
+            await _state.flush()
+            _channel_stats(chat_id)["backfill"] = progress.snapshot("failed")
+
+def _pending_media_ids(limit: int) -> Dict[int, List[int]]:
+    """Message ids of rows waiting for media: pending after a deferred backfill,
+    or sent to repair by verify_media.py. Albums expand to all their parts."""
+    rows = (
+        supabase.table("posts").select("channel_id,id,media")
+        .in_("media_status", ["pending", "repair"]).is_("deleted_at", "null").order("id", desc=True).limit(limit)
+        .execute().data or []
+    )
+    by_channel: Dict[int, List[int]] = {}
+    for row in rows:
+        ids = by_channel.setdefault(row["channel_id"], [])
+        ids.append(row["id"])
+        ids.extend(m["id"] for m in row.get("media") or [] if m["id"] != row["id"])
+    return by_channel
+
+def _set_media_status(channel_id: int, ids: List[int], status: str) -> None:
+    supabase.table("posts").update({"media_status": status}).eq("channel_id", channel_id).in_("id", ids).execute()
+
+async def hydrate_media() -> int:
+    """Run the media stages for one batch of rows left pending by a deferred backfill.
+
+    Rows are taken newest first, HYDRATE_BATCH_SIZE at a time, and refetched
+    through the pipeline's batched fetch stage. Objects are written over
+    whatever is stored: pending rows have nothing in R2 yet, and rows sent to
+    repair keep their damaged copies until the new ones replace them. Returns
+    how many posts got their media, so a batch that keeps failing is not
+    retried back to back.
+    """
+    pending = await asyncio.to_thread(_pending_media_ids, _env_int("HYDRATE_BATCH_SIZE", 50))
+    total = 0
+    for chat_id, ids in pending.items():
+        futures = await _pipeline.submit_ids(chat_id, ids, early_metadata=False, overwrite=True, source="hydration")
+        results = await asyncio.gather(*futures.values())
+        gone = [i for i, r in zip(futures, results) if r is None]
+        if gone:
+            # Deleted from the channel since the row was written; stop retrying them
+            await asyncio.to_thread(_set_media_status, chat_id, gone, "missing")
+        hydrated = sum(1 for r in results if r is True)
+        STATS["hydrated"] += hydrated
+        total += hydrated
+        logging.info(f"Hydrated media for {hydrated}/{len(ids)} post(s) of chat_id={chat_id}, {len(gone)} gone from the channel")
+    return total
+
+async def hydration_loop() -> None:
+    """Keep hydrating pending media; back off to HYDRATE_INTERVAL_SECS when idle
+    or when a whole batch failed (0 disables it)."""
+    interval = _env_int("HYDRATE_INTERVAL_SECS", 300)
+    if interval <= 0 or not supabase:
+        return
+    pause = _env_int("HYDRATE_PAUSE_SECS", 2)
+    while not _shutdown_event.is_set():
+        try:
+            if app.is_connected and await hydrate_media():
+                await asyncio.sleep(pause)
+                continue
+        except Exception as e:
+            logging.error(f"Media hydration failed: {e}", exc_info=True)
+        await asyncio.sleep(interval)
+
+def _merge_ranges(ranges: List[List[int]]) -> List[List[int]]:
+    """Sort and merge inclusive [start, end] id ranges, joining adjacent ones."""
+    merged: List[List[int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def _ids_to_ranges(ids) -> List[List[int]]:
+    return _merge_ranges([[i, i] for i in ids])
+
+def _uncovered_ids(ranges: List[List[int]], lo: int, hi: int):
+    """Yield ids in [lo, hi] that no range in (merged) `ranges` covers, newest first."""
+    cursor = hi
+    for start, end in reversed(ranges):
+        if end < lo:
+            break
+        if start > cursor:
+            continue
+        yield from range(cursor, end, -1)
+        cursor = start - 1
+    yield from range(cursor, lo - 1, -1)
+
+def _fetch_post_id_ranges(channel_id: int, lo: int = 1, page_size: int = 1000) -> List[List[int]]:
+    """Read the post ids of a channel from `lo` up in keyset order, compressed to
+    ranges (runs in a thread).
+
+    Album parts merged into another post's `media` list count as present,
+    including parts of an album whose lead is just below `lo`.
+    """
+    ranges: List[List[int]] = []
+    parts: List[int] = []
+    last = max(0, lo - ALBUM_MAX_PARTS)
+    while True:
+        rows = (
+            supabase.table("posts").select("id,media")
+            .eq("channel_id", channel_id).gt("id", last).order("id").limit(page_size)
+            .execute().data or []
+        )
+        for row in rows:
+            i = row["id"]
+            if ranges and i == ranges[-1][1] + 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+            parts.extend(m["id"] for m in row.get("media") or [] if m["id"] != i)
+        if len(rows) < page_size:
+            return _merge_ranges(ranges + _ids_to_ranges(parts)) if parts else ranges
+        last = rows[-1]["id"]
+
+_gap_first_seen: Dict[Tuple[int, int], float] = {}
+
+async def reconcile_gaps(chat_id: int) -> Dict[str, Any]:
+    """Find channel message ids missing from `posts` and refetch only those.
+
+    The DB side is read as compact id ranges; ids Telegram reports as gone
+    (deleted, service messages) are remembered in WorkerState so later runs
+    skip them. Ids waiting in the retry queue are left to it.
+
+    Only the newest RECONCILE_LOOKBACK_IDS ids (default 1000) are checked, and
+    only their rows are read, so an archive that was backfilled partially on
+    purpose stays that way and each run costs the same however large it grows.
+    RECONCILE_LOOKBACK_IDS=0 checks the whole history, which refetches every
+    missing message (media included), RECONCILE_MAX_IDS per run.
+    """
+    last_id = 0
+    async for msg in _iter_history(chat_id, 1):
+        last_id = msg.id
+    if not last_id:
+        return {}
+    lookback = _env_int("RECONCILE_LOOKBACK_IDS", 1000)
+    lo = max(1, last_id - lookback + 1) if lookback > 0 else 1
+    
+    key = f"reconcile:{chat_id}"
+    saved = _state.get(key) or {}
+    empty = saved.get("empty", [])
+    covered = await asyncio.to_thread(_fetch_post_id_ranges, chat_id, lo)
+    queued = [[q.message_id, q.message_id] for q in _message_queue if q.chat_id == chat_id]
+    missing = list(_uncovered_ids(_merge_ranges(covered + empty + queued), lo, last_id))
+    
+    now = time.time()
+    for message_id in missing:
+        _gap_first_seen.setdefault((chat_id, message_id), now)
+    max_ids = _env_int("RECONCILE_MAX_IDS", 5000)
+    todo = missing[:max_ids]
+    if todo:
+        logging.info(f"Reconciliation: {len(missing)} id(s) of chat_id={chat_id} missing from posts, refetching {len(todo)}")
+    
+    futures = await _pipeline.submit_ids(chat_id, todo, source="reconcile")
+    results = dict(zip(futures, await asyncio.gather(*futures.values())))
+    gone = [i for i, r in results.items() if r is None]
+    healed = [i for i, r in results.items() if r is True]
+    heal_times = [time.time() - _gap_first_seen.pop((chat_id, i)) for i in healed + gone if (chat_id, i) in _gap_first_seen]
+    
+    _state.set(key, {"empty": _merge_ranges(empty + _ids_to_ranges(gone))})
+    await _state.flush()
+    report = {
+        "last_run": datetime.now(timezone.utc).isoformat(),
+        "range": [lo, last_id],
+        "gap_count": len(missing),
+        "healed": len(healed),
+        "gone": len(gone),
+        "failed": len(todo) - len(healed) - len(gone),
+        "open_gaps": len(missing) - len(healed) - len(gone),
+        "time_to_heal_max_secs": round(max(heal_times), 1) if heal_times else None,
+        "time_to_heal_avg_secs": round(sum(heal_times) / len(heal_times), 1) if heal_times else None,
+    }
+    _channel_stats(chat_id)["reconcile"] = report
+    logging.info(f"Reconciliation of chat_id={chat_id} finished: {report}")
+    return report
+
+async def reconciliation_loop() -> None:
+    """Run gap reconciliation every RECONCILE_INTERVAL_SECS (0 disables it)."""
+    interval = _env_int("RECONCILE_INTERVAL_SECS", 3600)
+    if interval <= 0 or not supabase:
+        return
+    while not _shutdown_event.is_set():
+        for chat_id in list(_channels):
+            try:
+                if app.is_connected:
+                    await reconcile_gaps(chat_id)
+            except Exception as e:
+                logging.error(f"Reconciliation of chat_id={chat_id} failed: {e}", exc_info=True)
+        await asyncio.sleep(interval)
 
 async def reconnect_client(max_retries=10, base_delay=5):
     """Reconnect Telegram client with exponential backoff."""
@@ -742,6 +2779,58 @@ async def reconnect_client(max_retries=10, base_delay=5):
             await asyncio.sleep(delay)
     return False
 
+async def catch_up(chat_id: int) -> int:
+    """Feed messages posted since the last persisted id into the pipeline.
+
+    Pyrogram does not replay channel updates missed while disconnected, so
+    after every (re)connect the history is paged from the newest message
+    down to the last one we persisted. Returns the number of messages queued.
+    """
+    last_seen = _state.get(f"last_seen:{chat_id}")
+    if not last_seen:
+        logging.info(f"Catch-up of chat_id={chat_id} skipped: no persisted message id yet")
+        return 0
+    _last_persisted[chat_id] = max(_last_persisted.get(chat_id, 0), last_seen)
+    max_messages = _env_int("CATCHUP_MAX_MESSAGES", 5000)
+    missed = []
+    async for msg in _iter_history(chat_id, max_messages):
+        if msg.id <= last_seen:
+            break
+        missed.append(msg)
+    else:
+        if len(missed) >= max_messages:
+            logging.warning(f"Catch-up hit CATCHUP_MAX_MESSAGES={max_messages}; older gaps are left to reconciliation")
+    # Oldest first, so per-chat ordering in the pipeline follows the channel
+    for msg in reversed(missed):
+        await _pipeline.submit(msg, source="catchup")
+    logging.info(f"Catch-up queued {len(missed)} message(s) of chat_id={chat_id} newer than id={last_seen}")
+    return len(missed)
+
+async def catch_up_all() -> None:
+    for chat_id in list(_channels):
+        try:
+            await catch_up(chat_id)
+        except Exception as e:
+            logging.error(f"Catch-up of chat_id={chat_id} failed: {e}")
+
+async def resolve_channels() -> None:
+    """Resolve the configured channels to chat ids and check access to each."""
+    for channel in CHANNELS:
+        try:
+            chat = await app.get_chat(channel)
+            _channels[chat.id] = channel
+            _channel_stats(chat.id)["channel"] = channel
+            logging.info(f"Successfully connected to channel: {chat.title} (id: {chat.id}, weight: {_channel_weight(chat.id)})")
+            # Check if we're a member
+            try:
+                member = await app.get_chat_member(channel, "me")
+                logging.info(f"Channel membership status for {channel}: {member.status}")
+            except Exception as e:
+                logging.warning(f"Could not verify channel membership for {channel}: {e}")
+        except Exception as e:
+            logging.error(f"Failed to access channel {channel}: {e}")
+            logging.error("Make sure the account is a member of the channel and has proper permissions")
+
 async def connection_monitor():
     """Monitor connection and automatically reconnect if needed."""
     while not _shutdown_event.is_set():
@@ -750,14 +2839,20 @@ async def connection_monitor():
             if not app.is_connected:
                 logging.warning("Connection lost, attempting to reconnect...")
                 STATS["connected"] = False
-                await reconnect_client()
+                if await reconnect_client():
+                    await catch_up_all()
         except Exception as e:
             logging.error(f"Error in connection monitor: {e}", exc_info=True)
             await asyncio.sleep(60)
 
 async def main() -> None:
     """Main async entry point with automatic reconnection."""
-    start_status_server()
+    global _pipeline
+    start_tracemalloc()
+    await _status_server.start()
+    _pipeline = IngestPipeline()
+    _pipeline.start()
+    _loop_monitor.start()
     
     # Setup signal handlers for graceful shutdown
     def signal_handler(signum, frame):
@@ -776,19 +2871,7 @@ async def main() -> None:
         logging.info("Telegram client started")
         
         # Verify channel access
-        if NORMALIZED_CHANNEL:
-            try:
-                chat = await app.get_chat(NORMALIZED_CHANNEL)
-                logging.info(f"Successfully connected to channel: {chat.title} (id: {chat.id})")
-                # Check if we're a member
-                try:
-                    member = await app.get_chat_member(NORMALIZED_CHANNEL, "me")
-                    logging.info(f"Channel membership status: {member.status}")
-                except Exception as e:
-                    logging.warning(f"Could not verify channel membership: {e}")
-            except Exception as e:
-                logging.error(f"Failed to access channel {NORMALIZED_CHANNEL}: {e}")
-                logging.error("Make sure the account is a member of the channel and has proper permissions")
+        await resolve_channels()
         
         # Start background tasks
         async def heartbeat() -> None:
@@ -800,6 +2883,9 @@ async def main() -> None:
                 logging.info(f"Heartbeat connected={STATS['connected']} processed={STATS['processed']} failed={STATS['failed']} queue={len(_message_queue)} last_id={STATS['last_id']}")
                 await asyncio.sleep(interval)
         
+        await asyncio.to_thread(_state.load)
+        await catch_up_all()
+        
         # Run backfill if enabled
         if os.getenv("BACKFILL_ON_START") == "1":
             try:
@@ -811,6 +2897,10 @@ async def main() -> None:
         heartbeat_task = asyncio.create_task(heartbeat())
         connection_monitor_task = asyncio.create_task(connection_monitor())
         retry_queue_task = asyncio.create_task(process_retry_queue())
+        reconcile_task = asyncio.create_task(reconciliation_loop())
+        hydration_task = asyncio.create_task(hydration_loop())
+        edit_sync_task = asyncio.create_task(edit_sync_loop())
+        deletion_task = asyncio.create_task(deletion_loop())
         
         # Keep running until shutdown
         try:
@@ -828,9 +2918,13 @@ async def main() -> None:
         heartbeat_task.cancel()
         connection_monitor_task.cancel()
         retry_queue_task.cancel()
+        reconcile_task.cancel()
+        hydration_task.cancel()
+        edit_sync_task.cancel()
+        deletion_task.cancel()
         
         # Wait for tasks to finish
-        for task in [heartbeat_task, connection_monitor_task, retry_queue_task]:
+        for task in [heartbeat_task, connection_monitor_task, retry_queue_task, reconcile_task, hydration_task, edit_sync_task, deletion_task]:
             try:
                 await task
             except asyncio.CancelledError:
@@ -849,6 +2943,9 @@ async def main() -> None:
     finally:
         STATS["connected"] = False
         _shutdown_event.set()
+        await _pipeline.stop()
+        _loop_monitor.stop()
+        await _status_server.stop()
         try:
             if app.is_connected:
                 await app.stop()
@@ -857,6 +2954,7 @@ async def main() -> None:
             logging.error(f"Error stopping client: {e}")
 
 if __name__ == "__main__":
+    require_env(TELEGRAM_ENV + R2_ENV)
     logging.info("Starting Telegram worker...")
     max_restarts = int(os.getenv("MAX_RESTARTS", "10"))
     restart_count = 0
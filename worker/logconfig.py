@@ -0,0 +1,180 @@
+"""
+Logging setup for the worker: JSON lines written by a background thread.
+
+Records are handed to a QueueHandler and written by a QueueListener
+thread, so a log call on the event loop costs one queue put instead of a
+write to a pipe. Records below WARNING go to stdout and the rest to
+stderr (Railway marks everything on stderr as an error).
+
+Repetitive INFO/DEBUG lines are rate limited per call site: at most
+LOG_RATE_LIMIT records per LOG_RATE_WINDOW_SECS from one line of code, and
+the next record that gets through says how many were dropped. Pass
+extra={"rate_key": ...} to limit on something other than the call site.
+Warnings and errors are never dropped.
+
+Process pools pass setup_process_logging as their initializer: a forked
+child inherits the queue handler but not the listener thread, so nothing
+it logged would be written.
+
+Environment:
+    LOG_LEVEL             INFO (default), DEBUG, WARNING, ...
+    LOG_FORMAT            json (default) or text
+    LOG_RATE_LIMIT        records per key per window, 0 disables (default 20)
+    LOG_RATE_WINDOW_SECS  window length (default 10)
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "rate_key", "suppressed"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("[%(asctime)s] %(levelname)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if getattr(record, "suppressed", 0):
+            line += f" ({record.suppressed} similar line(s) suppressed)"
+        return line
+
+class RateLimitFilter(logging.Filter):
+    """Let at most `limit` records per key through in each `window` seconds (below WARNING only)."""
+
+    def __init__(self, limit: int, window: float) -> None:
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        # key -> [window start, records let through, records dropped]
+        self._keys: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, "rate_key", None) or (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None or now - state[0] >= self.window:
+                dropped = state[2] if state else 0
+                if len(self._keys) > 10000:
+                    self._keys.clear()
+                self._keys[key] = [now, 1, 0]
+                if dropped:
+                    record.suppressed = dropped
+                return True
+            if state[1] < self.limit:
+                state[1] += 1
+                return True
+            state[2] += 1
+            return False
+
+class _Below(logging.Filter):
+    def __init__(self, level: int) -> None:
+        super().__init__()
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno < self.level
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback now (the listener formats later, on
+        # another thread) but keep them apart, so the JSON has an "exc" field
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+_listener: Optional[QueueListener] = None
+
+def _level() -> int:
+    return getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+
+def _stream_handlers() -> Tuple[logging.Handler, logging.Handler]:
+    """stdout for records below WARNING, stderr for the rest."""
+    formatter = TextFormatter() if os.getenv("LOG_FORMAT", "json").lower() == "text" else JsonFormatter()
+    out = logging.StreamHandler(sys.stdout)
+    out.addFilter(_Below(logging.WARNING))
+    err = logging.StreamHandler(sys.stderr)
+    err.setLevel(logging.WARNING)
+    for handler in (out, err):
+        handler.setFormatter(formatter)
+    return out, err
+
+def setup_logging() -> None:
+    """Route the root logger through the queue; safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+    level = _level()
+    try:
+        limit = int(os.getenv("LOG_RATE_LIMIT", "20"))
+        window = float(os.getenv("LOG_RATE_WINDOW_SECS", "10"))
+    except ValueError:
+        limit, window = 20, 10.0
+
+    out, err = _stream_handlers()
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(RateLimitFilter(limit, window))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(records, out, err, respect_handler_level=True)
+    _listener.start()
+    # Flush what is still queued on exit
+    atexit.register(_listener.stop)
+
+def setup_process_logging() -> None:
+    """Process pool initializer: write straight to stdout/stderr.
+
+    Pool processes log little, so they skip the queue and rate limits.
+    """
+    global _listener
+    # An inherited listener belongs to the parent; its thread does not exist here
+    _listener = None
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    for handler in _stream_handlers():
+        root.addHandler(handler)
+    root.setLevel(_level())
@@ -0,0 +1,134 @@
+"""
+Event-loop lag sampling and blocking-call detection for the worker.
+
+A sampler task sleeps for a fixed interval and records how late it wakes
+up: that drift is how long every other callback on the loop waited too
+(Telegram pings included). A watchdog thread watches the sampler's
+heartbeat; when the loop has not come back for longer than the block
+threshold it grabs the loop thread's stack with sys._current_frames(), so
+the log says which coroutine or call was holding the loop, not just that
+something was.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from metrics import Counter, Histogram
+
+LOOP_LAG_SECONDS = Histogram(
+    "batarikh_event_loop_lag_seconds", "How late the event loop ran a scheduled wakeup",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_BLOCKS = Counter("batarikh_event_loop_blocked_total", "Times the event loop was blocked past the threshold")
+
+def _format_stack(frame) -> str:
+    # asyncio's own frames (run_forever, _run_once, Handle._run) are the same every time
+    entries = [e for e in traceback.extract_stack(frame, limit=30) if f"{os.sep}asyncio{os.sep}" not in e.filename]
+    return "".join(traceback.format_list(entries))
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.25, block_threshold: float = 0.5, window: int = 240) -> None:
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self._lags: deque = deque(maxlen=window)  # recent drift samples, seconds
+        self._blocks: deque = deque(maxlen=20)  # recent stalls, newest last
+        self._max_lag = 0.0
+        self._block_count = 0
+        self._beat = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._stall: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stop: Optional[threading.Event] = None
+
+    def start(self) -> None:
+        """Start sampling the running loop, plus the watchdog thread."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        # A fresh event per start, so a watchdog from an earlier loop can't miss its stop
+        self._stop = threading.Event()
+        self._task = asyncio.create_task(self._sample())
+        threading.Thread(target=self._watch, args=(self._stop,), name="loop-watchdog", daemon=True).start()
+        logging.info(f"Event loop monitor started (interval={self.interval * 1000:.0f}ms, "
+                     f"block threshold={self.block_threshold * 1000:.0f}ms)")
+
+    def stop(self) -> None:
+        if self._stop:
+            self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    def _running_task(self) -> Optional[str]:
+        """The task the loop is running right now, read from outside the loop thread."""
+        try:
+            task = asyncio.tasks._current_tasks.get(self._loop)
+        except Exception:
+            return None
+        if task is None:
+            return None  # a plain callback, not a coroutine step
+        return f"{task.get_name()} ({task.get_coro().__qualname__})"
+
+    async def _sample(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            with self._lock:
+                self._beat = now
+                self._lags.append(lag)
+                self._max_lag = max(self._max_lag, lag)
+                stall, self._stall = self._stall, None
+                if stall is not None:
+                    # The loop is back: the stall's full length is now known
+                    stall["seconds"] = round(lag, 3)
+            if stall is not None:
+                logging.warning(f"Event loop was blocked for {stall['seconds']:.2f}s by task {stall['task']}:\n{stall['stack']}")
+
+    def _watch(self, stop: threading.Event) -> None:
+        while not stop.wait(self.block_threshold / 2):
+            with self._lock:
+                behind = time.monotonic() - self._beat - self.interval
+                if behind < self.block_threshold or self._stall is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = _format_stack(frame) if frame else "(loop thread not found)"
+                self._stall = {
+                    "at": datetime.now(timezone.utc).isoformat(),
+                    "seconds": round(behind, 3),
+                    "task": self._running_task(),
+                    "stack": stack,
+                }
+                self._blocks.append(self._stall)
+                self._block_count += 1
+            LOOP_BLOCKS.inc()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lags = sorted(self._lags)
+            blocks: List[Dict[str, Any]] = [dict(b) for b in self._blocks]
+            max_lag = self._max_lag
+            block_count = self._block_count
+            current = time.monotonic() - self._beat - self.interval
+
+        def pct(p: float) -> Optional[float]:
+            return round(lags[min(len(lags) - 1, int(p * len(lags)))] * 1000, 1) if lags else None
+
+        return {
+            "lag_ms": {"p50": pct(0.5), "p99": pct(0.99), "max_recent": round(lags[-1] * 1000, 1) if lags else None,
+                       "max": round(max_lag * 1000, 1)},
+            "blocked_now_ms": round(current * 1000) if current >= self.block_threshold else 0,
+            "blocks": block_count,
+            "recent_blocks": blocks[-5:],
+        }
@@ -0,0 +1,139 @@
+"""
+Process memory readings for the worker: RSS, peaks and tracemalloc.
+
+RSS is read from /proc/self/statm (a few microseconds), cheap enough to
+sample at every stage boundary. The peaks recorded there show which stage
+was running when memory climbed. RSS_BUDGET_MB gives the worker a ceiling
+to hold new media work at. When it is reached, free heap pages are
+handed back to the OS with malloc_trim: RSS rarely shrinks after a peak,
+and a gc.collect() pause does not change that.
+
+tracemalloc is off unless asked for (TRACEMALLOC=1, or the first
+snapshot taken on /debug/memory/snapshot), since tracing every
+allocation slows the worker down.
+"""
+
+import os
+import sys
+import ctypes
+import logging
+import threading
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_MB = 1024 * 1024
+
+def rss_bytes() -> int:
+    """Current resident set size (falls back to the peak where /proc is missing)."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def trim() -> bool:
+    """Return free heap memory to the OS (glibc only); True if anything was released."""
+    try:
+        return bool(ctypes.CDLL("libc.so.6").malloc_trim(0))
+    except (OSError, AttributeError):
+        return False
+
+class MemoryWatch:
+    def __init__(self, budget_mb: int = 0) -> None:
+        self.budget = budget_mb * _MB  # 0: no budget
+        self.stage_peaks: Dict[str, int] = {}
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+
+    def note(self, stage: str) -> int:
+        """Record the RSS at the end of a stage step; returns it."""
+        rss = rss_bytes()
+        if rss > self.stage_peaks.get(stage, 0):
+            self.stage_peaks[stage] = rss
+        return rss
+
+    def over_budget(self) -> bool:
+        return bool(self.budget) and rss_bytes() > self.budget
+
+    def summary(self) -> Dict[str, Any]:
+        out = {
+            "rss_mb": round(rss_bytes() / _MB, 1),
+            "peak_rss_mb": round(peak_rss_bytes() / _MB, 1),
+            "budget_mb": round(self.budget / _MB) if self.budget else None,
+            "stage_peak_rss_mb": {k: round(v / _MB, 1) for k, v in self.stage_peaks.items()},
+            "tracemalloc": tracemalloc.is_tracing(),
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            out["traced_mb"] = round(current / _MB, 1)
+            out["traced_peak_mb"] = round(peak / _MB, 1)
+        return out
+
+    @staticmethod
+    def _take() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def snapshot(self, top: int = 25, frames: int = 1) -> Dict[str, Any]:
+        """Take a snapshot (starting tracemalloc if needed) and keep it as the diff baseline.
+
+        Slow on a large heap; call it from a thread.
+        """
+        with self._lock:
+            started = False
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                started = True
+            self._baseline = self._take()
+            stats = self._baseline.statistics("traceback" if frames > 1 else "lineno")
+            return {
+                "started_tracing": started,
+                "total_mb": round(sum(s.size for s in stats) / _MB, 2),
+                "top": [_stat(s) for s in stats[:top]],
+            }
+
+    def diff(self, top: int = 25, rebase: bool = False) -> Dict[str, Any]:
+        """Allocation growth since the baseline snapshot, largest first."""
+        with self._lock:
+            if not tracemalloc.is_tracing() or self._baseline is None:
+                raise RuntimeError("no baseline: take /debug/memory/snapshot first")
+            current = self._take()
+            stats = current.compare_to(self._baseline, "lineno")
+            if rebase:
+                self._baseline = current
+            return {
+                "growth_mb": round(sum(s.size_diff for s in stats) / _MB, 2),
+                "top": [dict(_stat(s), size_diff_kb=round(s.size_diff / 1024, 1), count_diff=s.count_diff)
+                        for s in stats[:top]],
+            }
+
+    def stop_tracing(self) -> None:
+        with self._lock:
+            self._baseline = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+def _stat(stat) -> Dict[str, Any]:
+    frames: List[str] = [f"{f.filename}:{f.lineno}" for f in stat.traceback]
+    return {"where": frames[0] if len(frames) == 1 else frames, "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+
+def start_from_env() -> None:
+    if os.getenv("TRACEMALLOC") == "1" and not tracemalloc.is_tracing():
+        tracemalloc.start(int(os.getenv("TRACEMALLOC_FRAMES", "1")))
+        logging.info("tracemalloc started")
@@ -0,0 +1,80 @@
+"""
+In-process profiling for the worker, for hosts where py-spy can't attach.
+
+`sample()` is a sampling profiler: a thread reads every other thread's
+stack through sys._current_frames() `hz` times a second and counts
+identical stacks. `collapse()` turns the counts into the collapsed-stack
+format (frame;frame;frame count) that flamegraph.pl, speedscope and
+Inferno read. The event loop thread shows coroutine steps on top of the
+asyncio frames; time spent idle shows up under select().
+
+`profiled()` and `pstats_text()` back the cProfile mode: each part of a
+message's processing runs under its own cProfile.Profile (one per thread,
+as cProfile requires) and the results are merged into one report.
+"""
+
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+SORT_KEYS = frozenset(pstats.Stats.sort_arg_dict_default)
+
+def _label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+def sample(seconds: float, hz: int = 100, threads: Optional[Dict[int, str]] = None) -> Tuple[Counter, int]:
+    """Sample stacks for `seconds`; returns (stack counts, samples taken).
+
+    `threads` limits sampling to these thread ids (mapped to the names used
+    as the root frame); by default every thread but the sampler is sampled.
+    Blocks the calling thread for the whole duration.
+    """
+    me = threading.get_ident()
+    interval = 1 / hz
+    counts: Counter = Counter()
+    taken = 0
+    deadline = time.monotonic() + seconds
+    next_tick = time.monotonic()
+    while time.monotonic() < deadline:
+        names = threads or {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or ident not in names:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names[ident])
+            counts[";".join(reversed(stack))] += 1
+        taken += 1
+        next_tick += interval
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+    return counts, taken
+
+def collapse(counts: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def profiled(fn: Callable, profiles: Optional[List[cProfile.Profile]]) -> Callable:
+    """`fn` run under a fresh cProfile.Profile appended to `profiles` (or `fn` itself if None)."""
+    if profiles is None:
+        return fn
+
+    def run(*args, **kwargs):
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        return profile.runcall(fn, *args, **kwargs)
+    return run
+
+def pstats_text(profiles: List[cProfile.Profile], sort: str = "cumulative", limit: int = 40) -> str:
+    out = io.StringIO()
+    stats = pstats.Stats(profiles[0], stream=out)
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
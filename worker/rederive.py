@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Re-derive image variants for the existing archive after IMAGE_SIZES,
+ENABLE_WEBP, ENABLE_AVIF or ENABLE_RESIZED_ORIGINALS change.
+
+New posts pick up changed image settings on their own; this walks every
+image post, works out which variants the current settings call for but the
+bucket does not have, and renders only those. Originals are read back from
+R2, not Telegram, so it needs no session and does not touch the Telegram
+rate limits.
+
+Usage:
+    python3 rederive.py [--processes N] [--workers N] [--nice 10] [--chat-id ID] [--restart] [--dry-run]
+
+Progress is checkpointed in worker_state (key "rederive", plus
+rederive_state.json locally), so an interrupted run resumes where it
+stopped; a checkpoint taken with different image settings is ignored.
+Encoding runs in --processes worker processes reniced by --nice, which
+keeps it from starving the live worker on the same machine.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import ingest
+import imaging
+from logconfig import setup_process_logging
+from imaging import HAS_PIL, derivative_keys, render_derivatives
+from sweep_r2 import IMAGE_EXTS, _contains, _key_hash, _sort_hashes
+
+STATE_KEY = "rederive"
+
+def _settings() -> Dict[str, Any]:
+    return {
+        "sizes": imaging.IMAGE_SIZES,
+        "webp": imaging.ENABLE_WEBP,
+        "avif": imaging.ENABLE_AVIF,
+        "resized_originals": imaging.ENABLE_RESIZED_ORIGINALS,
+    }
+
+def _lower_priority(nice: int) -> None:
+    """Process pool initializer: give encoding a lower CPU priority than the live worker."""
+    setup_process_logging()
+    try:
+        os.nice(nice)
+    except OSError:
+        pass
+
+def list_existing(prefix: str) -> array:
+    """Every object key in the bucket (under `prefix`) as a sorted hash array."""
+    hashes = array("Q")
+    paginator = ingest.r2.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=ingest.R2_BUCKET, Prefix=prefix):
+        hashes.extend(_key_hash(obj["Key"]) for obj in page.get("Contents", []))
+    logging.info(f"Listed {len(hashes)} existing objects")
+    return _sort_hashes(hashes)
+
+def _image_originals(row: Dict[str, Any]) -> List[Tuple[str, str, str, str]]:
+    """(object key, chat id, message id, ext) of each image original a post shows."""
+    media = [(row.get("media_url"), row.get("media_type"))]
+    media += [(m.get("url"), m.get("type")) for m in row.get("media") or []]
+    out = []
+    for url, media_type in media:
+        key = ingest._object_key(url)
+        if not key:
+            continue
+        chat, _, name = key.partition("/")
+        message_id, ext = os.path.splitext(name)
+        if (media_type == "image" or ext.lower() in IMAGE_EXTS) and not any(o[0] == key for o in out):
+            out.append((key, chat, message_id, ext))
+    return out
+
+def plan(row: Dict[str, Any], existing) -> List[Tuple[str, str, str, str, List[str]]]:
+    """The originals of a post that are missing variants, with the missing keys."""
+    todo = []
+    for key, chat, message_id, ext in _image_originals(row):
+        missing = [k for k in derivative_keys(chat, message_id, ext) if not _contains(existing, k)]
+        if missing:
+            todo.append((key, chat, message_id, ext, missing))
+    return todo
+
+def _rederive(row: Dict[str, Any], todo, encoders: ProcessPoolExecutor, tmp_dir: str, dry_run: bool) -> Dict[str, int]:
+    """Fetch originals, render the missing variants and upload them (runs in an I/O thread)."""
+    done = {"variants": 0, "bytes": 0, "failed": 0}
+    if dry_run:
+        done["variants"] = sum(len(t[4]) for t in todo)
+        return done
+    uploaded: List[Dict[str, Any]] = []
+    for key, chat, message_id, ext, missing in todo:
+        local = os.path.join(tmp_dir, key.replace("/", "_"))
+        try:
+            ingest.r2.download_file(ingest.R2_BUCKET, key, local)
+            outputs = encoders.submit(render_derivatives, local, chat, message_id, ext, tmp_dir, set(missing)).result()
+            for path, vkey in outputs:
+                try:
+                    if ingest._upload_to_r2(path, vkey):
+                        uploaded.append(ingest._manifest_entry(path, vkey))
+                        done["variants"] += 1
+                        done["bytes"] += uploaded[-1]["size"]
+                except Exception as e:
+                    logging.warning(f"Failed to upload {vkey}: {e}")
+                finally:
+                    ingest._remove_file(path)
+            done["failed"] += len(missing) - len(outputs)
+        except Exception as e:
+            logging.warning(f"Failed to re-derive {key}: {e}")
+            done["failed"] += len(missing)
+        finally:
+            ingest._remove_file(local)
+    manifest = row.get("media_manifest")
+    if uploaded and manifest is not None and ingest.supabase:
+        merged = list({o["key"]: o for o in manifest + uploaded}.values())
+        ingest.supabase.table("posts").update({"media_manifest": merged}) \
+            .eq("channel_id", row["channel_id"]).eq("id", row["id"]).execute()
+    return done
+
+def run(processes: int, workers: int, nice: int, chat_id: Optional[int], restart: bool,
+        dry_run: bool, checkpoint_secs: int = 10) -> Dict[str, int]:
+    state = ingest.WorkerState(os.getenv("REDERIVE_STATE_PATH", "rederive_state.json"))
+    state.load()
+    saved = state.get(STATE_KEY) or {}
+    after = None
+    if not restart and saved.get("settings") == _settings() and saved.get("after"):
+        after = tuple(saved["after"])
+        logging.info(f"Resuming after post {after}")
+    counts = {"posts": 0, "planned": 0, "variants": 0, "bytes": 0, "failed": 0}
+
+    existing = list_existing(f"{chat_id}/" if chat_id else "")
+    where = (lambda q: q.eq("channel_id", chat_id)) if chat_id else None
+    rows = ingest._iter_posts("media_type,media_url,media,media_manifest", after=after, where=where)
+
+    started = time.monotonic()
+    last_report = started
+    tmp_dir = tempfile.mkdtemp(prefix="batarikh-rederive-")
+
+    def complete(row: Dict[str, Any], done: Dict[str, int]) -> None:
+        nonlocal last_report
+        for k in ("variants", "bytes", "failed"):
+            counts[k] += done[k]
+        now = time.monotonic()
+        if now - last_report >= checkpoint_secs:
+            last_report = now
+            elapsed = now - started
+            logging.info(f"{counts['posts']} posts scanned ({counts['posts'] / elapsed:.1f}/s), "
+                         f"{counts['variants']} variants ({counts['variants'] / elapsed:.1f}/s, "
+                         f"{counts['bytes'] / 1048576 / elapsed:.2f} MB/s), {counts['failed']} failed")
+            if not dry_run:
+                state.set(STATE_KEY, {"after": [row["channel_id"], row["id"]], "settings": _settings(), **counts})
+                state.save()
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_lower_priority, initargs=(nice,)) as encoders, \
+                ThreadPoolExecutor(max_workers=workers) as io:
+            # Bounded window of in-flight posts; completed oldest first so the checkpoint never skips one
+            window = deque()
+            for row in rows:
+                counts["posts"] += 1
+                todo = plan(row, existing)
+                if not todo:
+                    window.append((row, None))
+                else:
+                    counts["planned"] += 1
+                    window.append((row, io.submit(_rederive, row, todo, encoders, tmp_dir, dry_run)))
+                while window and (len(window) > workers * 4 or window[0][1] is None or window[0][1].done()):
+                    done_row, future = window.popleft()
+                    complete(done_row, future.result() if future else {"variants": 0, "bytes": 0, "failed": 0})
+            while window:
+                done_row, future = window.popleft()
+                complete(done_row, future.result() if future else {"variants": 0, "bytes": 0, "failed": 0})
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not dry_run:
+        state.set(STATE_KEY, {"after": None, "settings": _settings(), "finished": True, **counts})
+        state.save()
+    return counts
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Render image variants the current settings call for but R2 lacks.")
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Encoding processes (default: half the CPUs)")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent R2 downloads/uploads")
+    parser.add_argument("--nice", type=int, default=10, help="Niceness of the encoding processes")
+    parser.add_argument("--chat-id", type=int, help="Only this channel")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the first post")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the variants that would be rendered")
+    args = parser.parse_args()
+
+    if not HAS_PIL:
+        raise SystemExit("Pillow is required to render image variants")
+    ingest.require_env(ingest.R2_ENV)
+    if not ingest.supabase:
+        raise SystemExit("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY are required")
+    logging.info(f"Image settings: {_settings()}")
+    counts = run(max(1, args.processes), max(1, args.workers), args.nice, args.chat_id, args.restart, args.dry_run)
+    logging.info(f"Re-derivation finished: {counts}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.info("Re-derivation interrupted; run again to resume")
+        sys.exit(1)
@@ -0,0 +1,51 @@
+-- Tables used by the ingest worker (Supabase / Postgres).
+
+create table if not exists posts (
+  id bigint not null,
+  channel_id bigint not null,
+  created_at timestamptz not null,
+  content text,
+  media_type text not null default 'none',
+  media_url text,
+  width integer,
+  height integer,
+  primary key (channel_id, id)
+);
+
+-- Worker checkpoints (backfill progress etc.), one JSON value per key
+create table if not exists worker_state (
+  key text primary key,
+  value jsonb not null,
+  updated_at timestamptz not null default now()
+);
+
+-- Media state, for metadata-first backfill and later hydration:
+-- pending (row written, media not fetched yet), ready, failed, missing,
+-- repair (stored objects missing or damaged; refetched like pending)
+alter table posts add column if not exists media_status text;
+alter table posts add column if not exists tg_file_id text;
+alter table posts add column if not exists tg_file_unique_id text;
+create index if not exists posts_media_status_idx on posts (media_status, id desc);
+
+-- Multi-channel ingestion: message ids are only unique per channel.
+-- For an existing single-channel table, fill in the channel's chat id
+-- (e.g. -1001234567890) before switching the primary key:
+--   alter table posts add column if not exists channel_id bigint;
+--   update posts set channel_id = <chat id> where channel_id is null;
+--   alter table posts alter column channel_id set not null;
+--   alter table posts drop constraint posts_pkey;
+--   alter table posts add primary key (channel_id, id);
+
+-- Albums are stored as one post under their lowest message id, with every
+-- part's media in order: [{"id", "type", "url", "width", "height"}, ...]
+alter table posts add column if not exists media jsonb;
+
+-- Edit sync compares edits with these instead of reprocessing the post
+alter table posts add column if not exists content_hash text;
+alter table posts add column if not exists entities_hash text;
+
+-- Deleted channel messages are soft-deleted; media_manifest lists every R2
+-- object written for a post ([{"key", "size", "etag"}, ...]) so storage can
+-- be freed and verified
+alter table posts add column if not exists deleted_at timestamptz;
+alter table posts add column if not exists media_manifest jsonb;
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Find (and optionally delete) R2 objects that no post references.
+
+Failed and repeated runs leave objects behind: variants from an older
+IMAGE_SIZES, originals of retries saved under another extension, files of
+posts that were deleted before storage cleanup existed. The sweeper lists
+the bucket, compares every key with the keys the posts table references
+and prints a storage report per prefix. Nothing is deleted without --delete.
+
+Usage:
+    python3 sweep_r2.py [--delete] [--prefix CHAT_ID/] [--min-age-hours 24] [--stale-variants] [--json]
+
+A live post references its media_url, the media of its album parts, every
+object in its media manifest and, for images, the variants
+render_derivatives produces with the current settings. With
+--stale-variants, variants that only a manifest still lists (older sizes
+or formats) count as orphans too, and the manifests are trimmed once they
+are deleted. Objects younger than --min-age-hours are never touched: the
+live worker uploads media before it writes the row.
+
+The report splits each prefix into originals, resized variants and full
+size WebP/AVIF copies; "served" is the part the site actually loads (the
+posts' media_url objects), which is where egress comes from.
+
+The referenced keys are kept as a sorted array of 64-bit hashes, so the
+comparison needs 8 bytes per key however large the archive grows. The
+arrays are sorted in place with numpy when it is installed; without it a
+chunked sort-merge keeps the peak near two arrays.
+"""
+
+import os
+import sys
+import json
+import bisect
+import heapq
+import hashlib
+import logging
+import argparse
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+import ingest
+from imaging import derivative_keys
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+def _key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+SORT_CHUNK = 1 << 20
+
+def _sort_hashes(hashes: array) -> array:
+    """Sort a hash array without turning it into a list of Python ints."""
+    if HAS_NUMPY:
+        numpy.asarray(memoryview(hashes)).sort()
+        return hashes
+    # Sort runs of SORT_CHUNK in place, then merge them into a new array
+    for start in range(0, len(hashes), SORT_CHUNK):
+        hashes[start:start + SORT_CHUNK] = array("Q", sorted(hashes[start:start + SORT_CHUNK]))
+    if len(hashes) <= SORT_CHUNK:
+        return hashes
+    runs = [(hashes[i] for i in range(start, min(start + SORT_CHUNK, len(hashes))))
+            for start in range(0, len(hashes), SORT_CHUNK)]
+    merged = array("Q")
+    merged.extend(heapq.merge(*runs))
+    return merged
+
+def _contains(hashes: array, key: str) -> bool:
+    h = _key_hash(key)
+    i = bisect.bisect_left(hashes, h)
+    return i < len(hashes) and hashes[i] == h
+
+def _post_keys(row: Dict[str, Any], stale_variants: bool) -> Tuple[List[str], Set[str], Optional[List[Dict[str, Any]]]]:
+    """Keys a post references: (served originals, all referenced keys, trimmed manifest or None)."""
+    media = [(row.get("media_url"), row.get("media_type"))]
+    media += [(m.get("url"), m.get("type")) for m in row.get("media") or []]
+    originals: Dict[str, Optional[str]] = {}
+    for url, media_type in media:
+        key = ingest._object_key(url)
+        if key:
+            originals.setdefault(key, media_type)
+    keys = set(originals)
+    for key, media_type in originals.items():
+        chat, _, name = key.partition("/")
+        message_id, ext = os.path.splitext(name)
+        if media_type == "image" or ext.lower() in IMAGE_EXTS:
+            keys.update(derivative_keys(chat, message_id, ext))
+    manifest = row.get("media_manifest") or []
+    if not stale_variants:
+        keys.update(o["key"] for o in manifest)
+        return list(originals), keys, None
+    kept = [o for o in manifest if o["key"] in keys]
+    return list(originals), keys, kept if len(kept) != len(manifest) else None
+
+def load_references(prefix: str, stale_variants: bool) -> Tuple[array, array, List[Tuple[int, int, List[Dict[str, Any]]]]]:
+    """Stream the posts table into sorted hash arrays of referenced and served keys."""
+    referenced = array("Q")
+    served = array("Q")
+    trimmed = []
+    rows = 0
+    where = None
+    if "/" in prefix:
+        # A chat prefix only needs that channel's posts
+        where = lambda query: query.eq("channel_id", int(prefix.split("/")[0]))
+    for row in ingest._iter_posts("media_type,media_url,media,media_manifest", where=where):
+        originals, keys, kept = _post_keys(row, stale_variants)
+        served.extend(_key_hash(k) for k in originals)
+        referenced.extend(_key_hash(k) for k in keys)
+        if kept is not None:
+            trimmed.append((row["channel_id"], row["id"], kept))
+        rows += 1
+        if rows % 10000 == 0:
+            logging.info(f"Read {rows} posts, {len(referenced)} referenced keys")
+    logging.info(f"Read {rows} posts, {len(referenced)} referenced keys")
+    return _sort_hashes(referenced), _sort_hashes(served), trimmed
+
+def _kind(key: str) -> str:
+    name = key.rsplit("/", 1)[-1]
+    if "-w" in name:
+        return "resized"
+    if name.endswith((".webp", ".avif")):
+        return "webp/avif"
+    return "original"
+
+def sweep(prefix: str, delete: bool, min_age_hours: float, stale_variants: bool) -> Dict[str, Any]:
+    referenced, served, trimmed = load_references(prefix, stale_variants)
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=min_age_hours)
+    report: Dict[str, Dict[str, Dict[str, int]]] = {}
+    totals = {"objects": 0, "bytes": 0, "orphans": 0, "orphan_bytes": 0, "deleted": 0, "failed": 0, "recent": 0}
+    batch: List[str] = []
+
+    def flush() -> None:
+        if delete and batch:
+            failed = ingest._delete_r2_objects(batch)
+            totals["failed"] += len(failed)
+            totals["deleted"] += len(batch) - len(failed)
+        batch.clear()
+
+    paginator = ingest.r2.get_paginator("list_objects_v2")
+    for pages, page in enumerate(paginator.paginate(Bucket=ingest.R2_BUCKET, Prefix=prefix), 1):
+        for obj in page.get("Contents", []):
+            key, size = obj["Key"], obj["Size"]
+            stats = report.setdefault(key.split("/", 1)[0] + "/", {}).setdefault(
+                _kind(key), {"objects": 0, "bytes": 0, "served_bytes": 0, "orphans": 0, "orphan_bytes": 0})
+            stats["objects"] += 1
+            stats["bytes"] += size
+            totals["objects"] += 1
+            totals["bytes"] += size
+            if _contains(served, key):
+                stats["served_bytes"] += size
+            if _contains(referenced, key):
+                continue
+            if obj["LastModified"] > cutoff:
+                totals["recent"] += 1
+                continue
+            stats["orphans"] += 1
+            stats["orphan_bytes"] += size
+            totals["orphans"] += 1
+            totals["orphan_bytes"] += size
+            batch.append(key)
+            if len(batch) >= ingest.R2_DELETE_BATCH:
+                flush()
+        if pages % 10 == 0:
+            logging.info(f"Listed {totals['objects']} objects, {totals['orphans']} orphaned")
+    flush()
+
+    if delete and trimmed and not totals["failed"]:
+        # The stale variants are gone; stop listing them in the manifests
+        for channel_id, post_id, kept in trimmed:
+            ingest.supabase.table("posts").update({"media_manifest": kept or None}) \
+                .eq("channel_id", channel_id).eq("id", post_id).execute()
+        totals["manifests_trimmed"] = len(trimmed)
+    return {"totals": totals, "prefixes": report}
+
+def _mb(n: int) -> str:
+    return f"{n / 1048576:,.1f}"
+
+def print_report(result: Dict[str, Any], delete: bool) -> None:
+    print(f"{'prefix':<22} {'kind':<10} {'objects':>9} {'MB':>10} {'served MB':>10} {'orphans':>8} {'orphan MB':>10}")
+    for prefix, kinds in sorted(result["prefixes"].items()):
+        for kind, s in sorted(kinds.items()):
+            print(f"{prefix:<22} {kind:<10} {s['objects']:>9} {_mb(s['bytes']):>10} {_mb(s['served_bytes']):>10} "
+                  f"{s['orphans']:>8} {_mb(s['orphan_bytes']):>10}")
+    t = result["totals"]
+    print(f"\n{t['objects']} objects ({_mb(t['bytes'])} MB), {t['orphans']} orphaned ({_mb(t['orphan_bytes'])} MB), "
+          f"{t['recent']} too recent to judge")
+    if delete:
+        print(f"Deleted {t['deleted']} object(s), {t['failed']} failed")
+    else:
+        print("Dry run: pass --delete to remove the orphans")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Report and delete R2 objects no post references.")
+    parser.add_argument("--delete", action="store_true", help="Delete orphans (default: report only)")
+    parser.add_argument("--prefix", default="", help="Only sweep keys under this prefix, e.g. '-1001234567890/'")
+    parser.add_argument("--min-age-hours", type=float, default=24, help="Leave objects younger than this alone")
+    parser.add_argument("--stale-variants", action="store_true",
+                        help="Also treat variants outside the current image settings as orphans")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    ingest.require_env(ingest.R2_ENV)
+    if not ingest.supabase:
+        # Without the posts table every object would look orphaned
+        raise SystemExit("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY are required")
+    result = sweep(args.prefix, args.delete, args.min_age_hours, args.stale_variants)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result, args.delete)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.info("Sweep interrupted")
+        sys.exit(1)
@@ -0,0 +1,96 @@
+"""
+Per-message span timelines for the ingest pipeline.
+
+Each message gets a trace: monotonic (start, end) spans for the time it
+waited in a queue and the time a stage spent on it. Traces live in a
+bounded ring buffer (oldest message evicted first) and can be dumped as
+plain JSON or as Chrome trace-event JSON, which chrome://tracing and
+Perfetto show as a flame chart.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+MAX_SPANS = 64  # per message; retries keep appending, so cap it
+
+class TraceBuffer:
+    def __init__(self, capacity: int = 2000) -> None:
+        self.capacity = capacity
+        self._traces: "OrderedDict[Tuple[int, int], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def span(self, chat_id: int, message_id: int, name: str, start: float, end: float) -> None:
+        """Record that `name` ran from `start` to `end` (time.monotonic values) for a message."""
+        key = (chat_id, message_id)
+        with self._lock:
+            trace = self._traces.get(key)
+            if trace is None:
+                trace = self._traces[key] = {
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    # Offset from monotonic to wall-clock time
+                    "wall_offset": time.time() - time.monotonic(),
+                    "first": start,
+                    "last": end,
+                    "spans": [],
+                }
+                if len(self._traces) > self.capacity:
+                    self._traces.popitem(last=False)
+            if len(trace["spans"]) < MAX_SPANS:
+                trace["spans"].append((name, start, end))
+            trace["first"] = min(trace["first"], start)
+            trace["last"] = max(trace["last"], end)
+
+    def get(self, message_id: int, chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            traces = [t for (c, m), t in self._traces.items()
+                      if m == message_id and (chat_id is None or c == chat_id)]
+            return [self._export(t) for t in traces]
+
+    def slowest(self, n: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            traces = sorted(self._traces.values(), key=lambda t: t["last"] - t["first"], reverse=True)[:n]
+            return [self._export(t) for t in traces]
+
+    @staticmethod
+    def _export(trace: Dict[str, Any]) -> Dict[str, Any]:
+        first = trace["first"]
+        return {
+            "chat_id": trace["chat_id"],
+            "message_id": trace["message_id"],
+            "started_at": datetime.fromtimestamp(trace["wall_offset"] + first, timezone.utc).isoformat(),
+            "total_ms": round((trace["last"] - first) * 1000, 1),
+            "spans": [
+                {"name": name, "start_ms": round((start - first) * 1000, 1), "duration_ms": round((end - start) * 1000, 1)}
+                for name, start, end in sorted(trace["spans"], key=lambda s: s[1])
+            ],
+        }
+
+def chrome_trace(traces: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Chrome trace-event JSON for exported traces: one process per chat and
+    one row per message (metadata and album rows get rows of their own, since
+    they overlap the media stages)."""
+    events = []
+    rows: Dict[Tuple[int, str], int] = {}
+    for trace in traces:
+        base = datetime.fromisoformat(trace["started_at"]).timestamp() * 1e6
+        for span in trace["spans"]:
+            name, _, variant = span["name"].partition(" (")
+            label = f"message {trace['message_id']}" + (f" ({variant}" if variant else "")
+            tid = rows.get((trace["chat_id"], label))
+            if tid is None:
+                tid = rows[(trace["chat_id"], label)] = len(rows) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": trace["chat_id"], "tid": tid,
+                               "args": {"name": label}})
+            events.append({
+                "name": name,
+                "ph": "X",
+                "pid": trace["chat_id"],
+                "tid": tid,
+                "ts": base + span["start_ms"] * 1000,
+                "dur": span["duration_ms"] * 1000,
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Verify that the media every post points at is really in R2, and send the
+broken posts back for repair.
+
+Streams posts in keyset order and HEADs each object a post references with
+bounded concurrency (--concurrency requests in flight). Objects listed in
+a post's media manifest are checked against the recorded size and ETag;
+posts written before manifests existed are checked for their media_url
+(and album part URLs) only.
+
+A post is broken when an object is missing, its size or ETag differ from
+the manifest, or it has media but no media_url at all. Broken posts are
+marked media_status='repair'. The worker's hydration loop then refetches
+them from Telegram and runs the media stages again, writing over the stored
+objects; nothing is deleted, so a post whose message is gone from Telegram
+keeps whatever copy it had. --report-only changes nothing.
+
+Usage:
+    python3 verify_media.py [--concurrency 64] [--chat-id ID] [--report-only] [--json]
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+import ingest
+
+REPAIR_BATCH = 500
+
+def _objects(row: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The objects to probe for a post, with expected size/etag where known."""
+    if row.get("media_manifest"):
+        return row["media_manifest"]
+    urls = [row.get("media_url")] + [m.get("url") for m in row.get("media") or []]
+    keys = {ingest._object_key(u) for u in urls} - {None}
+    return [{"key": k} for k in sorted(keys)]
+
+def _probe(key: str) -> Tuple[Optional[int], Optional[str], Optional[str]]:
+    """HEAD one object: (size, etag, error); a missing object is error "missing"."""
+    try:
+        head = ingest.r2.head_object(Bucket=ingest.R2_BUCKET, Key=key)
+        return head["ContentLength"], head["ETag"].strip('"'), None
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code", "")
+        return None, None, "missing" if code in ("404", "NoSuchKey", "NotFound") else f"error {code}"
+    except Exception as e:
+        return None, None, f"error {e}"
+
+def check_post(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Probe a post's objects (runs in a probe thread)."""
+    result = {"row": row, "objects": 0, "problems": [], "errors": 0}
+    if row.get("media_type", "none") != "none" and not row.get("media_url") \
+            and row.get("media_status") not in ("pending", "repair", "missing"):
+        result["problems"].append("no_media")
+    for obj in _objects(row):
+        result["objects"] += 1
+        size, etag, error = _probe(obj["key"])
+        if error == "missing":
+            result["problems"].append("missing")
+        elif error:
+            # Transient or permission problems are reported, not repaired
+            result["errors"] += 1
+        elif obj.get("size") is not None and size != obj["size"]:
+            result["problems"].append("size_mismatch")
+        elif obj.get("etag") and etag != obj["etag"]:
+            result["problems"].append("etag_mismatch")
+    return result
+
+def verify(concurrency: int, chat_id: Optional[int], repair: bool, report_secs: int = 10) -> Dict[str, Any]:
+    counts = {"posts": 0, "objects": 0, "ok": 0, "broken": 0, "missing": 0, "size_mismatch": 0,
+              "etag_mismatch": 0, "no_media": 0, "errors": 0, "queued_for_repair": 0}
+    broken_sample: List[Tuple[int, int, List[str]]] = []
+    to_repair: Dict[int, List[int]] = {}
+    started = time.monotonic()
+    last_report = started
+
+    def flush_repairs() -> None:
+        for channel_id, ids in to_repair.items():
+            ingest._set_media_status(channel_id, ids, "repair")
+            counts["queued_for_repair"] += len(ids)
+        to_repair.clear()
+
+    def complete(result: Dict[str, Any]) -> None:
+        nonlocal last_report
+        row = result["row"]
+        counts["posts"] += 1
+        counts["objects"] += result["objects"]
+        counts["errors"] += result["errors"]
+        if not result["problems"]:
+            counts["ok"] += 1
+        else:
+            counts["broken"] += 1
+            for problem in set(result["problems"]):
+                counts[problem] += 1
+            if len(broken_sample) < 50:
+                broken_sample.append((row["channel_id"], row["id"], sorted(set(result["problems"]))))
+            if repair:
+                to_repair.setdefault(row["channel_id"], []).append(row["id"])
+                if sum(len(ids) for ids in to_repair.values()) >= REPAIR_BATCH:
+                    flush_repairs()
+        now = time.monotonic()
+        if now - last_report >= report_secs:
+            last_report = now
+            rate = counts["objects"] / (now - started) * 60
+            logging.info(f"Checked {counts['posts']} posts, {counts['objects']} objects ({rate:,.0f}/min), "
+                         f"{counts['broken']} broken")
+
+    where = (lambda q: q.eq("channel_id", chat_id)) if chat_id else None
+    rows = ingest._iter_posts("media_type,media_url,media_status,media,media_manifest", where=where)
+    with ThreadPoolExecutor(max_workers=concurrency) as probes:
+        # Bounded window so memory stays flat however many posts there are
+        window = deque()
+        for row in rows:
+            if row.get("media_type", "none") == "none" and not row.get("media"):
+                continue
+            window.append(probes.submit(check_post, row))
+            while len(window) > concurrency * 4 or (window and window[0].done()):
+                complete(window.popleft().result())
+        while window:
+            complete(window.popleft().result())
+    if repair:
+        flush_repairs()
+    elapsed = time.monotonic() - started
+    counts["objects_per_min"] = round(counts["objects"] / max(elapsed, 1e-6) * 60)
+    return {"counts": counts, "broken_sample": broken_sample}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="HEAD-check every post's media in R2 and queue broken posts for repair.")
+    parser.add_argument("--concurrency", type=int, default=64, help="HEAD requests in flight")
+    parser.add_argument("--chat-id", type=int, help="Only this channel")
+    parser.add_argument("--report-only", action="store_true", help="Do not mark anything for repair")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    ingest.require_env(ingest.R2_ENV)
+    if not ingest.supabase:
+        raise SystemExit("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY are required")
+    result = verify(max(1, args.concurrency), args.chat_id, not args.report_only)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    c = result["counts"]
+    print(f"{c['posts']} posts, {c['objects']} objects checked ({c['objects_per_min']:,}/min)")
+    print(f"ok: {c['ok']}  broken: {c['broken']}  (missing {c['missing']}, size mismatch {c['size_mismatch']}, "
+          f"etag mismatch {c['etag_mismatch']}, no media_url {c['no_media']})  probe errors: {c['errors']}")
+    for channel_id, post_id, problems in result["broken_sample"]:
+        print(f"  {channel_id}/{post_id}: {', '.join(problems)}")
+    if args.report_only:
+        print("Report only: nothing was queued for repair")
+    else:
+        print(f"Queued {c['queued_for_repair']} post(s) for repair; the worker's hydration loop refetches them")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.info("Verification interrupted")
+        sys.exit(1)